@@ -0,0 +1,212 @@
+# このファイルはパース済みレコード表 (records.RecordTable) に対する異常の事前検出を管理します。
+# 分析エージェントがログ全体を走査しなくて済むよう、NumPy でファイルごとに時刻のビンに集計し、
+#   - エラー率の急増 (ERROR以上の件数が平常時の割合からの期待値を大きく超えるビン)
+#   - access.log の 5xx の集中
+#   - レベルの悪化 (ERROR の後に初めて CRITICAL が出た箇所)
+#   - ログの途絶 (停止・再起動の疑い)
+# を検出し、行範囲付きの異常候補をスコア順に並べたテキストとしてグラフに渡します。
+# 列は array から np.frombuffer でコピーせずに参照するため、数百万行でも数秒以内に終わります。
+
+import math
+import os
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from records import LEVEL_CRITICAL, LEVEL_ERROR, RecordTable, format_timestamp
+
+@dataclass
+class Anomaly:
+    kind: str
+    file_name: str
+    start: float
+    end: float
+    line_start: int
+    line_end: int
+    score: float
+    detail: str
+
+    def line_ref(self) -> str:
+        if self.line_start == self.line_end:
+            return f"{self.file_name}: {self.line_start:04d}"
+        return f"{self.file_name}: {self.line_start:04d}-{self.line_end:04d}"
+
+    def describe(self) -> str:
+        period = format_timestamp(self.start)
+        if self.end > self.start:
+            period += f" 〜 {format_timestamp(self.end)}"
+        return f"[スコア {self.score:.1f}] {self.kind}: {period} {self.detail} [{self.line_ref()}]"
+
+class TableColumns:
+    """
+    RecordTable の列を時刻順の NumPy 配列として参照する。
+    """
+
+    def __init__(self, table: RecordTable):
+        ts = np.frombuffer(table.timestamps, dtype=np.float64)
+        order = None
+        if len(ts) > 1 and np.any(ts[1:] < ts[:-1]):
+            order = np.argsort(ts, kind="stable")
+
+        def column(values, dtype) -> np.ndarray:
+            data = np.frombuffer(values, dtype=dtype)
+            return data if order is None else data[order]
+
+        self.file_name = table.file_name
+        self.is_access = table.parser_name == "access"
+        self.ts = column(table.timestamps, np.float64)
+        self.levels = column(table.levels, np.int8)
+        self.statuses = column(table.statuses, np.uint16)
+        self.line_starts = column(table.line_starts, np.uint32)
+        self.line_ends = column(table.line_ends, np.uint32)
+
+    def line_range(self, lo: int, hi: int) -> Tuple[int, int]:
+        """
+        時刻順で lo〜hi-1 番目のレコードが含まれる行範囲。
+        """
+        return int(self.line_starts[lo:hi].min()), int(self.line_ends[lo:hi].max())
+
+def _bin_spikes(
+    cols: TableColumns, mask: np.ndarray, kind: str, label: str, t0: float, bin_sec: float, z_threshold: float,
+    min_count: int,
+) -> List[Anomaly]:
+    """
+    mask に該当するレコードの件数をビンごとに集計し、平常時の割合からの期待値を大きく超えるビンを、
+    連続するものをまとめて返します。スコアはポアソン近似のzスコアです。
+    """
+    bins = ((cols.ts - t0) // bin_sec).astype(np.int64)
+    nbins = int(bins[-1]) + 1
+    totals = np.bincount(bins, minlength=nbins)
+    hits = np.bincount(bins, weights=mask, minlength=nbins)
+    active = totals > 0
+    # 平常時の割合はビンごとの割合の中央値 (急増しているビン自体に引きずられない)。
+    # エラーがまばらで中央値が0になる場合は、全体の割合を下限にして単発のエラーを拾わないようにする
+    baseline = max(float(np.median(hits[active] / totals[active])), float(hits.sum() / totals.sum()))
+    expected = baseline * totals
+    z = (hits - expected) / np.sqrt(expected + 1.0)
+    flagged = np.flatnonzero((z >= z_threshold) & (hits >= min_count))
+
+    anomalies: List[Anomaly] = []
+    # 連続するビンを1つの窓にまとめる
+    groups = np.split(flagged, np.flatnonzero(np.diff(flagged) > 1) + 1) if len(flagged) else []
+    for group in groups:
+        first, last = int(group[0]), int(group[-1])
+        start, end = t0 + first * bin_sec, t0 + (last + 1) * bin_sec
+        lo, hi = np.searchsorted(cols.ts, [start, end], side="left")
+        line_start, line_end = cols.line_range(int(lo), int(hi))
+        count, total = int(hits[first:last + 1].sum()), int(totals[first:last + 1].sum())
+        anomalies.append(Anomaly(
+            kind=kind,
+            file_name=cols.file_name,
+            start=start,
+            end=end,
+            line_start=line_start,
+            line_end=line_end,
+            score=float(z[first:last + 1].max()),
+            detail=f"{label} {count}件 / 全{total}件 (平常時 {baseline:.2%})",
+        ))
+    return anomalies
+
+def _escalations(cols: TableColumns, z_threshold: float) -> List[Anomaly]:
+    """
+    ERROR が出た後に、初めて CRITICAL 以上に悪化した箇所。
+    """
+    critical = np.flatnonzero(cols.levels >= LEVEL_CRITICAL)
+    if not len(critical):
+        return []
+    first = int(critical[0])
+    errors_before = int(np.count_nonzero(cols.levels[:first] >= LEVEL_ERROR))
+    if not errors_before:
+        return []
+    first_error = int(np.argmax(cols.levels >= LEVEL_ERROR))
+    return [Anomaly(
+        kind="レベルの悪化",
+        file_name=cols.file_name,
+        start=float(cols.ts[first_error]),
+        end=float(cols.ts[first]),
+        line_start=int(cols.line_starts[first]),
+        line_end=int(cols.line_ends[first]),
+        # 障害の拡大を示すため、閾値ちょうどのスパイクより優先する
+        score=z_threshold * 2,
+        detail=f"ERROR {errors_before}件の後に CRITICAL 以上が発生 (CRITICAL以上 計{len(critical)}件)",
+    )]
+
+def _gaps(cols: TableColumns, z_threshold: float, min_gap_sec: float, gap_factor: float) -> List[Anomaly]:
+    """
+    通常の出力間隔に比べて極端に長くログが途絶えた箇所 (停止・再起動の疑い)。
+    """
+    if len(cols.ts) < 3:
+        return []
+    intervals = np.diff(cols.ts)
+    threshold = max(min_gap_sec, gap_factor * float(np.median(intervals)))
+    anomalies = []
+    for i in np.flatnonzero(intervals > threshold):
+        i = int(i)
+        gap = float(intervals[i])
+        anomalies.append(Anomaly(
+            kind="ログの途絶",
+            file_name=cols.file_name,
+            start=float(cols.ts[i]),
+            end=float(cols.ts[i + 1]),
+            line_start=int(cols.line_starts[i]),
+            line_end=int(cols.line_ends[i + 1]),
+            score=z_threshold * min(gap / threshold, 3.0),
+            detail=f"{gap:.0f}秒間出力なし (停止・再起動の疑い)",
+        ))
+    return anomalies
+
+def detect_anomalies(
+    tables: List[Optional[RecordTable]],
+    bin_sec: Optional[float] = None,
+    z_threshold: Optional[float] = None,
+    min_count: int = 3,
+    max_bins: int = 1_000_000,
+) -> List[Anomaly]:
+    """
+    全ファイルの異常候補をスコアの高い順に返します。
+    ビンの区切りは全ファイル共通の開始時刻から数えるため、ファイル間で同じ窓を比較できます。
+    """
+    tables = [t for t in tables if t is not None and len(t)]
+    if not tables:
+        return []
+    if bin_sec is None:
+        bin_sec = float(os.getenv("ANOMALY_BIN_SEC", "60"))
+    if z_threshold is None:
+        z_threshold = float(os.getenv("ANOMALY_Z_THRESHOLD", "4"))
+    min_gap_sec = float(os.getenv("ANOMALY_GAP_MIN_SEC", "300"))
+    gap_factor = float(os.getenv("ANOMALY_GAP_FACTOR", "20"))
+
+    columns = [TableColumns(t) for t in tables]
+    t0 = min(float(c.ts[0]) for c in columns)
+    t1 = max(float(c.ts[-1]) for c in columns)
+    # 期間が長すぎる場合はビン数が上限に収まるよう幅を広げる
+    bin_sec = max(bin_sec, math.ceil((t1 - t0) / max_bins))
+
+    anomalies: List[Anomaly] = []
+    for cols in columns:
+        anomalies.extend(_bin_spikes(
+            cols, cols.levels >= LEVEL_ERROR, "エラー率の急増", "ERROR以上", t0, bin_sec, z_threshold, min_count
+        ))
+        if cols.is_access:
+            anomalies.extend(_bin_spikes(
+                cols, cols.statuses >= 500, "5xxの集中", "5xx", t0, bin_sec, z_threshold, min_count
+            ))
+        anomalies.extend(_escalations(cols, z_threshold))
+        anomalies.extend(_gaps(cols, z_threshold, min_gap_sec, gap_factor))
+    anomalies.sort(key=lambda a: (-a.score, a.start, a.file_name))
+    return anomalies
+
+def build_anomaly_report(tables: List[Optional[RecordTable]], max_items: Optional[int] = None) -> str:
+    """
+    異常候補のランキングをテキストで返します。候補が無い場合は空文字列を返します。
+    """
+    anomalies = detect_anomalies(tables)
+    if not anomalies:
+        return ""
+    if max_items is None:
+        max_items = int(os.getenv("ANOMALY_MAX_ITEMS", "20"))
+    lines = [f"{n}. {a.describe()}" for n, a in enumerate(anomalies[:max_items], start=1)]
+    if len(anomalies) > max_items:
+        lines.append(f"(他 {len(anomalies) - max_items} 件は省略)")
+    return "\n".join(lines) + "\n"
@@ -1,7 +1,83 @@
+import os
+import time
+from typing import Optional
+
 import chainlit as cl
+from chainlit.server import app as chainlit_server
+from fastapi import Request
+from fastapi.responses import PlainTextResponse
 from langchain_core.messages import HumanMessage
 from langchain_core.runnables.config import RunnableConfig
-from graph import app as app_graph
+from anomaly import build_anomaly_report
+from graph import app as app_graph, drop_sampled_contexts
+from ingest import IngestResult, read_log_files_async
+from line_index import drop_line_indexes, register_indexed_files
+from log_store import drop_blob_store, get_blob_store
+from metrics import RunRecorder, metrics_request_allowed, registry as metrics_registry
+from records import build_incident_timeline
+from shards import plan_shards
+from ui_stream import TokenStream
+
+@chainlit_server.get("/metrics")
+async def metrics_endpoint(request: Request):
+    """
+    Prometheus 形式のメトリクス (ノードごとの所要時間・TTFT・トークン数など)。
+    METRICS_TOKEN を設定した場合は Bearer トークン、未設定の場合は同じホストからの接続のみ受け付けます。
+    """
+    client_host = request.client.host if request.client else None
+    if not metrics_request_allowed(request.headers.get("authorization"), client_host):
+        return PlainTextResponse("forbidden\n", status_code=403)
+    return PlainTextResponse(metrics_registry.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+def prioritize_route(path: str) -> None:
+    """
+    path のルートをルーティング表の先頭に移動します。
+    Chainlit はフロントエンド用のキャッチオールルートを持つため、独自のルートはそれより前に評価させる必要があります
+    (登録順に依存しないよう、末尾を取り出すのではなくパスで探す)。
+    """
+    routes = chainlit_server.router.routes
+    for i, route in enumerate(routes):
+        if getattr(route, "path", None) == path:
+            routes.insert(0, routes.pop(i))
+            return
+    raise RuntimeError(f"ルート {path} が登録されていません")
+
+prioritize_route("/metrics")
+
+# 読み込みの進捗表示を更新する最短の間隔 (秒)。ファイル数が多くても更新が多すぎないようにする
+INGEST_PROGRESS_INTERVAL_SEC = 0.5
+
+async def ingest_uploads(files: list, thread_id: str) -> IngestResult:
+    """
+    アップロードされたファイルをプロセスプールで並列に読み込み、読み込み状況を1つのメッセージで更新しながら表示する。
+    ログ本文はセッションのブロブストアに保存し、グラフには参照と要約だけを渡す。
+    """
+    total = len(files)
+    progress = cl.Message(content=f"{total}個のファイルを読み込んでいます... (0/{total})")
+    await progress.send()
+    last_update = 0.0
+
+    async def report(done: int, total: int, name: str):
+        nonlocal last_update
+        now = time.monotonic()
+        if done < total and now - last_update < INGEST_PROGRESS_INTERVAL_SEC:
+            return
+        last_update = now
+        progress.content = f"{total}個のファイルを読み込んでいます... ({done}/{total}、{name} 完了)"
+        await progress.update()
+
+    ingest_result = await read_log_files_async(files, get_blob_store(thread_id), on_progress=report)
+    # 読み込めなかったファイルがあっても、他のファイルで分析を続ける
+    failed = ingest_result.failed_files
+    progress.content = f"{total}個のファイルの読み込みが完了しました。"
+    if failed:
+        progress.content += "\n読み込めなかったファイル:\n" + "\n".join(f"- {f.name}: {f.error}" for f in failed)
+    if ingest_result.renamed:
+        progress.content += "\n同じ名前のファイルがあったため、名前を変えて読み込みました:\n" + "\n".join(
+            f"- {old} → {new}" for old, new in ingest_result.renamed
+        )
+    await progress.update()
+    return ingest_result
 
 @cl.password_auth_callback
 def auth_callback(username: str, password: str):
@@ -16,29 +92,57 @@ def auth_callback(username: str, password: str):
     else:
         return None
 
-async def run_analysis_graph(user_input_content: str, config: RunnableConfig):
+async def run_analysis_graph(user_input_content: str, config: RunnableConfig, extra_state: Optional[dict] = None):
     """
     LangGraphを実行し、思考プロセスと最終結果をChainlitにストリーミングする共通関数。
+    extra_state にはメッセージ以外のState (統合インシデントタイムライン等) を渡します。
     """
     
     final_answer = None
     last_node = None
     current_step = None
+    # トークンはチャンクごとではなく、一定間隔でまとめて送信する (ui_stream.py)
+    step_stream = None
+    answer_stream = None
+    streams = []
+
+    async def close_step():
+        # 溜まっているトークンを送ってからステップを確定する
+        nonlocal current_step, step_stream
+        if step_stream:
+            await step_stream.close()
+            step_stream = None
+        if current_step:
+            await current_step.update()
+            current_step = None
     
     # ノード名と表示名のマッピング
     node_map = {
         "context_agent": "Context Agent",
         "analysis_agent": "Analysis Agent",
+        "log_tools": "Log Search Tools",
+        "shard_agent": "Shard Analysis Agents",
+        "reduce_agent": "Reduce Agent",
         "critique_node": "Critique Agent",
         "summary_agent": "Summary Agent"
     }
 
     # イベントストリームの処理
-    async for event in app_graph.astream_events(
-        {"messages": [HumanMessage(content=user_input_content)]},
+    graph_input = {"messages": [HumanMessage(content=user_input_content)]}
+    if extra_state:
+        graph_input.update(extra_state)
+
+    # シャードモードの進捗表示用
+    shard_total = len(graph_input.get("shards") or [])
+    shards_done = 0
+
+    # ノードごとの所要時間・TTFT・トークン数を計測しながら流す (metrics.py)
+    recorder = RunRecorder(config["configurable"]["thread_id"])
+    async for event in recorder.track(app_graph.astream_events(
+        graph_input,
         config,
         version="v2"
-    ):
+    )):
         kind = event["event"]
         node_name = event.get("metadata", {}).get("langgraph_node")
         
@@ -48,23 +152,25 @@ async def run_analysis_graph(user_input_content: str, config: RunnableConfig):
         # --- ノード開始 (Agent Start) ---
         if kind == "on_chain_start" and node_name != last_node:
             # 前のステップがあれば閉じる
-            if current_step:
-                await current_step.update()
-                current_step = None
+            await close_step()
 
             # Summary Agentに到達したら、最終回答の準備をする
             if node_name == "summary_agent":
                 final_answer = cl.Message(content="")
                 await final_answer.send()
+                answer_stream = TokenStream(final_answer)
+                streams.append(answer_stream)
             else:
                 # 新しいエージェントステップを開始 (type="process"で折りたたみ可能)
                 display_name = node_map.get(node_name, node_name)
                 current_step = cl.Step(name=display_name, type="process")
                 await current_step.send()
+                step_stream = TokenStream(current_step)
+                streams.append(step_stream)
                 
                 # ログ風の開始ヘッダー
                 header = f"```text\n=== [START] {display_name} ===\n"
-                await current_step.stream_token(header)
+                await step_stream.write(header)
             
             last_node = node_name
             
@@ -76,27 +182,47 @@ async def run_analysis_graph(user_input_content: str, config: RunnableConfig):
             if not content:
                 continue
             
-            if node_name == "summary_agent":
+            if node_name == "shard_agent":
+                # 並列実行中のシャードはトークンが混ざるため流さず、完了時に進捗だけを表示する
+                continue
+            elif node_name == "summary_agent":
                 # 最終回答はそのままストリーミング
-                if final_answer:
-                    await final_answer.stream_token(content)
+                if answer_stream:
+                    await answer_stream.write(content)
             else:
                 # 思考プロセス中は、内容をそのまま流すが、コードブロック内にあるのでログとして見える
-                if current_step:
-                    await current_step.stream_token(content)
+                if step_stream:
+                    await step_stream.write(content)
+
+        # --- ツール呼び出し (Log Search Tools) ---
+        elif kind == "on_tool_start":
+            if step_stream:
+                args = ", ".join(f"{k}={v!r}" for k, v in (event["data"].get("input") or {}).items())
+                await step_stream.write(f"{event['name']}({args})\n")
+
+        # --- シャード完了 (Shard End) ---
+        elif kind == "on_chain_end" and node_name == "shard_agent":
+            if event.get("name") != "shard_agent" or not step_stream:
+                continue
+            shards_done += 1
+            await step_stream.write(f"シャード完了: {shards_done}/{shard_total}\n")
+            if shards_done >= shard_total:
+                await step_stream.write(f"\n=== [END] {node_map['shard_agent']} ===\n```")
+                await close_step()
 
         # --- ノード終了 (Agent End) ---
         elif kind == "on_chain_end" and node_name in node_map and node_name != "summary_agent":
             # ステップの終了処理
-            if current_step:
+            if step_stream:
                 footer = f"\n=== [END] {node_map.get(node_name, node_name)} ===\n```"
-                await current_step.stream_token(footer)
-                await current_step.update()
-                current_step = None
+                await step_stream.write(footer)
+                await close_step()
 
     # ループ終了後の後処理
-    if current_step:
-        await current_step.update()
+    await close_step()
+    if answer_stream:
+        await answer_stream.close()
+    metrics_registry.record_stream(sum(s.chunks for s in streams), sum(s.frames for s in streams))
 
     if final_answer:
         # 最終回答メッセージを完了（UI上の更新）
@@ -107,6 +233,13 @@ async def run_analysis_graph(user_input_content: str, config: RunnableConfig):
              final_answer = cl.Message(content="処理が完了しましたが、応答が生成されませんでした。")
              await final_answer.send()
 
+    # セッションの計測結果を表示する (METRICS_SHOW_SUMMARY=true の場合)
+    if os.getenv("METRICS_SHOW_SUMMARY", "false").lower() in ("1", "true", "yes"):
+        summary = metrics_registry.session_summary(config["configurable"]["thread_id"])
+        if summary:
+            async with cl.Step(name="Metrics", type="tool") as step:
+                step.output = f"```text\n{summary}\n```"
+
 @cl.on_chat_start
 async def on_chat_start():
     """
@@ -124,41 +257,43 @@ async def on_chat_start():
             timeout=600
         ).send()
 
-    # ファイル読み込み処理
-    log_contents = ""
-    file_names = []
-    
-    for file in files:
-        file_names.append(file.name)
-        try:
-            with open(file.path, "r", encoding="utf-8") as f:
-                # 行番号を付与して読み込む
-                lines = f.readlines()
-                content_with_lines = ""
-                for i, line in enumerate(lines):
-                    # 1-based index
-                    content_with_lines += f"{i+1:04d}: {line}"
-                
-                log_contents += f"\n\n=== ログファイル: {file.name} ===\n{content_with_lines}\n==========================\n"
-        except UnicodeDecodeError:
-             log_contents += f"\n\n=== ログファイル: {file.name} ===\n(エンコードエラー: UTF-8テキストとして読み込めませんでした)\n==========================\n"
-        except Exception as e:
-            log_contents += f"\n\n=== ログファイル: {file.name} ===\n(読み込みエラー: {str(e)})\n==========================\n"
+    thread_id = cl.context.session.thread_id
+
+    # ファイル読み込み処理 (ファイルごとにプロセスプールで並列に読み込み、イベントループを止めない)
+    ingest_result = await ingest_uploads(files, thread_id)
+    file_names = ingest_result.file_names
+
+    # パース済みレコードはフォローアップ時のタイムライン再構築のためセッションに保持する (ファイル名 → 表)
+    cl.user_session.set("record_tables", ingest_result.merge_record_tables())
+    # 行インデックスを登録し、Analysis Agent のログ検索ツールから使えるようにする
+    register_indexed_files(thread_id, ingest_result.files)
             
+    # 大規模アップロードの場合はシャード分割して並列分析する
+    shards = plan_shards(ingest_result)
+
     # 読み込み完了通知
+    mode_note = f"\n(ログが大きいため、{len(shards)}区間に分割して並列分析します)" if shards else ""
     await cl.Message(
-        content=f"以下の{len(file_names)}個のファイルを読み込みました:\n{', '.join(file_names)}\n\n分析を開始します..."
+        content=f"以下の{len(file_names)}個のファイルを読み込みました:\n{', '.join(file_names)}{mode_note}\n\n分析を開始します..."
     ).send()
 
     # LangGraph入力の構築
-    user_input_content = f"以下のログファイルを分析してください:\n{', '.join(file_names)}\n{log_contents}"
+    user_input_content = f"以下のログファイルを分析してください:\n{', '.join(file_names)}"
     
     config: RunnableConfig = {
-        "configurable": {"thread_id": cl.context.session.thread_id}
+        "configurable": {"thread_id": thread_id}
     }
     
     # 共通関数で分析実行
-    await run_analysis_graph(user_input_content, config)
+    await run_analysis_graph(
+        user_input_content, config,
+        {
+            "log_files": ingest_result.log_files,
+            "incident_timeline": ingest_result.incident_timeline(),
+            "anomaly_report": ingest_result.anomaly_report(),
+            "shards": shards,
+        }
+    )
 
 @cl.on_message
 async def main(message: cl.Message):
@@ -166,32 +301,53 @@ async def main(message: cl.Message):
     ユーザーからのメッセージ受信時のメイン処理。
     """
     
+    thread_id = cl.context.session.thread_id
+
     # 1. 添付ファイルの処理 (追加でアップロードされた場合)
-    log_contents = ""
     file_names = []
+    # このターンで追加されたファイル (フォローアップの分析には追加分の要約だけを渡す)
+    extra_state = {"new_log_files": []}
     
     if message.elements:
-        for element in message.elements:
-            if isinstance(element, cl.File):
-                file_names.append(element.name)
-                try:
-                    with open(element.path, "r", encoding="utf-8") as f:
-                        content = f.read()
-                        log_contents += f"\n\n=== Log File: {element.name} ===\n{content}\n==========================\n"
-                except Exception as e:
-                    log_contents += f"\n\n=== Log File: {element.name} ===\n(Read Error: {str(e)})\n==========================\n"
+        attached_files = [element for element in message.elements if isinstance(element, cl.File)]
+        if attached_files:
+            ingest_result = await ingest_uploads(attached_files, thread_id)
+            file_names = ingest_result.file_names
+
+            # 既存のレコードと合わせてタイムラインを再構築する (同じ名前のファイルは新しい表で置き換える)
+            session_tables = ingest_result.merge_record_tables(cl.user_session.get("record_tables"))
+            cl.user_session.set("record_tables", session_tables)
+            record_tables = list(session_tables.values())
+            register_indexed_files(thread_id, ingest_result.files)
+            extra_state = {
+                "log_files": ingest_result.log_files,
+                "new_log_files": ingest_result.log_files,
+                "incident_timeline": await cl.make_async(build_incident_timeline)(record_tables),
+                "anomaly_report": await cl.make_async(build_anomaly_report)(record_tables),
+                "shards": plan_shards(ingest_result),
+            }
 
     # 2. ユーザー入力の構築
     user_input_content = message.content
     
-    if log_contents:
-        user_input_content += f"\n\n(追加ログファイル):\n{', '.join(file_names)}\n{log_contents}"
+    if file_names:
+        user_input_content += f"\n\n(追加ログファイル):\n{', '.join(file_names)}"
         await cl.Message(content=f"追加のファイルを読み込みました: {', '.join(file_names)}").send()
 
     # 3. LangGraphの実行
     config: RunnableConfig = {
-        "configurable": {"thread_id": cl.context.session.thread_id}
+        "configurable": {"thread_id": thread_id}
     }
     
     # 共通関数で分析実行
-    await run_analysis_graph(user_input_content, config)
+    await run_analysis_graph(user_input_content, config, extra_state)
+
+@cl.on_chat_end
+async def on_chat_end():
+    """
+    チャットセッション終了時の処理。セッションのログストアと行インデックスを削除する。
+    """
+    drop_line_indexes(cl.context.session.thread_id)
+    drop_sampled_contexts(cl.context.session.thread_id)
+    metrics_registry.drop_session(cl.context.session.thread_id)
+    drop_blob_store(cl.context.session.thread_id)
@@ -0,0 +1,217 @@
+# このファイルはブラウザを使わずに複数のインシデントを一括分析するバッチCLIを管理します。
+# 指定したログディレクトリ (1ディレクトリ = 1インシデント) ごとに、インジェスト (CPU負荷の高いパース) を
+# プロセスプールで並列に実行し、分析グラフを同時実行数の上限付きで実行します。
+# レポートと処理時間はディレクトリごとに出力先へ書き出します。
+#
+# 使い方:
+#   python batch.py incidents/2025-12-23-* --output reports --workers 4 --concurrency 4
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+
+from ingest import IngestResult, ingest_pool_context, read_log_files
+
+# ==========================================
+# 1. インジェスト (プロセスプールで実行)
+# ==========================================
+
+@dataclass
+class LogFile:
+    """
+    read_log_files に渡すファイル (Chainlitのファイル要素と同じく name と path を持つ)。
+    """
+    name: str
+    path: str
+
+def find_log_files(directory: str) -> List[LogFile]:
+    """
+    ディレクトリ配下のファイルを再帰的に列挙します (隠しファイルは除外、名前は相対パス)。
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for name in sorted(filenames):
+            if name.startswith("."):
+                continue
+            path = os.path.join(dirpath, name)
+            files.append(LogFile(os.path.relpath(path, directory).replace(os.sep, "/"), path))
+    return files
+
+def ingest_directory(directory: str, store) -> IngestResult:
+    """
+    1ディレクトリ分のログを読み込みます。ワーカープロセス上で実行されます。
+    """
+    return read_log_files(find_log_files(directory), store)
+
+# ==========================================
+# 2. 分析グラフの実行
+# ==========================================
+
+@dataclass
+class IncidentRun:
+    """
+    1インシデント (1ディレクトリ) 分の実行結果。
+    """
+    name: str
+    directory: str
+    status: str = "pending"
+    error: Optional[str] = None
+    files: int = 0
+    lines: int = 0
+    shards: int = 0
+    ingest_sec: float = 0.0
+    graph_sec: float = 0.0
+    total_sec: float = 0.0
+    # ノードごとの完了時刻 (グラフ開始からの経過秒)
+    node_timings: Optional[list] = None
+
+def unique_run_names(directories: List[str]) -> List[str]:
+    """
+    出力先のディレクトリ名。同じ名前のディレクトリがある場合は連番を付けます。
+    """
+    names, seen = [], {}
+    for directory in directories:
+        base = os.path.basename(os.path.normpath(directory)) or "incident"
+        count = seen.get(base, 0)
+        seen[base] = count + 1
+        names.append(base if count == 0 else f"{base}-{count + 1}")
+    return names
+
+async def run_incident(
+    run: IncidentRun, output_dir: str, pool: ProcessPoolExecutor, semaphore: asyncio.Semaphore
+) -> IncidentRun:
+    """
+    1インシデントのインジェストと分析を実行し、レポートと処理時間を書き出します。
+    失敗しても他のインシデントの処理は続行します。
+    """
+    # グラフ (LLMクライアント) はワーカープロセスで初期化しないよう、ここで読み込む
+    from graph import app as app_graph, drop_sampled_contexts, memory
+    from langchain_core.messages import AIMessage, HumanMessage
+    from line_index import drop_line_indexes, register_indexed_files
+    from log_store import drop_blob_store, get_blob_store
+    from shards import plan_shards
+
+    thread_id = f"batch-{run.name}-{int(time.time())}"
+    run_dir = os.path.join(output_dir, run.name)
+    os.makedirs(run_dir, exist_ok=True)
+    started = time.perf_counter()
+    try:
+        store = get_blob_store(thread_id)
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(pool, ingest_directory, run.directory, store)
+        run.ingest_sec = time.perf_counter() - started
+        run.files, run.lines = len(result.files), result.total_lines
+        if not result.files:
+            raise ValueError("ログファイルがありません")
+        register_indexed_files(thread_id, result.files)
+        shards = plan_shards(result)
+        run.shards = len(shards)
+
+        graph_input = {
+            "messages": [HumanMessage(content=f"以下のログファイルを分析してください:\n{', '.join(result.file_names)}")],
+            "log_files": result.log_files,
+            "incident_timeline": result.incident_timeline(),
+            "anomaly_report": result.anomaly_report(),
+            "shards": shards,
+        }
+        config = {"configurable": {"thread_id": thread_id}}
+
+        # グラフの同時実行数を制限する (LLM呼び出し自体の上限は llm_pool が管理)
+        async with semaphore:
+            graph_started = time.perf_counter()
+            run.node_timings = []
+            async for update in app_graph.astream(graph_input, config, stream_mode="updates"):
+                for node in update:
+                    run.node_timings.append({"node": node, "elapsed_sec": round(time.perf_counter() - graph_started, 3)})
+            run.graph_sec = time.perf_counter() - graph_started
+
+        state = await app_graph.aget_state(config)
+        report = next(
+            (m.content for m in reversed(state.values.get("messages", [])) if isinstance(m, AIMessage) and m.content),
+            "",
+        )
+        with open(os.path.join(run_dir, "report.md"), "w", encoding="utf-8") as f:
+            f.write(str(report))
+        run.status = "ok"
+    except Exception as e:
+        run.status = "error"
+        run.error = f"{type(e).__name__}: {str(e)}"
+    finally:
+        run.total_sec = time.perf_counter() - started
+        run.ingest_sec, run.graph_sec, run.total_sec = (
+            round(run.ingest_sec, 3), round(run.graph_sec, 3), round(run.total_sec, 3)
+        )
+        drop_line_indexes(thread_id)
+        drop_sampled_contexts(thread_id)
+        drop_blob_store(thread_id)
+        await memory.adelete_thread(thread_id)
+        with open(os.path.join(run_dir, "timing.json"), "w", encoding="utf-8") as f:
+            json.dump(vars(run), f, ensure_ascii=False, indent=2)
+    return run
+
+async def run_batch(directories: List[str], output_dir: str, workers: int, concurrency: int) -> List[IncidentRun]:
+    runs = [IncidentRun(name, directory) for name, directory in zip(unique_run_names(directories), directories)]
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    # グラフ・チェックポインター (SQLite) を持つプロセスから fork しないよう、ingest と同じ起動方式を使う
+    with ProcessPoolExecutor(max_workers=max(workers, 1), mp_context=ingest_pool_context()) as pool:
+        tasks = [run_incident(run, output_dir, pool, semaphore) for run in runs]
+        for done in asyncio.as_completed(tasks):
+            run = await done
+            detail = f"{run.total_sec:.1f}秒" if run.status == "ok" else run.error
+            print(f"[{run.status}] {run.name} ({run.files}ファイル, {run.lines}行) {detail}", file=sys.stderr)
+    return runs
+
+# ==========================================
+# 3. コマンドライン
+# ==========================================
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="ログディレクトリ (1ディレクトリ = 1インシデント) を一括分析します。")
+    parser.add_argument("directories", nargs="+", help="分析するログディレクトリ")
+    parser.add_argument("--output", default="reports", help="レポートの出力先 (既定: reports)")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="インジェストのプロセス数 (既定: CPU数)"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=int(os.getenv("BATCH_MAX_CONCURRENCY", "4")),
+        help="同時に実行する分析グラフの数 (既定: BATCH_MAX_CONCURRENCY または 4)",
+    )
+    parser.add_argument(
+        "--llm-concurrency", type=int, default=None,
+        help="LLM呼び出しの同時実行数 (LLM_MAX_CONCURRENCY を上書き)",
+    )
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.llm_concurrency is not None:
+        # llm_pool はグラフの読み込み時に設定を読むため、先に環境変数へ反映する
+        os.environ["LLM_MAX_CONCURRENCY"] = str(args.llm_concurrency)
+    directories = [d for d in args.directories if os.path.isdir(d)]
+    for skipped in sorted(set(args.directories) - set(directories)):
+        print(f"[skip] {skipped} はディレクトリではありません", file=sys.stderr)
+    if not directories:
+        return 2
+
+    os.makedirs(args.output, exist_ok=True)
+    started = time.perf_counter()
+    runs = asyncio.run(run_batch(directories, args.output, args.workers, args.concurrency))
+    summary = {
+        "total_sec": round(time.perf_counter() - started, 3),
+        "succeeded": sum(1 for r in runs if r.status == "ok"),
+        "failed": sum(1 for r in runs if r.status != "ok"),
+        "runs": [vars(r) for r in runs],
+    }
+    with open(os.path.join(args.output, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return 0 if summary["failed"] == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
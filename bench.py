@@ -0,0 +1,258 @@
+# このファイルはAPIを呼ばずにシステムのスループットを計測するベンチマークを管理します。
+# SYSTEM_CONTEXT_INFO の形式 (access.log / app.log / db.log) の合成ログを指定サイズ・エラー率で生成し、
+# 決定的なフェイクモデル (fake_llm.py, LLM_TYPE=fake) でグラフ全体を実行して、
+#   - インジェスト速度 (MB/s)・ピークRSS (初回と、解析キャッシュにヒットする再アップロード)
+#   - ノードごとの所要時間・送信トークン数 (見積もり)
+#   - エンドツーエンドの所要時間
+# を出力します。同じ引数 (シード) なら同じログが生成されるため、変更前後の比較に使えます。
+#
+# 使い方:
+#   python bench.py --lines 200000 --error-rate 0.01 --latency 0.2 --chars-per-sec 2000 --output bench.json
+
+import argparse
+import asyncio
+import calendar
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+# ==========================================
+# 1. 合成ログの生成
+# ==========================================
+
+ACCESS_PATHS = ("/api/v1/health", "/api/v1/login", "/api/v1/dashboard", "/api/v1/users", "/favicon.ico")
+USER_AGENTS = ("Mozilla/5.0", "Prometheus/2.45.0", "curl/7.68.0")
+APP_INFO_MESSAGES = (
+    "Request handled: GET /api/v1/dashboard user_id={n}",
+    "Cache hit for session {n}",
+    "Loading configuration from /etc/app/config.json",
+    "Background job {n} completed in {ms}ms",
+)
+DB_INFO_MESSAGES = (
+    "checkpoint complete: wrote {n} buffers",
+    "connection authorized: user=app database=main",
+    "duration: {ms} ms statement: SELECT * FROM users WHERE id = {n}",
+)
+MONTH_NAMES = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+def generate_logs(directory: str, lines: int, error_rate: float, seed: int = 0) -> List[str]:
+    """
+    access.log / app.log / db.log をそれぞれ約 lines 行生成し、パスの一覧を返します。
+    error_rate の割合で 500 エラー・Traceback 付きの ERROR・接続数上限の FATAL を混ぜます。
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    start = calendar.timegm((2025, 12, 23, 10, 0, 0, 0, 0, 0))
+    paths = {name: os.path.join(directory, name) for name in ("access.log", "app.log", "db.log")}
+    with open(paths["access.log"], "w") as access, open(paths["app.log"], "w") as app, open(paths["db.log"], "w") as db:
+        for i in range(lines):
+            t = time.gmtime(start + i * 0.5)
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", t)
+            is_error = rng.random() < error_rate
+            ip = f"192.168.1.{rng.randint(2, 254)}"
+            path = rng.choice(ACCESS_PATHS)
+            status = 500 if is_error else rng.choice((200, 200, 200, 200, 404))
+            access.write(
+                f'{ip} - - [{t.tm_mday:02d}/{MONTH_NAMES[t.tm_mon - 1]}/{t.tm_year}:{time.strftime("%H:%M:%S", t)} +0900] '
+                f'"GET {path} HTTP/1.1" {status} {rng.randint(10, 5000)} "-" "{rng.choice(USER_AGENTS)}"\n'
+            )
+            if is_error:
+                app.write(
+                    f"{stamp} [ERROR] Connection timeout: Unable to reach database server at 192.168.1.50:5432\n"
+                    "Traceback (most recent call last):\n"
+                    '  File "main.py", line 45, in <module>\n'
+                    "    db.connect()\n"
+                    '  File "/app/lib/db.py", line 120, in connect\n'
+                    '    raise ConnectionError("Timeout connecting to DB")\n'
+                    "ConnectionError: Timeout connecting to DB\n"
+                )
+                db.write(
+                    f"{stamp} [ERROR] FATAL: connection limit exceeded for non-superusers\n"
+                    f"{stamp} [DETAIL] 100 active connections found. Max connections is 100.\n"
+                )
+            else:
+                n, ms = rng.randint(1, 99999), rng.randint(1, 900)
+                app.write(f"{stamp} [INFO] {rng.choice(APP_INFO_MESSAGES).format(n=n, ms=ms)}\n")
+                level = "WARNING" if ms > 850 else "INFO"
+                db.write(f"{stamp} [{level}] {rng.choice(DB_INFO_MESSAGES).format(n=n, ms=ms)}\n")
+    return list(paths.values())
+
+# ==========================================
+# 2. 計測
+# ==========================================
+
+def peak_rss_mb() -> float:
+    """
+    このプロセスのピークRSS (MB)。Linux では KB、macOS ではバイト単位で返されるため換算する。
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class LogFile:
+    def __init__(self, path: str):
+        self.name = os.path.basename(path)
+        self.path = path
+
+def bench_ingest(paths: List[str], store) -> dict:
+    """
+    app.py と同じ read_log_files_async (解析キャッシュ・プロセスプール・小さいファイルのまとめ読み) で読み込みます。
+    peak_rss_mb は親プロセスの値です (プールのワーカーは含みません)。
+    """
+    from ingest import ingest_workers, read_log_files_async
+
+    size = sum(os.path.getsize(p) for p in paths)
+    started = time.perf_counter()
+    result = asyncio.run(read_log_files_async([LogFile(p) for p in paths], store))
+    elapsed = time.perf_counter() - started
+    return {
+        "result": result,
+        "bytes": size,
+        "lines": result.total_lines,
+        "workers": ingest_workers(),
+        "sec": round(elapsed, 3),
+        "mb_per_sec": round(size / (1024 * 1024) / elapsed, 2) if elapsed else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+async def bench_graph(result, thread_id: str) -> dict:
+    """
+    グラフ全体を実行し、ノードごとの所要時間と送信トークン数 (llm_pool.estimate_tokens) を集計します。
+    sec は全呼び出しの合計 (並列実行されるシャードではセマフォ待ちを含む)、max_sec は1回あたりの最大です。
+    """
+    from graph import app as app_graph
+    from langchain_core.messages import HumanMessage
+    from line_index import register_indexed_files
+    from llm_pool import estimate_tokens
+    from shards import plan_shards
+
+    register_indexed_files(thread_id, result.files)
+    shards = plan_shards(result)
+    graph_input = {
+        "messages": [HumanMessage(content=f"以下のログファイルを分析してください:\n{', '.join(result.file_names)}")],
+        "log_files": result.log_files,
+        "incident_timeline": result.incident_timeline(),
+        "anomaly_report": result.anomaly_report(),
+        "shards": shards,
+    }
+    config = {"configurable": {"thread_id": thread_id}}
+
+    nodes: Dict[str, dict] = {}
+    node_started: Dict[str, float] = {}
+    first_token: Optional[float] = None
+    started = time.perf_counter()
+    async for event in app_graph.astream_events(graph_input, config, version="v2"):
+        kind = event["event"]
+        node = event.get("metadata", {}).get("langgraph_node")
+        if not node:
+            continue
+        stats = nodes.setdefault(node, {"calls": 0, "sec": 0.0, "max_sec": 0.0, "llm_calls": 0, "tokens_sent": 0})
+        if kind == "on_chain_start" and event.get("name") == node:
+            node_started[event["run_id"]] = time.perf_counter()
+        elif kind == "on_chain_end" and event.get("name") == node and event["run_id"] in node_started:
+            elapsed = time.perf_counter() - node_started.pop(event["run_id"])
+            stats["calls"] += 1
+            stats["sec"] += elapsed
+            stats["max_sec"] = max(stats["max_sec"], elapsed)
+        elif kind == "on_chat_model_start":
+            stats["llm_calls"] += 1
+            stats["tokens_sent"] += sum(estimate_tokens(m) for m in event["data"]["input"]["messages"])
+        elif kind == "on_chat_model_stream" and first_token is None:
+            first_token = time.perf_counter() - started
+    for stats in nodes.values():
+        stats["sec"], stats["max_sec"] = round(stats["sec"], 3), round(stats["max_sec"], 3)
+    return {
+        "shards": len(shards),
+        "end_to_end_sec": round(time.perf_counter() - started, 3),
+        "first_token_sec": round(first_token, 3) if first_token is not None else None,
+        "tokens_sent": sum(s["tokens_sent"] for s in nodes.values()),
+        "nodes": nodes,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+def print_report(report: dict) -> None:
+    ingest = report["ingest"]
+    print(f"ingest: {ingest['lines']}行 / {ingest['bytes'] / (1024 * 1024):.1f}MB, "
+          f"{ingest['sec']}秒 ({ingest['mb_per_sec']} MB/s, {ingest['workers']}プロセス), "
+          f"peak RSS {ingest['peak_rss_mb']}MB")
+    cached = report["ingest_cached"]
+    print(f"ingest (解析キャッシュ): {cached['sec']}秒 ({cached['mb_per_sec']} MB/s)")
+    graph = report["graph"]
+    print(f"graph:  {graph['end_to_end_sec']}秒 (最初のトークンまで {graph['first_token_sec']}秒), "
+          f"shards {graph['shards']}, 送信トークン {graph['tokens_sent']}, peak RSS {graph['peak_rss_mb']}MB")
+    print(f"  {'node':<16}{'calls':>6}{'sec':>10}{'max_sec':>10}{'llm':>6}{'tokens':>10}")
+    for node, s in graph["nodes"].items():
+        print(f"  {node:<16}{s['calls']:>6}{s['sec']:>10.3f}{s['max_sec']:>10.3f}{s['llm_calls']:>6}{s['tokens_sent']:>10}")
+
+# ==========================================
+# 3. コマンドライン
+# ==========================================
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="合成ログとフェイクモデルでインジェストと分析グラフを計測します。")
+    parser.add_argument("--lines", type=int, default=100000, help="1ファイルあたりの行数 (既定: 100000)")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="エラー行の割合 (既定: 0.01)")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード (既定: 0)")
+    parser.add_argument("--latency", type=float, default=0.0, help="フェイクモデルの最初のトークンまでの遅延 (秒)")
+    parser.add_argument("--chars-per-sec", type=float, default=0.0, help="フェイクモデルのストリーミング速度 (0は待たない)")
+    parser.add_argument("--log-dir", default=None, help="合成ログの出力先 (既定: 一時ディレクトリ)")
+    parser.add_argument("--skip-graph", action="store_true", help="インジェストだけを計測する")
+    parser.add_argument("--output", default=None, help="結果をJSONで書き出すパス")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    work_dir = tempfile.mkdtemp(prefix="log-kaiseki-bench-")
+    # グラフの読み込み前に、フェイクモデルと使い捨ての保存先を設定する
+    # (LLM応答キャッシュは計測を歪めるため無効、解析キャッシュは初回が必ずミスになるよう使い捨てにする)
+    os.environ.update({
+        "LLM_TYPE": "fake",
+        "FAKE_LLM_LATENCY_SEC": str(args.latency),
+        "FAKE_LLM_CHARS_PER_SEC": str(args.chars_per_sec),
+        "LLM_CACHE_ENABLED": "false",
+        "CHECKPOINT_DB_PATH": os.path.join(work_dir, "checkpoints.sqlite"),
+        "LOG_STORE_DIR": os.path.join(work_dir, "store"),
+        "INGEST_CACHE_DIR": os.path.join(work_dir, "ingest_cache"),
+    })
+    from log_store import drop_blob_store, get_blob_store
+
+    thread_id = "bench"
+    try:
+        log_dir = args.log_dir or os.path.join(work_dir, "logs")
+        generate_started = time.perf_counter()
+        paths = generate_logs(log_dir, args.lines, args.error_rate, args.seed)
+        report = {
+            "params": vars(args),
+            "generate_sec": round(time.perf_counter() - generate_started, 3),
+        }
+        ingest = bench_ingest(paths, get_blob_store(thread_id))
+        result = ingest.pop("result")
+        report["ingest"] = ingest
+        # 別のセッションへの再アップロード (解析キャッシュにヒットする)
+        cached = bench_ingest(paths, get_blob_store(f"{thread_id}-repeat"))
+        cached.pop("result")
+        report["ingest_cached"] = cached
+        if not args.skip_graph:
+            report["graph"] = asyncio.run(bench_graph(result, thread_id))
+    finally:
+        drop_blob_store(thread_id)
+        drop_blob_store(f"{thread_id}-repeat")
+        # チェックポイントDB・ブロブストア・解析キャッシュ (と既定の合成ログ) を残さない
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.skip_graph:
+        print(json.dumps({"ingest": report["ingest"], "ingest_cached": report["ingest_cached"]}, ensure_ascii=False))
+    else:
+        print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
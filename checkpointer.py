@@ -0,0 +1,366 @@
+# このファイルはLangGraphのチェックポイント (会話状態) の永続化を管理します。
+# MemorySaver は全スレッドの全履歴をプロセスメモリに保持し続けるため、長時間稼働するサーバーでは
+# メモリが増え続け、再起動で全て失われます。ここではSQLiteに保存し、
+#   - スレッド (名前空間) ごとに最新のチェックポイントだけを残すコンパクション
+#   - 一定時間アクセスの無いスレッドの削除 (TTL) と、スレッド数上限による LRU 削除
+#   - 直近のチェックポイントをメモリ上限付きの LRU キャッシュで保持
+# を行います。app.py が渡す thread_id の設定 (configurable.thread_id) はそのまま使えます。
+
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+
+class BoundedSqliteSaver(BaseCheckpointSaver):
+    """
+    SQLiteに最新のチェックポイントのみを保存する、容量制限付きのチェックポインター。
+
+    過去のチェックポイントは保存しないため、タイムトラベル (過去の状態からの再実行) には対応しません。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl_sec: float = 7 * 24 * 3600,
+        max_threads: int = 1000,
+        memory_cap_bytes: int = 64 * 1024 * 1024,
+        evict_interval_sec: float = 60.0,
+        **kwargs: Any,
+    ):
+        super().__init__(**kwargs)
+        self.path = path
+        self.ttl_sec = ttl_sec
+        self.max_threads = max_threads
+        self.memory_cap_bytes = memory_cap_bytes
+        self.evict_interval_sec = evict_interval_sec
+        self._lock = threading.RLock()
+        self._last_evict = 0.0
+        # (thread_id, checkpoint_ns) -> (checkpoint_id, parent_id, checkpoint, metadata, size)
+        self._hot: "OrderedDict[Tuple[str, str], tuple]" = OrderedDict()
+        self._hot_bytes = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                parent_checkpoint_id TEXT,
+                type TEXT NOT NULL,
+                checkpoint BLOB NOT NULL,
+                metadata_type TEXT NOT NULL,
+                metadata BLOB NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns)
+            );
+            CREATE TABLE IF NOT EXISTS writes (
+                thread_id TEXT NOT NULL,
+                checkpoint_ns TEXT NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                type TEXT NOT NULL,
+                value BLOB NOT NULL,
+                task_path TEXT NOT NULL,
+                PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+            );
+            CREATE TABLE IF NOT EXISTS threads (
+                thread_id TEXT PRIMARY KEY,
+                accessed_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_threads_accessed ON threads (accessed_at);
+            """
+        )
+        self._conn.commit()
+
+    # ------------------------------------------
+    # 内部処理
+    # ------------------------------------------
+    def _touch(self, thread_id: str) -> None:
+        self._conn.execute(
+            "INSERT INTO threads (thread_id, accessed_at) VALUES (?, ?) "
+            "ON CONFLICT(thread_id) DO UPDATE SET accessed_at = excluded.accessed_at",
+            (thread_id, time.time()),
+        )
+
+    def _cache_put(self, key: Tuple[str, str], entry: tuple) -> None:
+        old = self._hot.pop(key, None)
+        if old is not None:
+            self._hot_bytes -= old[-1]
+        self._hot[key] = entry
+        self._hot_bytes += entry[-1]
+        while self._hot_bytes > self.memory_cap_bytes and len(self._hot) > 1:
+            _, evicted = self._hot.popitem(last=False)
+            self._hot_bytes -= evicted[-1]
+
+    def _cache_drop_thread(self, thread_id: str) -> None:
+        for key in [k for k in self._hot if k[0] == thread_id]:
+            self._hot_bytes -= self._hot.pop(key)[-1]
+
+    def _load_latest(self, thread_id: str, checkpoint_ns: str) -> Optional[tuple]:
+        key = (thread_id, checkpoint_ns)
+        entry = self._hot.get(key)
+        if entry is not None:
+            self._hot.move_to_end(key)
+            return entry
+        row = self._conn.execute(
+            "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata "
+            "FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?",
+            (thread_id, checkpoint_ns),
+        ).fetchone()
+        if row is None:
+            return None
+        checkpoint_id, parent_id, type_, checkpoint, metadata_type, metadata = row
+        entry = (checkpoint_id, parent_id, (type_, checkpoint), (metadata_type, metadata),
+                 len(checkpoint) + len(metadata))
+        self._cache_put(key, entry)
+        return entry
+
+    def _load_writes(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> list:
+        rows = self._conn.execute(
+            "SELECT task_id, channel, type, value FROM writes "
+            "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+        return [(task_id, channel, self.serde.loads_typed((type_, value))) for task_id, channel, type_, value in rows]
+
+    def _make_tuple(self, thread_id: str, checkpoint_ns: str, entry: tuple) -> CheckpointTuple:
+        checkpoint_id, parent_id, checkpoint, metadata, _ = entry
+        return CheckpointTuple(
+            config={"configurable": {
+                "thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id,
+            }},
+            checkpoint=self.serde.loads_typed(checkpoint),
+            metadata=self.serde.loads_typed(metadata),
+            pending_writes=self._load_writes(thread_id, checkpoint_ns, checkpoint_id),
+            parent_config=(
+                {"configurable": {
+                    "thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id,
+                }}
+                if parent_id else None
+            ),
+        )
+
+    def _maybe_evict(self) -> None:
+        """
+        一定間隔で、TTL切れのスレッドとスレッド数上限を超えた古いスレッドを削除します。
+        """
+        now = time.time()
+        if now - self._last_evict < self.evict_interval_sec:
+            return
+        self._last_evict = now
+        expired = [r[0] for r in self._conn.execute(
+            "SELECT thread_id FROM threads WHERE accessed_at < ?", (now - self.ttl_sec,)
+        )]
+        overflow = [r[0] for r in self._conn.execute(
+            "SELECT thread_id FROM threads ORDER BY accessed_at DESC LIMIT -1 OFFSET ?", (self.max_threads,)
+        )]
+        for thread_id in set(expired + overflow):
+            self._delete_thread(thread_id)
+
+    def _delete_thread(self, thread_id: str) -> None:
+        for table in ("checkpoints", "writes", "threads"):
+            self._conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (thread_id,))
+        self._cache_drop_thread(thread_id)
+
+    # ------------------------------------------
+    # BaseCheckpointSaver の実装 (同期)
+    # ------------------------------------------
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        with self._lock:
+            entry = self._load_latest(thread_id, checkpoint_ns)
+            if entry is None:
+                return None
+            # 最新以外のチェックポイントは保存していない
+            checkpoint_id = get_checkpoint_id(config)
+            if checkpoint_id and checkpoint_id != entry[0]:
+                return None
+            self._touch(thread_id)
+            self._conn.commit()
+            return self._make_tuple(thread_id, checkpoint_ns, entry)
+
+    def list(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> Iterator[CheckpointTuple]:
+        with self._lock:
+            if config:
+                query = "SELECT thread_id, checkpoint_ns FROM checkpoints WHERE thread_id = ?"
+                params: tuple = (config["configurable"]["thread_id"],)
+                if config["configurable"].get("checkpoint_ns") is not None:
+                    query += " AND checkpoint_ns = ?"
+                    params += (config["configurable"]["checkpoint_ns"],)
+            else:
+                query, params = "SELECT thread_id, checkpoint_ns FROM checkpoints", ()
+            keys = self._conn.execute(query, params).fetchall()
+            results = []
+            for thread_id, checkpoint_ns in keys:
+                entry = self._load_latest(thread_id, checkpoint_ns)
+                if entry is None:
+                    continue
+                if config and get_checkpoint_id(config) and get_checkpoint_id(config) != entry[0]:
+                    continue
+                if before and get_checkpoint_id(before) and entry[0] >= get_checkpoint_id(before):
+                    continue
+                result = self._make_tuple(thread_id, checkpoint_ns, entry)
+                if filter and not all(result.metadata.get(k) == v for k, v in filter.items()):
+                    continue
+                results.append(result)
+        results.sort(key=lambda t: t.config["configurable"]["checkpoint_id"], reverse=True)
+        yield from results[:limit] if limit is not None else results
+
+    def put(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        parent_id = config["configurable"].get("checkpoint_id")
+        type_, serialized = self.serde.dumps_typed(checkpoint)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self._lock:
+            # コンパクション: 同じスレッド・名前空間の古いチェックポイントと書き込みを置き換える
+            self._conn.execute(
+                "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id != ?",
+                (thread_id, checkpoint_ns, checkpoint["id"]),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints "
+                "(thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, checkpoint["id"], parent_id, type_, serialized,
+                 metadata_type, serialized_metadata),
+            )
+            self._touch(thread_id)
+            self._cache_put(
+                (thread_id, checkpoint_ns),
+                (checkpoint["id"], parent_id, (type_, serialized), (metadata_type, serialized_metadata),
+                 len(serialized) + len(serialized_metadata)),
+            )
+            self._maybe_evict()
+            self._conn.commit()
+        return {"configurable": {
+            "thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"],
+        }}
+
+    def put_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, serialized = self.serde.dumps_typed(value)
+            rows.append((thread_id, checkpoint_ns, checkpoint_id, task_id,
+                         WRITES_IDX_MAP.get(channel, idx), channel, type_, serialized, task_path))
+        # 特殊チャネル (エラー・割り込み等) は上書き、通常の書き込みは既存を優先する
+        replace = all(channel in WRITES_IDX_MAP for channel, _ in writes)
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        with self._lock:
+            self._conn.executemany(
+                f"{verb} INTO writes (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, type, value, task_path) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            self._delete_thread(thread_id)
+            self._conn.commit()
+
+    def get_next_version(self, current: Optional[str], channel: None = None) -> str:
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+    # ------------------------------------------
+    # 非同期版 (SQLiteの処理はワーカースレッドで実行する)
+    # ------------------------------------------
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(
+        self,
+        config: Optional[RunnableConfig],
+        *,
+        filter: Optional[Dict[str, Any]] = None,
+        before: Optional[RunnableConfig] = None,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[CheckpointTuple]:
+        results = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for result in results:
+            yield result
+
+    async def aput(
+        self,
+        config: RunnableConfig,
+        checkpoint: Checkpoint,
+        metadata: CheckpointMetadata,
+        new_versions: ChannelVersions,
+    ) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(
+        self,
+        config: RunnableConfig,
+        writes: Sequence[Tuple[str, Any]],
+        task_id: str,
+        task_path: str = "",
+    ) -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+def create_checkpointer() -> BoundedSqliteSaver:
+    """
+    環境変数に基づいてチェックポインターを作成します。
+    """
+    return BoundedSqliteSaver(
+        path=os.getenv("CHECKPOINT_DB_PATH", os.path.join(".cache", "checkpoints.sqlite")),
+        ttl_sec=float(os.getenv("CHECKPOINT_TTL_SEC", str(7 * 24 * 3600))),
+        max_threads=int(os.getenv("CHECKPOINT_MAX_THREADS", "1000")),
+        memory_cap_bytes=int(float(os.getenv("CHECKPOINT_MEMORY_MB", "64")) * 1024 * 1024),
+    )
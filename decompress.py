@@ -0,0 +1,124 @@
+# このファイルは圧縮・アーカイブされたログアップロードのストリーミング展開を管理します。
+# ローテートされたログ (app.log.1.gz など) や tar アーカイブを、先頭のマジックバイトで判定し、
+# 展開後のファイルをメモリやディスクに書き出さずに、行単位のストリームとしてインジェストに渡します。
+# zstd は zstandard パッケージがインストールされている場合のみ対応します。
+
+import io
+import os
+import tarfile
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # zstd は任意の依存関係
+    zstandard = None
+
+# 展開時の読み込みバッファサイズ
+READ_BUFFER_SIZE = 1024 * 1024
+
+# (マジックバイト, 形式)
+MAGIC_NUMBERS = (
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+)
+
+COMPRESSION_SUFFIXES = (".gz", ".gzip", ".bz2", ".xz", ".zst", ".zstd")
+
+# ==========================================
+# 1. 形式の判定
+# ==========================================
+
+def detect_compression(head: bytes) -> Optional[str]:
+    """
+    先頭のバイト列から圧縮形式 (gzip / bz2 / xz / zstd) を判定します。非圧縮の場合は None。
+    """
+    for magic, kind in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return kind
+    return None
+
+def is_tar(head: bytes) -> bool:
+    """
+    先頭512バイトが tar (ustar) のヘッダーかどうか。
+    """
+    return head[257:262] == b"ustar"
+
+def strip_compression_suffix(name: str) -> str:
+    """
+    "app.log.1.gz" → "app.log.1" のように圧縮形式の拡張子を取り除きます。
+    """
+    lower = name.lower()
+    for suffix in COMPRESSION_SUFFIXES:
+        if lower.endswith(suffix) and len(name) > len(suffix):
+            return name[: -len(suffix)]
+    return name
+
+# ==========================================
+# 2. ストリーミング展開
+# ==========================================
+
+def open_decompressed(stream: BinaryIO, kind: str) -> io.BufferedReader:
+    """
+    圧縮されたバイナリストリームを、展開しながら読み出すストリームでラップします。
+    """
+    if kind == "gzip":
+        import gzip
+        raw = gzip.GzipFile(fileobj=stream, mode="rb")
+    elif kind == "bz2":
+        import bz2
+        raw = bz2.BZ2File(stream, mode="rb")
+    elif kind == "xz":
+        import lzma
+        raw = lzma.LZMAFile(stream, mode="rb")
+    elif kind == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd 形式の展開には zstandard パッケージが必要です (pip install zstandard)")
+        raw = zstandard.ZstdDecompressor().stream_reader(stream, read_size=READ_BUFFER_SIZE)
+    else:
+        raise ValueError(f"未対応の圧縮形式です: {kind}")
+    return io.BufferedReader(raw, READ_BUFFER_SIZE)
+
+def _maybe_decompress(stream: io.BufferedReader) -> Tuple[io.BufferedReader, bool]:
+    kind = detect_compression(stream.peek(8)[:8])
+    if kind is None:
+        return stream, False
+    return open_decompressed(stream, kind), True
+
+def iter_raw_stream_lines(stream: BinaryIO) -> Iterator[bytes]:
+    """
+    バイナリストリームから1行ずつ (改行コードを除いたバイト列) を返すジェネレータ。
+    """
+    for raw in stream:
+        yield raw.rstrip(b"\r\n")
+
+def iter_log_members(file_name: str, path: str) -> Iterator[Tuple[str, Optional[Iterator[bytes]]]]:
+    """
+    アップロードされた1ファイルに含まれるログを (ファイル名, 行のバイト列のイテレータ) で返します。
+
+    - 非圧縮のテキストファイル: (file_name, None) を1件返します (呼び出し側で mmap により読み込む)。
+    - 圧縮ファイル: 拡張子を除いた名前で、展開しながら読む行イテレータを1件返します。
+    - tar アーカイブ (圧縮されたものを含む): 含まれる通常ファイルごとに "アーカイブ名/メンバー名" で返します。
+      tar はストリームモードで読むため、各メンバーの行イテレータは次のメンバーに進む前に読み切ってください。
+    """
+    with open(path, "rb") as f:
+        head = f.read(512)
+        kind = detect_compression(head)
+        if kind is None and not is_tar(head):
+            yield file_name, None
+            return
+        f.seek(0)
+        stream = open_decompressed(f, kind) if kind else io.BufferedReader(f, READ_BUFFER_SIZE)
+        if not is_tar(stream.peek(512)[:512]):
+            yield strip_compression_suffix(file_name), iter_raw_stream_lines(stream)
+            return
+        with tarfile.open(fileobj=stream, mode="r|") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                member_stream, compressed = _maybe_decompress(archive.extractfile(member))
+                member_name = os.path.normpath(member.name)
+                if compressed:
+                    member_name = strip_compression_suffix(member_name)
+                yield f"{file_name}/{member_name}", iter_raw_stream_lines(member_stream)
@@ -0,0 +1,131 @@
+# このファイルはベンチマークやオフライン検証用の決定的なチャットモデルを管理します。
+# 実際のAPIを呼ばずに、遅延 (最初のトークンまでの時間) とストリーミング速度を再現し、
+# 各エージェントの指示プロンプトに応じた固定の応答を返します。
+# LLM_TYPE=fake を設定すると graph.get_llm() がこのモデルを返します。
+
+import asyncio
+import os
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+# (指示プロンプトに含まれる文字列, 応答)
+FAKE_RESPONSES = (
+    ("Critique Agent", "APPROVE\n引用は原文と一致しており、因果関係の説明も妥当です。"),
+    ("Summary Agent", (
+        "# ログ分析レポート\n\n"
+        "## 概要\nDB接続数の上限到達により、アプリケーションがDBに接続できず500エラーが発生しました。\n\n"
+        "## 根拠\n- [db.log: 0004] FATAL: connection limit exceeded\n"
+        "- [app.log: 0004] Connection timeout\n- [access.log: 0003] 500\n\n"
+        "## 対策\n- max_connections とコネクションプール設定を見直す\n"
+    )),
+    ("Reduce Agent", "統合結果: [db.log: 0004] の接続数上限到達が [app.log: 0004] のタイムアウトの原因です。"),
+    ("Shard Analysis Agent", "このシャードの注目点: [app.log: 0004] Connection timeout"),
+)
+DEFAULT_RESPONSE = (
+    "## エラーの抽出\n- [app.log: 0004] Connection timeout: Unable to reach database server\n"
+    "- [db.log: 0004] FATAL: connection limit exceeded for non-superusers\n\n"
+    "## 根本原因\n重いクエリによるDB負荷で接続数が上限に達し、アプリ側の接続がタイムアウトしました。\n"
+)
+
+class FakeChatModel(BaseChatModel):
+    """
+    固定の応答を、設定した遅延と速度でストリーミングするチャットモデル。
+    """
+    # 最初のトークンまでの遅延 (秒)
+    latency_sec: float = 0.0
+    # ストリーミング速度 (文字/秒)。0 の場合は待たない
+    chars_per_sec: float = 0.0
+    chunk_size: int = 8
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model_name": "fake", "latency_sec": self.latency_sec, "chars_per_sec": self.chars_per_sec}
+
+    def bind_tools(self, tools: List[Any], **kwargs: Any):
+        # ツールは受け付けるが呼び出さない (常に分析結果を返す)
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], **kwargs)
+
+    def _reply(self, messages: List[BaseMessage]) -> str:
+        instruction = str(messages[-1].content) if messages else ""
+        for marker, response in FAKE_RESPONSES:
+            if marker in instruction:
+                return response
+        return DEFAULT_RESPONSE
+
+    def _chunk_delay(self) -> float:
+        return self.chunk_size / self.chars_per_sec if self.chars_per_sec > 0 else 0.0
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        text = self._reply(messages)
+        time.sleep(self.latency_sec + self._chunk_delay() * (len(text) // self.chunk_size))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        text = self._reply(messages)
+        await asyncio.sleep(self.latency_sec + self._chunk_delay() * (len(text) // self.chunk_size))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        text = self._reply(messages)
+        time.sleep(self.latency_sec)
+        for i in range(0, len(text), self.chunk_size):
+            if i:
+                time.sleep(self._chunk_delay())
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=text[i:i + self.chunk_size]))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        text = self._reply(messages)
+        await asyncio.sleep(self.latency_sec)
+        for i in range(0, len(text), self.chunk_size):
+            if i:
+                await asyncio.sleep(self._chunk_delay())
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=text[i:i + self.chunk_size]))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+def get_fake_llm() -> FakeChatModel:
+    """
+    環境変数 (FAKE_LLM_LATENCY_SEC / FAKE_LLM_CHARS_PER_SEC) に基づいてモデルを作成します。
+    """
+    return FakeChatModel(
+        latency_sec=float(os.getenv("FAKE_LLM_LATENCY_SEC", "0")),
+        chars_per_sec=float(os.getenv("FAKE_LLM_CHARS_PER_SEC", "0")),
+    )
@@ -1,12 +1,14 @@
+import asyncio
 import os
-from typing import Annotated, Literal, TypedDict
+from collections import OrderedDict
+from typing import Annotated, Literal, Optional, TypedDict
 import operator
 
-from langchain_core.messages import HumanMessage, SystemMessage, BaseMessage, AIMessage
+from langchain_core.messages import HumanMessage, SystemMessage, BaseMessage, AIMessage, ToolMessage
 from langchain_openai import ChatOpenAI, AzureChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import START, END, StateGraph, MessagesState
 from langgraph.prebuilt import ToolNode
+from langgraph.types import Send
 
 # プロンプト定義をインポート
 from prompts import (
@@ -15,8 +17,29 @@ from prompts import (
     ANALYSIS_AGENT_PROMPT,
     ANALYSIS_FOLLOWUP_PROMPT,
     CRITIC_AGENT_PROMPT,
-    SUMMARY_AGENT_PROMPT
+    SUMMARY_AGENT_PROMPT,
+    INCIDENT_TIMELINE_PROMPT,
+    ANOMALY_REPORT_PROMPT,
+    SHARD_ANALYSIS_PROMPT,
+    REDUCE_AGENT_PROMPT,
+    LOG_DIGEST_PROMPT,
+    LOG_SAMPLE_NOTE_PROMPT,
+    CITATION_SLICES_PROMPT,
+    CITATION_CHECK_PROMPT,
+    LOG_TOOLS_PROMPT,
+    PREVIOUS_FINDINGS_PROMPT,
+    EARLIER_LOG_FILES_PROMPT
 )
+from ingest import format_file_block, format_line
+from line_index import get_indexed_files
+from checkpointer import create_checkpointer
+from llm_cache import ReplayChatModel, cached_ainvoke
+from llm_pool import estimate_text_tokens, get_llm_pool, get_named_semaphore
+from log_tools import LOG_TOOLS
+from sampler import context_token_budget, sample_logs
+from log_store import find_citations, get_blob_store, render_citation_slices, resolve_session_id
+from shards import describe_shard, read_shard, shard_max_concurrency
+from verifier import CitedLines, Verdict, verifier_enabled, verify_analysis
 
 # 環境変数の読み込み
 from dotenv import load_dotenv
@@ -25,9 +48,10 @@ load_dotenv()
 # ==========================================
 # 1. LLMの初期化設定
 # ==========================================
-def get_llm():
+def get_llm(model_name: Optional[str] = None):
     """
     環境変数に基づいて適切なLLMインスタンスを返します。
+    model_name を指定した場合は、そのモデル (Azure の場合はデプロイ名) を使います。
     """
     llm_type = os.getenv("LLM_TYPE", "openai")
 
@@ -37,25 +61,105 @@ def get_llm():
             api_key=os.getenv("AZURE_OPENAI_API_KEY"),
             azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
             api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            azure_deployment=os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
-            temperature=0
+            azure_deployment=model_name or os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+            temperature=0,
+            # 再試行は llm_pool 側でジッター付きバックオフとして行う
+            max_retries=0,
+            # ストリーミング時も usage_metadata (実トークン数) を受け取り、metrics.py で集計する
+            stream_usage=True
         )
+    elif llm_type == "fake":
+        # ベンチマーク・オフライン検証用の決定的なモデル (APIを呼ばない)
+        from fake_llm import get_fake_llm
+        return get_fake_llm()
     else:
         # 本家OpenAIの設定
         return ChatOpenAI(
-            model="gpt-4o-mini", 
-            temperature=0
+            model=model_name or os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+            temperature=0,
+            # 再試行は llm_pool 側でジッター付きバックオフとして行う
+            max_retries=0,
+            # ストリーミング時も usage_metadata (実トークン数) を受け取り、metrics.py で集計する
+            stream_usage=True
         )
 
-# LLMインスタンスを作成
+# LLMインスタンスを作成 (全セッションで共有し、呼び出しはプロバイダー単位のプールでレート制御する)
 model = get_llm()
+llm_pool = get_llm_pool()
+
+# ノードごとのモデルを指定する環境変数 (未設定のノードは既定のモデルを使う)
+# 例: 批評は小さく速いモデル、分析は強いモデル
+NODE_MODEL_ENV = {
+    "analysis_agent": "ANALYSIS_LLM_MODEL",
+    "shard_agent": "SHARD_LLM_MODEL",
+    "reduce_agent": "REDUCE_LLM_MODEL",
+    "critique_node": "CRITIQUE_LLM_MODEL",
+    "summary_agent": "SUMMARY_LLM_MODEL",
+}
+_node_models = {}
+
+def get_node_model(node: str):
+    """
+    ノードに割り当てられたモデルを返します。同じモデル名のインスタンスはノード間で共有します。
+    """
+    model_name = os.getenv(NODE_MODEL_ENV[node], "") if node in NODE_MODEL_ENV else ""
+    if not model_name:
+        return model
+    node_model = _node_models.get(model_name)
+    if node_model is None:
+        node_model = _node_models[model_name] = get_llm(model_name)
+    return node_model
+
+def log_tool_max_rounds() -> int:
+    """
+    1回の分析で Analysis Agent がログ検索ツールを呼び出せる回数の上限。0 の場合はツールを使いません。
+    """
+    return int(os.getenv("LOG_TOOL_MAX_ROUNDS", "5"))
 
 # ==========================================
 # 2. State (状態) の定義
 # ==========================================
+def merge_findings(current: Optional[list], update: Optional[list]) -> list:
+    """
+    シャード分析結果のリデューサー。None を受け取った場合はリセットする。
+    """
+    if update is None:
+        return []
+    return (current or []) + update
+
+def merge_log_files(current: Optional[list], update: Optional[list]) -> list:
+    """
+    ログファイル参照のリデューサー。同じファイル名のものは新しい内容 (ref) で置き換え、重複させない
+    (行インデックスの登録 line_index.register_indexed_files と同じ扱い。追記され続けるファイルの
+    スナップショットを何度渡しても State が大きくならない)。
+    """
+    merged = list(current or [])
+    positions = {f["name"]: i for i, f in enumerate(merged)}
+    for entry in update or []:
+        i = positions.get(entry["name"])
+        if i is None:
+            positions[entry["name"]] = len(merged)
+            merged.append(entry)
+        else:
+            merged[i] = entry
+    return merged
+
 class LogAnalysisState(MessagesState):
     # レビューの反復回数を追跡
     revision_count: int
+    # アップロードされたログの参照と要約 (ingest.IngestedFile.digest_entry)
+    # ログ本文はメッセージ履歴に入れず、セッションのブロブストア (log_store) に保存する
+    log_files: Annotated[list, merge_log_files]
+    # ログのパース結果から生成した統合インシデントタイムライン (records.build_incident_timeline)
+    incident_timeline: str
+    # パース結果から NumPy で事前検出した異常候補のランキング (anomaly.build_anomaly_report)
+    anomaly_report: str
+    # このターンで追加されたログの参照と要約 (フォローアップ時は差分だけを渡す)
+    new_log_files: list
+    # 大規模アップロード時のシャード計画 (shards.plan_shards)。空の場合は通常の単一分析
+    shards: list
+    # 各シャードの部分的な分析結果 (map の出力 / reduce の入力)
+    shard_findings: Annotated[list, merge_findings]
 
 # ==========================================
 # 3. ノード (処理ステップ) の定義
@@ -63,6 +167,202 @@ class LogAnalysisState(MessagesState):
 
 from langchain_core.runnables import RunnableConfig
 
+def build_timeline_context(state: LogAnalysisState) -> list:
+    """
+    統合インシデントタイムラインをメッセージとして返す
+    """
+    timeline = state.get("incident_timeline")
+    if not timeline:
+        return []
+    return [HumanMessage(content=INCIDENT_TIMELINE_PROMPT.format(timeline=timeline))]
+
+def build_anomaly_context(state: LogAnalysisState) -> list:
+    """
+    事前検出した異常候補のランキングをメッセージとして返す
+    """
+    report = state.get("anomaly_report")
+    if not report:
+        return []
+    return [HumanMessage(content=ANOMALY_REPORT_PROMPT.format(report=report))]
+
+def followup_compaction_enabled() -> bool:
+    return os.getenv("FOLLOWUP_COMPACT_HISTORY", "true").lower() not in ("0", "false", "no")
+
+def find_turn_start(messages: list) -> Optional[int]:
+    """
+    今回のターンの開始位置 (最後のユーザー入力) を返す。前のターンにAIの応答が無い場合 (初回) は None を返す
+    """
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage):
+            if any(isinstance(m, AIMessage) for m in messages[:i]):
+                return i
+            return None
+    return None
+
+def compact_history(messages: list) -> list:
+    """
+    フォローアップ時は、前のターンまでの履歴をシステム情報と直前の最終レポートだけに畳み込む
+    (送信量がセッションの長さではなく、今回のターンの内容で決まるようにする)
+    """
+    turn_start = find_turn_start(messages)
+    if turn_start is None or not followup_compaction_enabled():
+        return messages
+    earlier = messages[:turn_start]
+    report = next(
+        (m for m in reversed(earlier) if isinstance(m, AIMessage) and not getattr(m, "tool_calls", None)), None
+    )
+    compacted = [m for m in earlier if isinstance(m, SystemMessage)]
+    if report is not None:
+        compacted.append(HumanMessage(content=PREVIOUS_FINDINGS_PROMPT.format(report=report.content)))
+    return compacted + messages[turn_start:]
+
+def shared_prefix_enabled() -> bool:
+    return os.getenv("PROMPT_SHARED_PREFIX", "true").lower() not in ("0", "false", "no")
+
+def bind_log_tools(node_model, config: RunnableConfig, allow_calls: bool = True):
+    """
+    セッションに行インデックスがあれば、ログ検索ツールの定義をモデルに渡す。
+    ツールの定義はプロバイダー側ではプロンプトの先頭に置かれるため、ツールを呼び出さないノード (批評・要約など) にも
+    同じ定義を tool_choice="none" で渡し、分析ノードと先頭部分を同じバイト列に揃える (allow_calls=False)。
+    """
+    if log_tool_max_rounds() <= 0 or not get_indexed_files(resolve_session_id(config)):
+        return node_model
+    if allow_calls:
+        return node_model.bind_tools(LOG_TOOLS)
+    return node_model.bind_tools(LOG_TOOLS, tool_choice="none")
+
+def build_prompt(state: LogAnalysisState, config: RunnableConfig, tail: list, include_logs: bool = True) -> list:
+    """
+    ノードに渡すメッセージを「システム情報 → ログの要約 → 会話履歴 → ノード固有の内容と指示」の順に組み立てる。
+    先頭 (システム情報 + ログ) はターン内の分析・批評・要約で同じバイト列になるため、
+    プロバイダー側のプロンプトキャッシュ (先頭一致) が効く。
+    """
+    history = compact_history(state["messages"])
+    system = [m for m in history if isinstance(m, SystemMessage)]
+    conversation = [m for m in history if not isinstance(m, SystemMessage)]
+    log_context = build_log_context(state, config) if include_logs else []
+    return system + log_context + conversation + tail
+
+# (セッション, ファイルの ref, 予算) -> サンプリング結果のメッセージ
+# 分析・批評・要約の各ノードで同じプロンプトの先頭部分になるよう、同じ入力には同じ結果を返す
+# (セッション終了時に破棄するが、破棄されない実行があっても直近の件数だけを保持する)
+SAMPLED_CONTEXT_CACHE_SIZE = 32
+_sampled_contexts: "OrderedDict[tuple, list]" = OrderedDict()
+
+def read_file_body(log_file: dict, store) -> str:
+    """
+    プロンプトに載せる1ファイル分の本文。全行を渡すファイル ("raw") は State には要約しか無いため、
+    ブロブストアから全行を読み出す (ストアに無い場合は要約を使う)
+    """
+    ref = log_file.get("ref")
+    if log_file.get("raw") and store is not None and ref and store.exists(ref):
+        return "".join(format_line(no, line) for no, line in store.read_lines(ref, 1, log_file.get("lines") or 0))
+    return log_file["digest"]
+
+def render_log_context(log_files: list, config: RunnableConfig) -> list:
+    """
+    ファイルごとの本文 (全行またはテンプレート要約) をログブロックとして返す。
+    合計がトークン予算 (LOG_CONTEXT_TOKEN_BUDGET) を超える場合は、ブロブストアの原文から
+    重要な行を残して層別サンプリングしたブロックと、省略した内容の説明を返す (sampler.py)
+    """
+    session_id = resolve_session_id(config)
+    store = get_blob_store(session_id) if session_id is not None else None
+    log_blocks = "".join(format_file_block(f["name"], read_file_body(f, store)) for f in log_files)
+    budget = context_token_budget()
+    if budget <= 0 or store is None or estimate_text_tokens(log_blocks) <= budget:
+        return [HumanMessage(content=LOG_DIGEST_PROMPT.format(log_blocks=log_blocks))]
+    key = (session_id, tuple(f.get("ref") for f in log_files), budget)
+    cached = _sampled_contexts.get(key)
+    if cached is not None:
+        _sampled_contexts.move_to_end(key)
+        return cached
+    sampled_files = [f for f in log_files if f.get("ref") and store.exists(f["ref"])]
+    # ブロブの無いファイル (ストアに保存していないもの) は要約のまま渡す
+    other_blocks = "".join(
+        format_file_block(f["name"], f["digest"]) for f in log_files if f not in sampled_files
+    )
+    budget -= estimate_text_tokens(other_blocks)
+    if not sampled_files or budget <= 0:
+        return [HumanMessage(content=LOG_DIGEST_PROMPT.format(log_blocks=log_blocks))]
+    sampled = sample_logs([(f["name"], store.path(f["ref"]), f.get("lines") or 0) for f in sampled_files], budget)
+    context = [
+        HumanMessage(content=LOG_DIGEST_PROMPT.format(log_blocks=sampled.blocks + other_blocks)),
+        HumanMessage(content=LOG_SAMPLE_NOTE_PROMPT.format(note=sampled.note())),
+    ]
+    _sampled_contexts[key] = context
+    while len(_sampled_contexts) > SAMPLED_CONTEXT_CACHE_SIZE:
+        _sampled_contexts.popitem(last=False)
+    return context
+
+def drop_sampled_contexts(session_id: str) -> None:
+    """
+    セッション終了時にサンプリング結果を破棄する
+    """
+    for key in [k for k in _sampled_contexts if k[0] == session_id]:
+        del _sampled_contexts[key]
+
+def build_log_context(state: LogAnalysisState, config: RunnableConfig) -> list:
+    """
+    ログの要約 (ファイルごとの本文またはテンプレート要約)、統合タイムライン、異常候補をメッセージとして返す
+    フォローアップ時は、このターンで追加されたファイルの要約だけを渡し、以前のファイルは名前だけを示す
+    (以前のファイルは行インデックスに残っているため、ログ検索ツールで参照できる)
+    """
+    log_files = state.get("log_files") or []
+    if (
+        log_files
+        and find_turn_start(state["messages"]) is not None
+        and followup_compaction_enabled()
+        and get_indexed_files(resolve_session_id(config))
+    ):
+        new_files = state.get("new_log_files") or []
+        new_names = {f["name"] for f in new_files}
+        earlier_names = [f["name"] for f in log_files if f["name"] not in new_names]
+        context = []
+        if earlier_names:
+            context.append(HumanMessage(content=EARLIER_LOG_FILES_PROMPT.format(file_names=", ".join(earlier_names))))
+        if not new_files:
+            return context
+        return (
+            context
+            + render_log_context(new_files, config)
+            + build_timeline_context(state)
+            + build_anomaly_context(state)
+        )
+    if not log_files:
+        return build_timeline_context(state) + build_anomaly_context(state)
+    return (
+        render_log_context(log_files, config)
+        + build_timeline_context(state)
+        + build_anomaly_context(state)
+    )
+
+def build_citation_context(state: LogAnalysisState, config: RunnableConfig) -> list:
+    """
+    直前の分析結果で引用された行だけをブロブストアから読み出し、メッセージとして返す
+    """
+    log_files = state.get("log_files") or []
+    session_id = resolve_session_id(config)
+    analysis = next((m for m in reversed(state["messages"]) if isinstance(m, AIMessage)), None)
+    if not log_files or session_id is None or analysis is None:
+        return []
+    citations = find_citations(str(analysis.content))
+    if not citations:
+        return []
+    slices = render_citation_slices(get_blob_store(session_id), log_files, citations)
+    return [HumanMessage(content=CITATION_SLICES_PROMPT.format(slices=slices))]
+
+def verify_citations(state: LogAnalysisState, config: RunnableConfig) -> Optional[Verdict]:
+    """
+    直前の分析結果の引用を、行インデックス / ブロブストアの原文と機械的に照合する (verifier.py)
+    """
+    log_files = state.get("log_files") or []
+    session_id = resolve_session_id(config)
+    analysis = next((m for m in reversed(state["messages"]) if isinstance(m, AIMessage)), None)
+    if not verifier_enabled() or not log_files or session_id is None or analysis is None:
+        return None
+    lines = CitedLines(session_id, get_blob_store(session_id), log_files)
+    return verify_analysis(str(analysis.content), lines)
+
 def context_node(state: LogAnalysisState):
     """
     ステップ1: システム情報のコンテキストを注入するノード
@@ -76,7 +376,8 @@ def context_node(state: LogAnalysisState):
         for m in messages
     )
     
-    result = {"revision_count": 0}
+    # 前のターンのシャード分析結果はリセットする
+    result = {"revision_count": 0, "shard_findings": None}
     
     if not has_system_info:
         system_info = SystemMessage(content=CONTEXT_AGENT_PROMPT)
@@ -84,16 +385,32 @@ def context_node(state: LogAnalysisState):
         
     return result
 
-def analysis_node(state: LogAnalysisState, config: RunnableConfig):
+def split_tool_rounds(messages: list) -> tuple:
+    """
+    履歴末尾のツール呼び出し (ツール呼び出し付きのAI応答と ToolMessage) を除いたメッセージと、
+    末尾に続いているツール呼び出しの回数を返す
+    """
+    end = len(messages)
+    rounds = 0
+    while end and (isinstance(messages[end - 1], ToolMessage) or getattr(messages[end - 1], "tool_calls", None)):
+        if isinstance(messages[end - 1], AIMessage):
+            rounds += 1
+        end -= 1
+    return messages[:end], rounds
+
+async def analysis_node(state: LogAnalysisState, config: RunnableConfig):
     """
     ステップ2: エラー解析を行うノード
+    セッションに行インデックスがあれば、ログ検索ツールを使って必要な行だけを取得しながら分析する
     """
     messages = state["messages"]
+    turn_messages, tool_rounds = split_tool_rounds(messages)
     
     # プロンプトの選択ロジック
     # 直前のメッセージがユーザーからのもの（かつ、履歴に既にAIの応答がある）場合はフォローアップとみなす
-    last_message = messages[-1]
-    has_ai_history = any(isinstance(m, AIMessage) for m in messages)
+    # (ツール呼び出しの途中であれば、その呼び出しを始める前のメッセージで判断する)
+    last_message = turn_messages[-1]
+    has_ai_history = any(isinstance(m, AIMessage) for m in turn_messages)
     
     if isinstance(last_message, HumanMessage) and has_ai_history:
         # ユーザーからのフォローアップ入力
@@ -102,43 +419,120 @@ def analysis_node(state: LogAnalysisState, config: RunnableConfig):
         # 初回分析、またはCritiqueからのフィードバックループ
         prompt_content = ANALYSIS_AGENT_PROMPT
     
+    # ツール呼び出しの上限に達した場合は、ツールを呼び出せないようにして分析結果を出力させる
+    # (定義は外さずに tool_choice="none" にし、プロンプトの先頭部分を変えない)
+    use_tools = bool(get_indexed_files(resolve_session_id(config))) and tool_rounds < log_tool_max_rounds()
+    if use_tools:
+        prompt_content += LOG_TOOLS_PROMPT
+
     # 解析エージェントへの指示を追加
     instruction = HumanMessage(content=prompt_content)
     
-    # LLMを実行 (これまでの履歴 + 今回の指示)
-    response = model.invoke(messages + [instruction], config=config)
+    # LLMを実行 (ログの要約と統合タイムライン + これまでの履歴 + 今回の指示)
+    # フォローアップ時は、前回までの履歴を最終レポートに畳み込み、ログも追加分だけを渡す
+    response = await cached_ainvoke(
+        bind_log_tools(get_node_model("analysis_agent"), config, allow_calls=use_tools),
+        build_prompt(state, config, [instruction]), config, "analysis_agent", llm_pool
+    )
     
     # AIの応答（解析結果）を返す
     return {"messages": [response]}
 
-def critique_node(state: LogAnalysisState, config: RunnableConfig):
+async def shard_analysis_node(payload: dict, config: RunnableConfig):
+    """
+    ステップ2 (シャードモード / Map): 1つのシャードだけを分析するノード
+    Send で並列に起動され、payload にはシャード1件分の情報が入る。
+    """
+    shard = payload["shard"]
+    shard_label = describe_shard(shard)
+    try:
+        log_text = await asyncio.to_thread(read_shard, shard)
+    except Exception as e:
+        return {"shard_findings": [f"### {shard_label}\n(読み込みエラー: {str(e)})"]}
+
+    messages = [
+        SystemMessage(content=CONTEXT_AGENT_PROMPT),
+        HumanMessage(content=SHARD_ANALYSIS_PROMPT.format(shard_label=shard_label, log_text=log_text)),
+    ]
+    # シャード分析の同時実行数を制限する (全セッション共通。プロバイダー全体の上限は llm_pool が管理)
+    async with get_named_semaphore("shard_agent", shard_max_concurrency()):
+        response = await cached_ainvoke(get_node_model("shard_agent"), messages, config, "shard_agent", llm_pool)
+
+    return {"shard_findings": [f"### {shard_label}\n{response.content}"]}
+
+async def reduce_node(state: LogAnalysisState, config: RunnableConfig):
+    """
+    ステップ2 (シャードモード / Reduce): シャードごとの分析結果を統合するノード
+    """
+    findings = state.get("shard_findings") or []
+
+    instruction = HumanMessage(content=REDUCE_AGENT_PROMPT.format(
+        shard_count=len(findings), findings="\n\n".join(findings)
+    ))
+
+    # LLMを実行 (ログの要約と統合タイムライン + これまでの履歴 + 部分分析結果)
+    response = await cached_ainvoke(
+        bind_log_tools(get_node_model("reduce_agent"), config, allow_calls=False),
+        build_prompt(state, config, [instruction]), config, "reduce_agent", llm_pool
+    )
+
+    # シャード計画は使い終わったのでクリアする (次のターンで再実行されないように)
+    return {"messages": [response], "shards": []}
+
+async def critique_node(state: LogAnalysisState, config: RunnableConfig):
     """
     ステップ2.5: 分析結果を批評するノード（新規追加）
     """
     messages = state["messages"]
     
+    # 反復回数をインクリメント
+    current_count = state.get("revision_count", 0)
+    
+    # 引用を機械的に検証し、十分に引用された分析はLLMを呼ばずに承認する
+    # (判定はLLMの応答と同じようにストリーミング表示する)
+    verdict = await asyncio.to_thread(verify_citations, state, config)
+    if verdict is not None and verdict.status == "approve":
+        response = await ReplayChatModel(text=verdict.approval_message()).ainvoke(messages[-1:], config=config)
+        return {"messages": [response], "revision_count": current_count + 1}
+    
     # 批評エージェントへの指示
     instruction = HumanMessage(content=CRITIC_AGENT_PROMPT)
     
-    # LLMを実行
-    response = model.invoke(messages + [instruction], config=config)
-    
-    # 反復回数をインクリメント
-    current_count = state.get("revision_count", 0)
+    # LLMを実行 (引用箇所の原文と、機械的な検証で見つかった問題を渡す)
+    # 共通の先頭部分を使う場合は、分析と同じログの要約を先頭に置いてプロンプトキャッシュに乗せる。
+    # 使わない場合は、ログ全体ではなく統合タイムラインだけを渡す
+    shared_prefix = shared_prefix_enabled()
+    citation_context = await asyncio.to_thread(build_citation_context, state, config)
+    if not shared_prefix:
+        citation_context += build_timeline_context(state)
+    if verdict is not None:
+        citation_context.append(HumanMessage(content=CITATION_CHECK_PROMPT.format(report=verdict.report())))
+    # ログの要約を先頭に置く場合は、ツールの定義も分析と揃える (呼び出しはさせない)
+    critique_model = get_node_model("critique_node")
+    response = await cached_ainvoke(
+        bind_log_tools(critique_model, config, allow_calls=False) if shared_prefix else critique_model,
+        build_prompt(state, config, citation_context + [instruction], include_logs=shared_prefix),
+        config, "critique_node", llm_pool
+    )
     
     return {"messages": [response], "revision_count": current_count + 1}
 
-def summary_node(state: LogAnalysisState, config: RunnableConfig):
+async def summary_node(state: LogAnalysisState, config: RunnableConfig):
     """
     ステップ3: 最終レポートを作成するノード
     """
-    messages = state["messages"]
-    
     # 要約エージェントへの指示を追加
     instruction = HumanMessage(content=SUMMARY_AGENT_PROMPT)
     
-    # LLMを実行 (これまでの履歴 + 今回の指示)
-    response = model.invoke(messages + [instruction], config=config)
+    # LLMを実行 (これまでの履歴 + 今回の指示。フォローアップ時は前回までを最終レポートに畳み込む)
+    # 共通の先頭部分を使う場合は、分析・批評と同じログの要約を先頭に置いてプロンプトキャッシュに乗せる
+    shared_prefix = shared_prefix_enabled()
+    summary_model = get_node_model("summary_agent")
+    response = await cached_ainvoke(
+        bind_log_tools(summary_model, config, allow_calls=False) if shared_prefix else summary_model,
+        build_prompt(state, config, [instruction], include_logs=shared_prefix),
+        config, "summary_agent", llm_pool
+    )
     
     # AIの応答（レポート）を返す
     return {"messages": [response]}
@@ -147,9 +541,27 @@ def summary_node(state: LogAnalysisState, config: RunnableConfig):
 # 4. 条件付きエッジのロジック
 # ==========================================
 
-def should_continue(state: LogAnalysisState) -> Literal["analysis_agent", "summary_agent"]:
+def route_analysis(state: LogAnalysisState):
+    """
+    シャード計画があれば各シャードへ並列に分岐 (Send)、無ければ通常の分析ノードへ進む
+    """
+    shards = state.get("shards") or []
+    if not shards:
+        return "analysis_agent"
+    return [Send("shard_agent", {"shard": shard}) for shard in shards]
+
+def route_tools(state: LogAnalysisState) -> Literal["log_tools", "critique_node"]:
+    """
+    Analysis Agent がツールを呼び出した場合はツールノードへ、そうでなければ批評へ進む
+    """
+    if getattr(state["messages"][-1], "tool_calls", None):
+        return "log_tools"
+    return "critique_node"
+
+def should_continue(state: LogAnalysisState) -> Literal["analysis_agent", "reduce_agent", "summary_agent"]:
     """
     Critiqueの結果を見て、修正が必要か（analysisに戻るか）、完了か（summaryに進むか）を判断する
+    シャードモードの場合は、全シャードを再分析せずに reduce から修正する
     """
     messages = state["messages"]
     last_message = messages[-1]
@@ -166,6 +578,8 @@ def should_continue(state: LogAnalysisState) -> Literal["analysis_agent", "summa
     else:
         # REJECTの場合は再分析へ
         # 批評家のコメントが履歴に残っている状態でAnalysisに戻るので、LLMはそれを考慮して修正できる
+        if state.get("shard_findings"):
+            return "reduce_agent"
         return "analysis_agent"
 
 # ==========================================
@@ -178,14 +592,21 @@ workflow = StateGraph(LogAnalysisState)
 # ノードを追加
 workflow.add_node("context_agent", context_node)
 workflow.add_node("analysis_agent", analysis_node)
+workflow.add_node("log_tools", ToolNode(LOG_TOOLS))
+workflow.add_node("shard_agent", shard_analysis_node)
+workflow.add_node("reduce_agent", reduce_node)
 workflow.add_node("critique_node", critique_node)
 workflow.add_node("summary_agent", summary_node)
 
 # エッジを定義
-# START -> context -> analysis -> critique
+# START -> context -> analysis (<-> log_tools) -> critique
+# (シャードモード: context -> shard x N (並列) -> reduce -> critique)
 workflow.add_edge(START, "context_agent")
-workflow.add_edge("context_agent", "analysis_agent")
-workflow.add_edge("analysis_agent", "critique_node")
+workflow.add_conditional_edges("context_agent", route_analysis, ["analysis_agent", "shard_agent"])
+workflow.add_conditional_edges("analysis_agent", route_tools)
+workflow.add_edge("log_tools", "analysis_agent")
+workflow.add_edge("shard_agent", "reduce_agent")
+workflow.add_edge("reduce_agent", "critique_node")
 
 # 条件付きエッジ: critique -> (check) -> analysis OR summary
 workflow.add_conditional_edges(
@@ -196,7 +617,8 @@ workflow.add_conditional_edges(
 workflow.add_edge("summary_agent", END)
 
 # メモリ（チェックポイント）の設定
-memory = MemorySaver()
+# SQLiteに最新の状態だけを保存し、古いスレッドはTTLと上限数で削除する
+memory = create_checkpointer()
 
 # コンパイル
 app = workflow.compile(checkpointer=memory)
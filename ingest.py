@@ -0,0 +1,664 @@
+# このファイルはアップロードされたログファイルの読み込み（インジェスト）処理を管理します。
+# ファイル全体を readlines() で保持せず、mmap でページ単位に読み出しながら
+# ジェネレータで行番号を付与することで、巨大なアップロードでもメモリ使用量を抑えます。
+# 圧縮ファイルや tar アーカイブ (decompress.py) も展開しながら同じ経路で読み込み、
+# UTF-8 以外の文字コード (Shift_JIS / EUC-JP など) は行単位で判定してデコードします。
+# 一度読み込んだアップロードは解析キャッシュ (ingest_cache.py) に登録し、同じ内容の再アップロードはパースを省きます。
+# 複数ファイルのアップロードは read_log_files_async でファイルごとにプロセスプールへ分配して並列に読み込みます
+# (小さいファイルはいくつかまとめて1つのタスクにし、プロセス間の受け渡しの回数を抑えます)。
+
+import asyncio
+import codecs
+import mmap
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from decompress import iter_log_members, strip_compression_suffix
+from ingest_cache import get_ingest_cache
+from line_index import LineIndex, log_index_enabled
+from anomaly import build_anomaly_report
+from records import RecordCollector, RecordTable, build_incident_timeline
+from reducer import TemplateMiner, reduce_max_templates, reduce_min_lines
+
+# ==========================================
+# 1. 行単位の読み込み
+# ==========================================
+
+def iter_raw_lines(path: str, skip_lines: int = 0) -> Iterator[bytes]:
+    """
+    ファイルを mmap で開き、1行ずつ (改行コード \\r\\n, \\n を除いた) バイト列で返すジェネレータ。
+
+    skip_lines を指定すると、先頭の行はデコードせずに改行の検索だけで読み飛ばします。
+    """
+    with open(path, "rb") as f:
+        # 空ファイルは mmap できないため、何も返さずに終了する
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            for _ in range(skip_lines):
+                pos = mm.find(b"\n", pos) + 1
+                if pos == 0:
+                    return
+            mm.seek(pos)
+            for raw in iter(mm.readline, b""):
+                yield raw.rstrip(b"\r\n")
+
+def iter_lines(path: str, encoding: str = "utf-8", skip_lines: int = 0) -> Iterator[str]:
+    """
+    ファイルを mmap で開き、1行ずつデコードして返すジェネレータ。
+    デコードに失敗した場合は UnicodeDecodeError をそのまま送出します。
+    """
+    for raw in iter_raw_lines(path, skip_lines):
+        yield raw.decode(encoding)
+
+def iter_numbered_lines(path: str, start: int = 1, end: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+    """
+    (行番号, 行の内容) を返すジェネレータ。行番号は1始まり。
+    start / end (両端を含む) を指定すると、その範囲の行だけを返します。
+    """
+    numbered = enumerate(iter_lines(path, skip_lines=start - 1), start=start)
+    if end is None:
+        return numbered
+    return islice(numbered, max(end - start + 1, 0))
+
+def log_encodings() -> List[str]:
+    """
+    アップロードされたログの文字コードの候補 (LOG_ENCODINGS、カンマ区切り、先頭が既定)。
+    """
+    return [e.strip() for e in os.getenv("LOG_ENCODINGS", "utf-8,cp932,euc_jp").split(",") if e.strip()]
+
+class LineDecoder:
+    """
+    行単位で文字コードを判定しながらデコードするデコーダー。
+
+    現在の文字コードでデコードできない行が現れた時点で候補を試し、以降はその文字コードを使い続けます。
+    複数の候補でデコードできる場合は、半角カナ (誤判定の典型) が最も少ないものを選びます。
+    どの候補でもデコードできない行は、置換文字 (U+FFFD) を含めて読み込みます。
+    """
+
+    def __init__(self, encodings: Optional[Sequence[str]] = None):
+        self.encodings = list(encodings or log_encodings())
+        self.encoding = self.encodings[0]
+        self.replaced_lines = 0
+        self._first = True
+
+    def decode(self, raw: bytes) -> str:
+        if self._first:
+            self._first = False
+            if raw.startswith(codecs.BOM_UTF8):
+                raw = raw[len(codecs.BOM_UTF8):]
+        try:
+            return raw.decode(self.encoding)
+        except UnicodeDecodeError:
+            pass
+        candidates = []
+        for encoding in self.encodings:
+            if encoding == self.encoding:
+                continue
+            try:
+                text = raw.decode(encoding)
+            except UnicodeDecodeError:
+                continue
+            candidates.append((sum(1 for c in text if "\uff61" <= c <= "\uff9f"), text, encoding))
+        if not candidates:
+            self.replaced_lines += 1
+            return raw.decode(self.encoding, errors="replace")
+        _, text, self.encoding = min(candidates, key=lambda c: c[0])
+        return text
+
+# render_log_body が sink にまとめて渡す行数
+INGEST_BATCH_LINES = 4096
+
+def format_line(line_no: int, line: str) -> str:
+    """
+    LLMに渡す行番号付きの1行を整形します (例: "0045: ...")。
+    """
+    return f"{line_no:04d}: {line}\n"
+
+# ==========================================
+# 2. ファイルブロックの構築
+# ==========================================
+
+def format_file_block(file_name: str, body: str) -> str:
+    """
+    ファイル名のヘッダーとフッターで本文を囲んだブロックを返します。
+    """
+    return f"\n\n=== ログファイル: {file_name} ===\n{body}\n==========================\n"
+
+def render_log_body(lines: Iterable[Tuple[int, str]], sinks: Sequence = ()) -> Tuple[str, int, str]:
+    """
+    行番号付きの行を本文テキストに変換し、(本文, 行数, テンプレート要約) を返します。
+    本文は行数が閾値 (LOG_REDUCE_MIN_LINES) 以下なら全行をそのまま、超えた場合はテンプレート要約です。
+    全行のバッファは閾値を超えた時点で破棄するため、メモリ使用量は閾値とテンプレート数で抑えられます。
+
+    sinks には add_batch(first_line_no, lines) を持つオブジェクト (パーサー等) を渡すと、同じ1パスの中で
+    INGEST_BATCH_LINES 行ずつまとめて渡されます。行番号は連続している必要があります。
+    """
+    min_lines = reduce_min_lines()
+    miner = TemplateMiner()
+    raw_lines = []
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, INGEST_BATCH_LINES))
+        if not batch:
+            break
+        first_line_no = batch[0][0]
+        texts = [line for _, line in batch]
+        miner.add_batch(first_line_no, texts)
+        for sink in sinks:
+            sink.add_batch(first_line_no, texts)
+        if raw_lines is not None:
+            if len(raw_lines) + len(batch) > min_lines:
+                raw_lines = None
+            else:
+                raw_lines.extend(format_line(i, line) for i, line in batch)
+    summary = miner.render(max_templates=reduce_max_templates())
+    if raw_lines is not None:
+        return "".join(raw_lines), miner.total_lines, summary
+    return summary, miner.total_lines, summary
+
+# State の要約の合計の上限を超えたファイルに入れる説明
+OMITTED_DIGEST = "(要約は State の上限を超えたため省略しています。ログ検索ツールで原文を参照してください)\n"
+# 原文より大きい要約を切り詰めたときに末尾に付ける説明
+TRUNCATED_DIGEST = "(要約が原文より大きいため、以降を省略しています。ログ検索ツールで原文を参照してください)\n"
+
+def state_digest_max_chars() -> int:
+    """
+    LangGraph の State (チェックポイント) に持たせる要約の合計文字数の上限 (LOG_STATE_DIGEST_MAX_CHARS)。
+    """
+    return int(os.getenv("LOG_STATE_DIGEST_MAX_CHARS", "200000"))
+
+@dataclass
+class IngestedFile:
+    """
+    1ファイル分のインジェスト結果。
+    """
+    name: str
+    body: str
+    records: Optional[RecordTable] = None
+    path: Optional[str] = None
+    line_count: int = 0
+    # ブロブストアに保存した場合の参照 (内容のSHA-256)。path はストア内の本文を指す
+    ref: Optional[str] = None
+    # ツール検索用の行インデックス (ストアに保存した場合のみ。オフセットはストア内の本文に対応する)
+    index: Optional[LineIndex] = None
+    # 読み込み・展開に失敗した場合のエラー (body にも同じ内容を入れてLLMに伝える)
+    error: Optional[str] = None
+    # テンプレート要約 (body が全行の場合も作る。ストアに保存した場合は State にはこちらだけを持たせる)
+    summary: Optional[str] = None
+
+    @property
+    def block(self) -> str:
+        return format_file_block(self.name, self.body)
+
+    @property
+    def raw_body(self) -> bool:
+        """
+        body が要約ではなく全行 (LOG_REDUCE_MIN_LINES 以下のファイル) かどうか。
+        """
+        return self.summary is not None and self.body != self.summary
+
+    def digest_entry(self) -> dict:
+        """
+        LangGraphのStateに持たせる、このファイルの参照と要約。
+        ストアに保存したファイルは全行を State やチェックポイントに含めず、テンプレート要約だけを持たせる
+        (全行を渡すファイルは "raw" を付け、プロンプトを組み立てるときにストアから読み出す)。
+        ただし要約が原文より大きくならないよう、全行を渡すファイルは全行と要約の小さい方を持たせ、
+        それ以外のファイルは要約を原文の大きさで切り詰める。
+        """
+        if self.ref is None or self.summary is None:
+            return {"name": self.name, "ref": self.ref, "lines": self.line_count, "digest": self.body}
+        if self.raw_body:
+            digest = min(self.body, self.summary, key=len)
+        else:
+            digest = truncate_digest(self.summary, self._raw_chars())
+        return {"name": self.name, "ref": self.ref, "lines": self.line_count, "digest": digest, "raw": self.raw_body}
+
+    def _raw_chars(self) -> Optional[int]:
+        """
+        ストアに保存した本文の大きさ (バイト数。文字数の上限の目安に使う)。
+        """
+        try:
+            return os.path.getsize(self.path)
+        except (OSError, TypeError):
+            return None
+
+def truncate_digest(digest: str, max_chars: Optional[int]) -> str:
+    """
+    要約が max_chars を超える場合は、行の区切りで切り詰めて TRUNCATED_DIGEST を付けます。
+    """
+    if max_chars is None or len(digest) <= max(max_chars, len(TRUNCATED_DIGEST)):
+        return digest
+    cut = digest.rfind("\n", 0, max(max_chars - len(TRUNCATED_DIGEST), 0)) + 1
+    return digest[:cut] + TRUNCATED_DIGEST
+
+@dataclass
+class IngestResult:
+    """
+    アップロードされたファイル群のインジェスト結果。
+    """
+    files: List[IngestedFile] = field(default_factory=list)
+    # 同じ名前になったため付け替えた (元の名前, 新しい名前) の一覧
+    renamed: List[Tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def file_names(self) -> List[str]:
+        return [f.name for f in self.files]
+
+    @property
+    def log_contents(self) -> str:
+        return "".join(f.block for f in self.files)
+
+    @property
+    def log_files(self) -> List[dict]:
+        """
+        State に持たせる参照と要約の一覧。要約の合計が LOG_STATE_DIGEST_MAX_CHARS を超えた分は、
+        ストアに本文があるファイルに限り要約を省略する (全行を渡すファイルはストアから読み出し、
+        それ以外はログ検索ツールで参照できる)。
+        """
+        entries = [f.digest_entry() for f in self.files]
+        remaining = state_digest_max_chars()
+        for entry in entries:
+            if entry["ref"] is not None and len(entry["digest"]) > remaining:
+                entry["digest"] = OMITTED_DIGEST
+            remaining -= len(entry["digest"])
+        return entries
+
+    @property
+    def total_lines(self) -> int:
+        return sum(f.line_count for f in self.files)
+
+    @property
+    def failed_files(self) -> List[IngestedFile]:
+        return [f for f in self.files if f.error is not None]
+
+    @property
+    def record_tables(self) -> List[RecordTable]:
+        return [f.records for f in self.files if f.records is not None]
+
+    def merge_record_tables(self, current: Optional[Dict[str, RecordTable]] = None) -> Dict[str, RecordTable]:
+        """
+        セッションのレコード表 (ファイル名 → 表) にこのアップロードの表を反映します。
+        同じ名前のファイルは新しい内容で置き換え、レコードを持たなくなった場合は取り除きます
+        (graph.merge_log_files / line_index.register_indexed_files と同じ扱い。古い表の行番号が引用に混ざらないようにする)。
+        """
+        merged = dict(current or {})
+        for f in self.files:
+            if f.records is not None:
+                merged[f.name] = f.records
+            else:
+                merged.pop(f.name, None)
+        return merged
+
+    def incident_timeline(self) -> str:
+        """
+        パース済みレコードからファイル横断の統合インシデントタイムラインを作成します。
+        """
+        return build_incident_timeline(self.record_tables)
+
+    def anomaly_report(self) -> str:
+        """
+        パース済みレコードから異常候補 (エラー率の急増・5xxの集中など) のランキングを作成します。
+        """
+        return build_anomaly_report(self.record_tables)
+
+def failed_file(file_name: str, error: str) -> IngestedFile:
+    return IngestedFile(file_name, f"({error})", error=error)
+
+def ingest_file(
+    file_name: str, path: str, store=None, raw_lines: Optional[Iterable[bytes]] = None
+) -> IngestedFile:
+    """
+    1つのログファイルを1パスで読み込み、行番号付きの本文 (または要約) とパース済みレコード表を作成します。
+    文字列の連結はリストに溜めて最後に1回だけ join するため、線形時間で処理されます。
+
+    store (log_store.BlobStore) を渡すと、同じパスの中で本文をストアに書き出し、ref を設定します。
+    その場合は検索ツール用の行インデックスも同じパスで作成します (LOG_INDEX_ENABLED)。
+
+    raw_lines (展開済みの行のバイト列) を渡した場合は path ではなくそちらから読み込みます。
+    """
+    decoder = LineDecoder()
+    from_path = raw_lines is None
+    if from_path:
+        raw_lines = iter_raw_lines(path)
+    collector = RecordCollector(file_name)
+    writer = store.writer() if store is not None else None
+    index = LineIndex(file_name) if writer is not None and log_index_enabled() else None
+    sinks = [s for s in (collector, writer, index) if s is not None]
+    try:
+        lines = enumerate((decoder.decode(raw) for raw in raw_lines), start=1)
+        body, line_count, summary = render_log_body(lines, sinks=sinks)
+    except Exception as e:
+        if writer is not None:
+            writer.abort()
+        return failed_file(file_name, f"読み込みエラー: {str(e)}")
+    if writer is None:
+        # 元のファイルを UTF-8 のまま行番号で読み直せない場合 (圧縮・他の文字コード) は path を持たせない
+        readable = from_path and decoder.encoding == "utf-8" and not decoder.replaced_lines
+        return IngestedFile(file_name, body, collector.table, path if readable else None, line_count)
+    ref = writer.commit()
+    return IngestedFile(file_name, body, collector.table, store.path(ref), line_count, ref, index, summary=summary)
+
+def ingest_settings() -> dict:
+    """
+    インジェスト結果を左右する設定 (解析キャッシュのキーに含める)。
+    """
+    return {
+        "encodings": log_encodings(),
+        "reduce_min_lines": reduce_min_lines(),
+        "reduce_max_templates": reduce_max_templates(),
+        "index": log_index_enabled(),
+    }
+
+def load_cached_upload(file_name: str, path: str, store=None) -> Tuple[Optional[str], Optional[List[IngestedFile]]]:
+    """
+    解析キャッシュのキーと、キャッシュ済みであればそのインジェスト結果を返します。
+    store が無い場合・キャッシュが無効な場合は (None, None) を返します。
+    """
+    cache = get_ingest_cache() if store is not None else None
+    if cache is None:
+        return None, None
+    try:
+        key = cache.key(file_name, path, ingest_settings())
+    except OSError:
+        # 読めないファイルは通常の経路でエラーとして扱う
+        return None, None
+    cached = cache.load(key, store)
+    if cached is None:
+        return key, None
+    return key, [IngestedFile(**member) for member in cached]
+
+def parse_upload(file_name: str, path: str, store=None, cache_key: Optional[str] = None) -> List[IngestedFile]:
+    """
+    アップロードされた1ファイルをパースします。cache_key を渡した場合は結果を解析キャッシュに登録します。
+    """
+    ingested = []
+    try:
+        for member_name, raw_lines in iter_log_members(file_name, path):
+            ingested.append(ingest_file(member_name, path, store, raw_lines))
+    except Exception as e:
+        ingested.append(failed_file(file_name, f"展開エラー: {str(e)}"))
+    # 読み込みエラーのあるアップロードはキャッシュしない
+    cache = get_ingest_cache()
+    if cache_key is not None and cache is not None and ingested and all(f.ref is not None for f in ingested):
+        cache.save(cache_key, ingested, store)
+    return ingested
+
+def ingest_upload(file_name: str, path: str, store=None) -> List[IngestedFile]:
+    """
+    アップロードされた1ファイルを読み込みます。
+    圧縮ファイルは展開しながら、tar アーカイブは含まれるファイルごとに IngestedFile を返します。
+
+    store を渡した場合は解析キャッシュを使い、同じ内容のアップロードはパースせずに
+    キャッシュ済みの要約・レコード表・行インデックスを返します。
+    """
+    key, cached = load_cached_upload(file_name, path, store)
+    if cached is not None:
+        return cached
+    return parse_upload(file_name, path, store, key)
+
+def read_log_files(files: Iterable, store=None) -> IngestResult:
+    """
+    Chainlitのファイル要素 (name, path を持つオブジェクト) の一覧を読み込みます。
+    圧縮ファイル・tar アーカイブは展開したファイル単位の結果になります。
+
+    同期的なファイルI/Oを行うため、イベントループからは cl.make_async 等で
+    ワーカースレッド上で呼び出してください。
+    """
+    return build_ingest_result([(file.name, ingest_upload(file.name, file.path, store)) for file in files])
+
+def _numbered_name(name: str, n: int) -> str:
+    # "app.log" → "app-2.log" (引用の "ファイル名: 行番号" として読める形を保つ)
+    directory, base = os.path.split(name)
+    stem, dot, ext = base.partition(".")
+    return os.path.join(directory, f"{stem}-{n}{dot}{ext}")
+
+def _rename(f: IngestedFile, name: str) -> None:
+    f.name = name
+    if f.index is not None:
+        f.index.file_name = name
+    if f.records is not None:
+        f.records.file_name = name
+
+def build_ingest_result(uploads: List[Tuple[str, List[IngestedFile]]]) -> IngestResult:
+    """
+    アップロードごとのインジェスト結果を1つにまとめます。
+    "app.log.gz" と "app.log" のように展開後の名前が重なる場合は、State と行インデックスで
+    片方が他方を置き換えないよう名前を付け替えます。圧縮ファイルは元のアップロード名 (拡張子付き) に、
+    tar のメンバーはアーカイブ名に、それ以外はファイル名に "app-2.log" のように番号を付けます。
+    展開していないファイルの名前を優先して残します。
+    """
+    files = [(upload_name, f) for upload_name, ingested in uploads for f in ingested]
+    taken = set()
+    renamed = []
+    # 圧縮を外して名前が変わったファイルは後から名前を決める
+    compressed = [upload_name != f.name and strip_compression_suffix(upload_name) == f.name for upload_name, f in files]
+    for pass_compressed in (False, True):
+        for (upload_name, f), is_compressed in zip(files, compressed):
+            if is_compressed != pass_compressed:
+                continue
+            name = f.name
+            if name in taken and is_compressed and upload_name not in taken:
+                name = upload_name
+            n = 2
+            while name in taken:
+                if f.name.startswith(upload_name + "/"):
+                    # tar のメンバーはアーカイブ名の側に番号を付ける ("logs-2.tar/app.log")
+                    name = _numbered_name(upload_name, n) + f.name[len(upload_name):]
+                else:
+                    name = _numbered_name(f.name, n)
+                n += 1
+            taken.add(name)
+            if name != f.name:
+                renamed.append((f.name, name))
+                _rename(f, name)
+    return IngestResult([f for _, f in files], renamed)
+
+# ==========================================
+# 3. 複数ファイルの並列読み込み
+# ==========================================
+
+def ingest_workers() -> int:
+    """
+    並列インジェストのプロセス数 (INGEST_WORKERS、既定: CPU数)。1 の場合はスレッドで順に読み込みます。
+    """
+    return max(int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1))), 1)
+
+def ingest_inline_max_bytes() -> int:
+    """
+    小さいファイルとして扱う上限 (INGEST_INLINE_MAX_MB、既定: 8)。これ以下のファイルはまとめて1つのタスクでプロセスプールに
+    送り (1タスクもこのサイズまで)、合計がこれ以下しか無い場合はプールを使わずにワーカースレッドで読み込みます。
+    """
+    return int(float(os.getenv("INGEST_INLINE_MAX_MB", "8")) * 1024 * 1024)
+
+def ingest_pool_context():
+    """
+    プロセスプールの起動方式。Chainlit (uvicorn) のプロセスはスレッドを持つため fork は使わず、
+    forkserver (使えない環境では spawn) でワーカーを起動する
+    (fork すると、他のスレッドが保持していたロックを子プロセスで獲得できずに止まることがある)。
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def get_ingest_pool() -> Optional[ProcessPoolExecutor]:
+    """
+    全セッションで共有するインジェスト用のプロセスプールを返します (INGEST_WORKERS=1 の場合は None)。
+    """
+    global _pool
+    workers = ingest_workers()
+    if workers <= 1:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=ingest_pool_context())
+        return _pool
+
+def _discard_broken_pool(pool: ProcessPoolExecutor) -> None:
+    # ワーカーが異常終了したプールは使えないため、次の読み込みで作り直す
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def parse_upload_in_worker(
+    file_name: str, path: str, store, cache_key: Optional[str]
+) -> Optional[List[IngestedFile]]:
+    """
+    プロセスプールで実行する parse_upload。結果を解析キャッシュに登録できた場合は None を返し、
+    行インデックスやレコード表を pickle して送り返す代わりに、親プロセスでキャッシュから mmap で読み込ませます。
+    """
+    ingested = parse_upload(file_name, path, store, cache_key)
+    cache = get_ingest_cache()
+    if cache_key is not None and cache is not None and os.path.exists(cache.entry_dir(cache_key)):
+        return None
+    return ingested
+
+def parse_uploads_in_worker(
+    uploads: List[Tuple[str, str, Optional[str]]], store
+) -> List[Optional[List[IngestedFile]]]:
+    """
+    小さいファイルをまとめて1回のタスクで読み込む parse_upload_in_worker (タスクの受け渡しの回数を減らす)。
+    1ファイルの失敗は他のファイルに影響させず、そのファイルだけエラーとして返します。
+    """
+    results: List[Optional[List[IngestedFile]]] = []
+    for file_name, path, cache_key in uploads:
+        try:
+            results.append(parse_upload_in_worker(file_name, path, store, cache_key))
+        except Exception as e:
+            results.append([failed_file(file_name, f"読み込みエラー: {str(e)}")])
+    return results
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def group_small_uploads(sizes: List[Tuple[int, int]], workers: int, max_bytes: int) -> List[List[int]]:
+    """
+    (アップロードの番号, サイズ) の一覧を、1グループが max_bytes 以下で、かつワーカー数以上のグループに
+    なるよう (ファイルが足りる場合) 順にまとめます。
+    """
+    total = sum(size for _, size in sizes)
+    target = max(min(max_bytes, total // max(workers, 1)), 1)
+    groups: List[List[int]] = []
+    group_bytes = 0
+    for i, size in sizes:
+        if not groups or group_bytes + size > target:
+            groups.append([])
+            group_bytes = 0
+        groups[-1].append(i)
+        group_bytes += size
+    return groups
+
+# 進捗の通知先: (読み込み済みのファイル数, 全ファイル数, 今回読み込んだファイル名)
+ProgressCallback = Callable[[int, int, str], Awaitable[None]]
+
+async def read_log_files_async(
+    files: Iterable, store=None, on_progress: Optional[ProgressCallback] = None
+) -> IngestResult:
+    """
+    read_log_files の並列版。解析キャッシュの確認をスレッドで行い、キャッシュに無いファイルのパースを
+    プロセスプールで並列に行います。大きいファイルは1ファイルずつ、INGEST_INLINE_MAX_MB 以下のファイルは
+    いくつかまとめて1つのタスクにします。プールを使わない場合 (INGEST_WORKERS=1、または小さいファイルが
+    合計 INGEST_INLINE_MAX_MB 以下しか無い場合) はワーカースレッドで順に読み込みます。
+    1ファイル読み終わるごとに on_progress を呼び出します。
+    結果はアップロードの順に並べ、1ファイルの失敗 (ワーカーの異常終了を含む) は他のファイルに影響させません。
+    """
+    uploads = [(file.name, file.path) for file in files]
+    total = len(uploads)
+    loop = asyncio.get_running_loop()
+    max_bytes = ingest_inline_max_bytes()
+    sizes = [_file_size(path) for _, path in uploads]
+    small = [(i, size) for i, size in enumerate(sizes) if size <= max_bytes]
+    pool = None
+    if len(small) < total or sum(size for _, size in small) > max_bytes:
+        pool = get_ingest_pool()
+
+    async def read_cached(i: int) -> Tuple[Optional[str], Optional[List[IngestedFile]]]:
+        name, path = uploads[i]
+        return await asyncio.to_thread(load_cached_upload, name, path, store)
+
+    async def finish(i: int, key: Optional[str], ingested: Optional[List[IngestedFile]]) -> List[IngestedFile]:
+        name, path = uploads[i]
+        if ingested is None:
+            _, ingested = await read_cached(i)
+        if ingested is None:
+            # 登録直後に削除された場合などはこのプロセスで読み直す
+            ingested = await asyncio.to_thread(parse_upload, name, path, store, key)
+        return ingested
+
+    def failed(indexes: List[int], e: Exception) -> List[Tuple[int, List[IngestedFile]]]:
+        if isinstance(e, BrokenProcessPool):
+            _discard_broken_pool(pool)
+        return [(i, [failed_file(uploads[i][0], f"読み込みエラー: {str(e) or type(e).__name__}")]) for i in indexes]
+
+    async def read_one(i: int) -> List[Tuple[int, List[IngestedFile]]]:
+        name, path = uploads[i]
+        try:
+            key, cached = await read_cached(i)
+            if cached is not None:
+                return [(i, cached)]
+            ingested = await loop.run_in_executor(pool, parse_upload_in_worker, name, path, store, key)
+            return [(i, await finish(i, key, ingested))]
+        except Exception as e:
+            return failed([i], e)
+
+    async def read_group(indexes: List[int]) -> List[Tuple[int, List[IngestedFile]]]:
+        try:
+            results = []
+            pending = []
+            for i in indexes:
+                key, cached = await read_cached(i)
+                if cached is not None:
+                    results.append((i, cached))
+                else:
+                    pending.append((i, key))
+            if pending:
+                batch = [(uploads[i][0], uploads[i][1], key) for i, key in pending]
+                parsed = await loop.run_in_executor(pool, parse_uploads_in_worker, batch, store)
+                for (i, key), ingested in zip(pending, parsed):
+                    results.append((i, await finish(i, key, ingested)))
+            return results
+        except Exception as e:
+            done_indexes = {i for i, _ in results}
+            return results + failed([i for i in indexes if i not in done_indexes], e)
+
+    # プールを使わない場合は1つずつ読み込む (GIL を取り合うと、順に読むより遅くなるため)
+    inline_lock = asyncio.Lock()
+
+    async def read_inline(i: int) -> List[Tuple[int, List[IngestedFile]]]:
+        name, path = uploads[i]
+        try:
+            async with inline_lock:
+                return [(i, await asyncio.to_thread(ingest_upload, name, path, store))]
+        except Exception as e:
+            return failed([i], e)
+
+    if pool is None:
+        tasks = [read_inline(i) for i in range(total)]
+    else:
+        small_indexes = {i for i, _ in small}
+        tasks = [read_one(i) for i in range(total) if i not in small_indexes]
+        tasks += [read_group(group) for group in group_small_uploads(small, ingest_workers(), max_bytes)]
+
+    results: List[List[IngestedFile]] = [[] for _ in uploads]
+    done = 0
+    for task in asyncio.as_completed(tasks):
+        for i, ingested in await task:
+            results[i] = ingested
+            done += 1
+            if on_progress is not None:
+                await on_progress(done, total, uploads[i][0])
+    return build_ingest_result([(uploads[i][0], ingested) for i, ingested in enumerate(results)])
@@ -0,0 +1,282 @@
+# このファイルはアップロードされたログの解析結果のキャッシュ (解析キャッシュ) を管理します。
+# 同じローテート済みログを複数のセッションにアップロードした場合に毎回パースし直さないよう、
+# アップロードの内容 (SHA-256) とインジェスト設定をキーに、セッションをまたいで
+#   - 正規化済みのログ本文 (ブロブ。セッションのブロブストアへはハードリンクで取り込む)
+#   - 要約 (digest)、パース済みレコード表、検索用の行インデックス
+# をローカルのディレクトリに1回だけ保存します。数値列は8バイト境界に揃えて書き出し、
+# ヒット時は mmap した memoryview をそのまま列として使うため、パースもコピーも行いません。
+# 合計サイズが上限を超えた場合は、最終アクセスの古いエントリから削除します。
+
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from line_index import LineIndex
+from records import RecordTable
+
+# キャッシュの形式を変えた場合は上げる (古いエントリはキーが一致しなくなり、いずれ削除される)
+CACHE_FORMAT = 2
+PACK_MAGIC = b"LKPACK1\n"
+PACK_ALIGN = 8
+
+# ==========================================
+# 1. ファイル操作
+# ==========================================
+
+def link_or_copy(source: str, dest: str) -> None:
+    """
+    source を dest にハードリンクします。別のファイルシステムなどでリンクできない場合はコピーします。
+    ブロブは書き換えないため、リンク先を共有しても問題ありません。
+    """
+    try:
+        os.link(source, dest)
+        return
+    except FileExistsError:
+        return
+    except OSError:
+        pass
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix=".tmp-")
+    os.close(fd)
+    try:
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def hash_file(path: str, salt: bytes = b"", chunk_size: int = 1024 * 1024) -> str:
+    """
+    ファイルの内容 (先頭に salt を付けたもの) の SHA-256 を返します。
+    """
+    digest = hashlib.sha256(salt)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % PACK_ALIGN)
+
+def write_pack(path: str, meta: dict, columns: Dict[str, Sequence]) -> None:
+    """
+    メタ情報 (JSON) と数値列 (array) を1つのファイルに書き出します。
+    形式: マジック + ヘッダー長 (8バイト) + ヘッダー (JSON) + 8バイト境界に揃えた各列の生データ
+    """
+    layout = {}
+    position = 0
+    views = []
+    for name, values in columns.items():
+        view = memoryview(values)
+        layout[name] = [position, view.nbytes, view.format]
+        views.append(view)
+        position += view.nbytes + len(_padding(view.nbytes))
+    header = json.dumps({"meta": meta, "columns": layout}, ensure_ascii=False).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(PACK_MAGIC)
+        f.write(len(header).to_bytes(8, "little"))
+        f.write(header)
+        f.write(_padding(len(PACK_MAGIC) + 8 + len(header)))
+        for view in views:
+            f.write(view)
+            f.write(_padding(view.nbytes))
+
+def read_pack(path: str) -> Tuple[dict, Dict[str, memoryview]]:
+    """
+    write_pack() で書き出したファイルを mmap し、(メタ情報, 列名 -> memoryview) を返します。
+    列はファイルを直接参照するため、読み込み時間は列の大きさにほとんど依存しません。
+    """
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    if view[:len(PACK_MAGIC)] != PACK_MAGIC:
+        raise ValueError(f"解析キャッシュの形式が不正です: {path}")
+    header_start = len(PACK_MAGIC) + 8
+    header_size = int.from_bytes(view[len(PACK_MAGIC):header_start], "little")
+    header = json.loads(bytes(view[header_start:header_start + header_size]).decode("utf-8"))
+    base = header_start + header_size + len(_padding(header_start + header_size))
+    columns = {
+        name: view[base + offset:base + offset + size].cast(fmt)
+        for name, (offset, size, fmt) in header["columns"].items()
+    }
+    return header["meta"], columns
+
+# ==========================================
+# 2. 解析キャッシュ本体
+# ==========================================
+
+class IngestCache:
+    """
+    内容アドレス方式の解析キャッシュ (1アップロード = 1ディレクトリ)。
+    エントリは一時ディレクトリに書いてから名前を変えて確定するため、複数のプロセスから共有できます。
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def key(self, file_name: str, path: str, settings: dict) -> str:
+        """
+        アップロードの内容・ファイル名 (パーサーの判定とアーカイブ内の名前に使われる)・インジェスト設定から
+        キャッシュキーを作ります。
+        """
+        salt = json.dumps(
+            {"format": CACHE_FORMAT, "name": file_name, "settings": settings}, ensure_ascii=False, sort_keys=True
+        ).encode("utf-8")
+        return hash_file(path, salt + b"\0")
+
+    def load(self, key: str, store) -> Optional[List[dict]]:
+        """
+        キャッシュ済みのインジェスト結果を、ingest.IngestedFile の引数の一覧として返します。
+        ブロブは store (log_store.BlobStore) に取り込みます。無い場合・読めない場合は None を返します。
+        """
+        entry = self.entry_dir(key)
+        manifest_path = os.path.join(entry, "manifest.json")
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            members = []
+            for i, member in enumerate(manifest["members"]):
+                meta, columns = read_pack(os.path.join(entry, f"{i}.pack"))
+                name = member["name"]
+                members.append({
+                    "name": name,
+                    "body": member["body"],
+                    "summary": member.get("summary"),
+                    "records": self._restore(RecordTable, name, meta.get("records"), columns, "records."),
+                    "path": store.adopt(member["ref"], os.path.join(entry, f"{i}.log")),
+                    "line_count": member["line_count"],
+                    "ref": member["ref"],
+                    "index": self._restore(LineIndex, name, meta.get("index"), columns, "index."),
+                })
+            # 最終アクセス時刻を更新する (削除の順番に使う)
+            os.utime(manifest_path)
+        except (OSError, ValueError, KeyError):
+            # 未登録、または削除・書き込みと競合した場合はパースし直す
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return members
+
+    @staticmethod
+    def _restore(cls, name: str, meta: Optional[dict], columns: Dict[str, memoryview], prefix: str):
+        if meta is None:
+            return None
+        return cls.from_columns(name, meta, {k[len(prefix):]: v for k, v in columns.items() if k.startswith(prefix)})
+
+    def save(self, key: str, files: Sequence, store) -> None:
+        """
+        インジェスト結果 (ingest.IngestedFile の一覧、全て store に保存済みのもの) をキャッシュに登録します。
+        キャッシュへの書き込みに失敗しても、インジェスト自体は失敗させません。
+        """
+        entry = self.entry_dir(key)
+        if os.path.exists(entry):
+            return
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix=".tmp-")
+        except OSError:
+            return
+        try:
+            members = []
+            for i, f in enumerate(files):
+                link_or_copy(store.path(f.ref), os.path.join(tmp_dir, f"{i}.log"))
+                meta, columns = {}, {}
+                for prefix, part in (("records", f.records), ("index", f.index)):
+                    if part is None:
+                        continue
+                    meta[prefix], part_columns = part.to_columns()
+                    columns.update({f"{prefix}.{k}": v for k, v in part_columns.items()})
+                write_pack(os.path.join(tmp_dir, f"{i}.pack"), meta, columns)
+                members.append({
+                    "name": f.name, "body": f.body, "summary": f.summary, "line_count": f.line_count, "ref": f.ref
+                })
+            size = sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir))
+            with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as out:
+                json.dump({"members": members, "size": size, "created_at": time.time()}, out, ensure_ascii=False)
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # 同じキーを別のセッションが先に登録した場合も含め、一時ディレクトリは破棄する
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        try:
+            self.evict()
+        except OSError:
+            pass
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        """
+        (最終アクセス時刻, サイズ, ディレクトリ) の一覧。
+        """
+        entries = []
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if shard.startswith(".") or not os.path.isdir(shard_dir):
+                continue
+            for key in os.listdir(shard_dir):
+                if key.startswith("."):
+                    continue
+                manifest_path = os.path.join(shard_dir, key, "manifest.json")
+                try:
+                    with open(manifest_path, encoding="utf-8") as f:
+                        size = json.load(f)["size"]
+                    entries.append((os.path.getmtime(manifest_path), size, os.path.join(shard_dir, key)))
+                except (OSError, ValueError, KeyError):
+                    continue
+        return entries
+
+    def evict(self) -> None:
+        """
+        合計サイズが上限を超えていれば、最終アクセスの古いエントリから削除します。
+        使用中のセッションはブロブをハードリンク、列を mmap で参照しているため、削除しても影響を受けません。
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def stats(self) -> Dict[str, float]:
+        entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
+
+_cache: Optional[IngestCache] = None
+_cache_lock = threading.Lock()
+
+def get_ingest_cache() -> Optional[IngestCache]:
+    """
+    環境変数に基づいて解析キャッシュを返します。INGEST_CACHE_ENABLED=false の場合は None。
+    """
+    global _cache
+    if os.getenv("INGEST_CACHE_ENABLED", "true").lower() in ("0", "false", "no"):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = IngestCache(
+                root=os.getenv("INGEST_CACHE_DIR", os.path.join(".cache", "ingest_cache")),
+                max_bytes=int(float(os.getenv("INGEST_CACHE_MAX_MB", "1024")) * 1024 * 1024),
+            )
+        return _cache
@@ -0,0 +1,447 @@
+# このファイルはアップロードされたログ行の検索インデックスを管理します。
+# インジェスト時に sink として全行を受け取り、転置インデックス (トークン → 行番号の配列) と
+# 行ごとのバイトオフセットを作成します。分析エージェントはツール (log_tools.py) を通して
+# キーワード検索 (BM25)・正規表現検索・行範囲の取得を必要な分だけ行うため、
+# プロンプトの大きさはアップロード量ではなく関連する行の量で決まります。
+
+import math
+import mmap
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_right
+from collections.abc import Mapping
+from itertools import accumulate
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python 3.10 以前
+    import sre_parse
+
+# 英字 (または日本語) で始まる2文字以上の語と、3〜5桁の数字 (ステータスコード・ポート番号など)。
+# 時刻の "10" "00" のような短い数字や、行ごとに異なる長いID・連番は検索の役に立たず語彙を膨らませるため索引しない
+TOKEN_PATTERN = re.compile(r"(?:[^\W\d]|_)\w+|\b\d{3,5}\b")
+# ASCII だけのテキストでは同じ結果になり、Unicode の文字分類を引かない分だけ速い
+ASCII_TOKEN_PATTERN = re.compile(TOKEN_PATTERN.pattern, re.ASCII)
+
+# BM25 のパラメータ
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# grep の候補行がこの割合を超える場合は、候補を1行ずつ調べずにファイル全体を走査する
+# (多くの行に現れる語なら、先頭から走査してもすぐに limit 件に達する)
+GREP_PREFILTER_MAX_RATIO = 0.01
+
+# 遅延作成でブロブから読み込む行数 (ingest.INGEST_BATCH_LINES と同じ)
+TERM_BATCH_LINES = 4096
+
+# 転置インデックスの遅延作成を、同じファイルに対して同時に行わないためのロック
+_build_lock = threading.Lock()
+
+def log_index_enabled() -> bool:
+    """
+    インジェスト時に検索インデックスを作成するかどうか (LOG_INDEX_ENABLED)。
+    """
+    return os.getenv("LOG_INDEX_ENABLED", "true").lower() not in ("0", "false", "no")
+
+def log_index_eager_max_bytes() -> int:
+    """
+    インジェスト時に転置インデックスまで作成するファイルの大きさの上限 (LOG_INDEX_EAGER_MAX_MB, 0で無制限)。
+    語の切り出しはインジェストの所要時間の多くを占めるため、これを超えるファイルは行オフセット表だけを作り、
+    転置インデックスは最初のキーワード検索のときにブロブから作成します。
+    """
+    return int(float(os.getenv("LOG_INDEX_EAGER_MAX_MB", "64")) * 1024 * 1024)
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+def _as_numpy(values: Sequence[int]) -> np.ndarray:
+    # array / memoryview (解析キャッシュの mmap) をコピーせずに NumPy 配列として扱う
+    return np.frombuffer(values, dtype=np.dtype(f"u{values.itemsize}"))
+
+def required_literals(pattern: "re.Pattern[bytes]") -> List[str]:
+    """
+    正規表現に一致する行が必ず含む英単語の断片 (トップレベルで連続するリテラルのうち、英字か _ で始まる2文字以上の
+    \w の並び) を返します。選択 (|) を含むなど判定できない場合は空のリストを返します。
+    TOKEN_PATTERN の語は \w の並びを英字から切り出したものなので、こうした断片を含む行は、
+    断片を部分文字列として含む語の転置リストに必ず現れます。
+    """
+    try:
+        parsed = sre_parse.parse(pattern.pattern.decode("utf-8"), pattern.flags & ~re.DEBUG)
+    except (re.error, UnicodeDecodeError, OverflowError, RecursionError):
+        return []
+    runs: List[str] = []
+    current: List[str] = []
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            current.append(chr(av))
+            continue
+        runs.append("".join(current))
+        current = []
+        if op is sre_parse.BRANCH:
+            return []
+    runs.append("".join(current))
+    literals = []
+    for run in runs:
+        for word in re.findall(r"\w+", run.lower()):
+            if len(word) >= 2 and not word[0].isdigit():
+                literals.append(word)
+    return literals
+
+# ==========================================
+# 1. 行インデックス
+# ==========================================
+
+class PackedPostings(Mapping):
+    """
+    全語の行番号を1本の列に連結した読み取り専用の転置インデックス (解析キャッシュからの復元用)。
+    語ごとの行番号は列のスライス (コピーなし) として返します。
+    """
+
+    def __init__(self, terms: List[str], bounds: Sequence[int], rows: Sequence[int]):
+        self._terms = {term: i for i, term in enumerate(terms)}
+        self._bounds = bounds
+        self._rows = rows
+
+    def __getitem__(self, term: str) -> Sequence[int]:
+        i = self._terms[term]
+        return self._rows[self._bounds[i]:self._bounds[i + 1]]
+
+    def __contains__(self, term: object) -> bool:
+        return term in self._terms
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._terms)
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+    def __reduce__(self):
+        # プロセス間で受け渡す場合は、通常の辞書と配列にコピーする
+        return dict, ({term: array("I", self[term]) for term in self._terms},)
+
+class LineIndex:
+    """
+    1ファイル分の転置インデックスと行オフセット表。
+
+    オフセットはブロブストアに保存される正規化済みテキスト (UTF-8, 改行は \\n) 上の位置で、
+    log_store.BlobWriter と同じ行を受け取ることを前提にしています。
+    LOG_INDEX_EAGER_MAX_MB を超えた時点で転置インデックスを破棄してオフセット表だけを作り続け
+    (terms_indexed が False)、転置インデックスは ensure_terms() でブロブから作成します。
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.terms_indexed = True
+        self.eager_max_bytes = log_index_eager_max_bytes()
+        self.postings: Dict[str, array] = {}
+        # 行ごとの異なり語数 (BM25の文書長) と先頭バイト位置。添字は 行番号 - 1
+        self.lengths = array("H")
+        self.offsets = array("Q")
+        self._offset = 0
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def to_columns(self) -> Tuple[dict, Dict[str, array]]:
+        """
+        解析キャッシュに保存する (メタ情報, 数値列) を返します。転置インデックスは語順に連結します。
+        """
+        terms = list(self.postings)
+        bounds = array("Q", [0])
+        rows = array("I")
+        for term in terms:
+            rows.extend(self.postings[term])
+            bounds.append(len(rows))
+        meta = {
+            "terms": terms, "end_offset": self._offset, "total_length": self._total_length,
+            "terms_indexed": self.terms_indexed,
+        }
+        return meta, {"offsets": self.offsets, "lengths": self.lengths, "bounds": bounds, "rows": rows}
+
+    @classmethod
+    def from_columns(cls, file_name: str, meta: dict, columns: Dict[str, Sequence]) -> "LineIndex":
+        """
+        to_columns() で保存した列から行インデックスを復元します (検索・読み出し専用)。
+        """
+        index = cls(file_name)
+        index.terms_indexed = meta.get("terms_indexed", True)
+        index.postings = PackedPostings(meta["terms"], columns["bounds"], columns["rows"])
+        index.offsets = columns["offsets"]
+        index.lengths = columns["lengths"]
+        index._offset = meta["end_offset"]
+        index._total_length = meta["total_length"]
+        return index
+
+    def __getstate__(self) -> dict:
+        # mmap した列 (memoryview) はプロセス間で受け渡せないため、配列にコピーする
+        return {
+            k: array(v.format, v.tobytes()) if isinstance(v, memoryview) else v
+            for k, v in self.__dict__.items() if k != "_vocab"
+        }
+
+    def add(self, line_no: int, line: str) -> None:
+        self.add_batch(line_no, [line])
+
+    def add_batch(self, first_line_no: int, lines: Sequence[str]) -> None:
+        """
+        連続する行番号の行 (first_line_no から始まる) をまとめて索引します。
+        小文字化とバイト長の計算はまとめて行い、転置リストへの追加も語ごとに1回にまとめます。
+        """
+        if not lines:
+            return
+        text = "\n".join(lines)
+        ascii_only = text.isascii()
+        if ascii_only:
+            sizes = [len(line) + 1 for line in lines]
+        else:
+            sizes = [len(line.encode("utf-8")) + 1 for line in lines]
+        ends = list(accumulate(sizes, initial=self._offset))
+        self._offset = ends.pop()
+        self.offsets.extend(ends)
+        if not self.terms_indexed:
+            return
+        if 0 < self.eager_max_bytes < self._offset:
+            # 大きなファイルは語の切り出しをインジェストから外し、最初の検索まで遅らせる
+            self.terms_indexed = False
+            self.postings = {}
+            self.lengths = array("H")
+            self._total_length = 0
+            return
+        self._index_terms(first_line_no, text, ascii_only)
+
+    def _index_terms(self, first_line_no: int, text: str, ascii_only: bool) -> None:
+        findall = (ASCII_TOKEN_PATTERN if ascii_only else TOKEN_PATTERN).findall
+        lengths = []
+        pending: Dict[str, List[int]] = {}
+        for line_no, lowered in enumerate(text.lower().split("\n"), first_line_no):
+            terms = set(findall(lowered))
+            lengths.append(min(len(terms), 0xFFFF))
+            for term in terms:
+                rows = pending.get(term)
+                if rows is None:
+                    pending[term] = [line_no]
+                else:
+                    rows.append(line_no)
+        self.lengths.extend(lengths)
+        self._total_length += sum(lengths)
+        postings = self.postings
+        for term, rows in pending.items():
+            existing = postings.get(term)
+            if existing is None:
+                postings[term] = array("I", rows)
+            else:
+                existing.extend(rows)
+
+    def ensure_terms(self, path: str) -> None:
+        """
+        転置インデックスが未作成 (LOG_INDEX_EAGER_MAX_MB を超えたファイル) なら、ブロブ (path) から作成します。
+        """
+        if self.terms_indexed:
+            return
+        with _build_lock:
+            if self.terms_indexed:
+                return
+            self.postings = {}
+            self.lengths = array("H")
+            self._total_length = 0
+            with open(path, "rb") as f:
+                line_no = 1
+                while True:
+                    batch = f.readlines(TERM_BATCH_LINES * 128)
+                    if not batch:
+                        break
+                    text = b"".join(batch).decode("utf-8", errors="replace")
+                    if text.endswith("\n"):
+                        text = text[:-1]
+                    self._index_terms(line_no, text, text.isascii())
+                    line_no += len(batch)
+            self.terms_indexed = True
+
+    def search(self, query: str, limit: int = 20) -> List[Tuple[float, int]]:
+        """
+        BM25 でスコアの高い行を (スコア, 行番号) の降順で返します (同点は行番号の昇順)。
+        半数以上の行に現れる語は、他に語があればスコア計算から除外します (idf がほぼ0のため)。
+        スコアは転置リストの列ごとに NumPy でまとめて計算し、上位 limit 件だけを部分ソートで取り出します。
+        転置インデックスが未作成の場合は空のリストを返します (先に ensure_terms() を呼びます)。
+        """
+        n = len(self.lengths)
+        if not n or limit <= 0:
+            return []
+        terms = sorted(t for t in set(tokenize(query)) if t in self.postings)
+        rare = [t for t in terms if len(self.postings[t]) * 2 <= n]
+        if rare:
+            terms = rare
+        if not terms:
+            return []
+        avg_length = self._total_length / n or 1.0
+        lengths = _as_numpy(self.lengths)
+        all_rows = []
+        all_scores = []
+        for term in terms:
+            rows = _as_numpy(self.postings[term])
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows - 1] / avg_length)
+            all_rows.append(rows)
+            all_scores.append(idf * (BM25_K1 + 1) / (1 + norm))
+        if len(terms) == 1:
+            rows, scores = all_rows[0], all_scores[0]
+        else:
+            # 複数の語に一致する行はスコアを合計する
+            totals = np.bincount(np.concatenate(all_rows), weights=np.concatenate(all_scores), minlength=n + 1)
+            rows = np.flatnonzero(totals)
+            scores = totals[rows]
+        if len(rows) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            rows, scores = rows[top], scores[top]
+        order = np.lexsort((rows, -scores))
+        return [(float(scores[i]), int(rows[i])) for i in order]
+
+    def candidate_lines(self, pattern: "re.Pattern[bytes]") -> Optional[np.ndarray]:
+        """
+        pattern に一致しうる行番号 (昇順) を転置インデックスから絞り込みます。
+        リテラルの断片を持たないパターンや、どの断片も多くの行に現れて絞り込みが効かない場合は
+        None (全行が候補) を返します。転置インデックスが未作成の場合も None です。
+        """
+        if not self.terms_indexed:
+            return None
+        literals = required_literals(pattern)
+        if not literals:
+            return None
+        max_rows = len(self.offsets) * GREP_PREFILTER_MAX_RATIO
+        terms, joined, starts = self._vocabulary()
+        candidates = None
+        for literal in sorted(set(literals), key=len, reverse=True):
+            # 断片を部分文字列として含む語 (語彙を改行で連結した文字列を1回走査して探す)
+            positions = [m.start() for m in re.finditer(re.escape(literal), joined)]
+            found = np.unique(np.searchsorted(starts, positions, side="right") - 1)
+            postings = [self.postings[terms[i]] for i in found.tolist()]
+            if not postings:
+                return np.empty(0, dtype=np.int64)
+            if max(len(rows) for rows in postings) > max_rows:
+                # この断片だけでは候補が多すぎる
+                continue
+            postings = [_as_numpy(rows) for rows in postings]
+            rows = postings[0] if len(postings) == 1 else np.unique(np.concatenate(postings))
+            candidates = rows if candidates is None else np.intersect1d(candidates, rows, assume_unique=True)
+            if not len(candidates):
+                break
+        return candidates
+
+    def _vocabulary(self) -> Tuple[List[str], str, np.ndarray]:
+        """
+        (語の一覧, 語を改行で連結した文字列, 各語の開始位置)。語が増えた場合だけ作り直す。
+        """
+        cached = getattr(self, "_vocab", None)
+        if cached is None or len(cached[0]) != len(self.postings):
+            terms = list(self.postings)
+            joined = "\n".join(terms)
+            starts = np.cumsum([0] + [len(term) + 1 for term in terms[:-1]]) if terms else np.zeros(0, dtype=np.int64)
+            cached = self._vocab = (terms, joined, starts)
+        return cached
+
+    def grep(self, path: str, pattern: "re.Pattern[bytes]", limit: int = 50) -> List[int]:
+        """
+        正規表現に一致する行番号を先頭から最大 limit 件返します (ブロブをmmapで走査)。
+        パターンにリテラルの単語があり、それを含む行が少ない場合は、転置インデックスで絞り込んだ候補行だけを
+        1行ずつ照合します (この場合、複数行にまたがる一致は対象外です)。
+        転置インデックスが未作成の場合は作成せずに全体を走査します (mmap の走査は語の切り出しより十分速い)。
+        """
+        if not os.path.getsize(path):
+            return []
+        candidates = self.candidate_lines(pattern)
+        if candidates is not None and len(candidates) <= len(self.offsets) * GREP_PREFILTER_MAX_RATIO:
+            return self._grep_lines(path, pattern, candidates, limit)
+        matches: List[int] = []
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            while len(matches) < limit:
+                match = pattern.search(mm, pos)
+                if match is None:
+                    break
+                line_no = bisect_right(self.offsets, match.start())
+                matches.append(line_no)
+                # 同じ行の2件目以降は数えない
+                pos = self.offsets[line_no] if line_no < len(self.offsets) else len(mm)
+                if match.end() > pos:
+                    pos = match.end()
+                if pos >= len(mm):
+                    break
+        return matches
+
+    def _grep_lines(self, path: str, pattern: "re.Pattern[bytes]", candidates: np.ndarray, limit: int) -> List[int]:
+        matches: List[int] = []
+        if not len(candidates):
+            return matches
+        n = len(self.offsets)
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line_no in candidates.tolist():
+                start = self.offsets[line_no - 1]
+                # 行末の改行は含めない ($ は endpos で一致する)
+                end = self.offsets[line_no] - 1 if line_no < n else max(self._offset - 1, start)
+                if pattern.search(mm, start, end) is not None:
+                    matches.append(line_no)
+                    if len(matches) >= limit:
+                        break
+        return matches
+
+    def read_lines(self, path: str, line_numbers: Iterable[int]) -> List[Tuple[int, str]]:
+        """
+        オフセット表を使って、指定した行だけをブロブから読み出します。
+        """
+        n = len(self.offsets)
+        result = []
+        with open(path, "rb") as f:
+            for line_no in line_numbers:
+                if not 1 <= line_no <= n:
+                    continue
+                f.seek(self.offsets[line_no - 1])
+                result.append((line_no, f.readline().rstrip(b"\n").decode("utf-8", errors="replace")))
+        return result
+
+    def read_range(self, path: str, start: int, end: int) -> List[Tuple[int, str]]:
+        """
+        start〜end 行目 (両端を含む) をまとめて読み出します。
+        """
+        n = len(self.offsets)
+        start, end = max(start, 1), min(end, n)
+        if start > end:
+            return []
+        with open(path, "rb") as f:
+            f.seek(self.offsets[start - 1])
+            stop = self.offsets[end] if end < n else self._offset
+            data = f.read(stop - self.offsets[start - 1]).decode("utf-8", errors="replace")
+        return list(enumerate(data.split("\n")[:end - start + 1], start=start))
+
+# ==========================================
+# 2. セッション単位の管理
+# ==========================================
+
+# session_id -> {ファイル名: ingest.IngestedFile (index と records を持つもの)}
+_sessions: Dict[str, Dict[str, object]] = {}
+
+def register_indexed_files(session_id: str, files: Iterable) -> None:
+    """
+    インジェスト済みファイルをセッションに登録し、ツールから検索できるようにします。
+    同じ名前のファイルが再アップロードされた場合は新しいものに置き換えます。
+    """
+    registry = _sessions.setdefault(session_id, {})
+    for f in files:
+        if getattr(f, "index", None) is not None and f.path is not None:
+            registry[f.name] = f
+
+def get_indexed_files(session_id: Optional[str]) -> Dict[str, object]:
+    if session_id is None:
+        return {}
+    return _sessions.get(session_id, {})
+
+def drop_line_indexes(session_id: str) -> None:
+    """
+    セッション終了時にインデックスを破棄します。
+    """
+    _sessions.pop(session_id, None)
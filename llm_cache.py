@@ -0,0 +1,266 @@
+# このファイルはLLM応答のディスクキャッシュを管理します。
+# 同じログの再アップロードやUI再接続後の再実行で、分析 → 批評 → 要約 の呼び出しを繰り返さないよう、
+# 「ノード名 + 正規化したメッセージ履歴 (指示プロンプトを含む) + モデル設定」のハッシュをキーに
+# 応答をSQLiteへ保存します。キャッシュヒット時も ReplayChatModel を通して応答をストリーミングするため、
+# run_analysis_graph 側の表示は通常の呼び出しと変わりません。
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableConfig
+
+# ==========================================
+# 1. キャッシュキー
+# ==========================================
+
+def normalize_messages(messages: List[BaseMessage]) -> List[list]:
+    """
+    メッセージID等の揮発的な情報を除き、(種類, 内容, ツール呼び出し) だけに正規化します。
+    """
+    normalized = []
+    for m in messages:
+        content = m.content if isinstance(m.content, str) else json.dumps(m.content, ensure_ascii=False, sort_keys=True)
+        tool_calls = [
+            [c.get("name"), json.dumps(c.get("args"), ensure_ascii=False, sort_keys=True)]
+            for c in (getattr(m, "tool_calls", None) or [])
+        ]
+        normalized.append([m.type, content.strip(), tool_calls])
+    return normalized
+
+# キャッシュキーに含めないモデル設定 (認証情報と、応答に影響しない接続設定)。
+# max_tokens などそれ以外の設定はすべてキーに含める (出力の上限が違う呼び出しで、切り詰められた応答を再生しない)
+SIGNATURE_EXCLUDED_PARAMS = frozenset({
+    "api_key", "openai_api_key", "azure_openai_api_key", "azure_ad_token", "azure_ad_token_provider",
+    "azure_ad_async_token_provider", "default_headers", "default_query", "http_client", "http_async_client",
+})
+
+def model_signature(model: Any) -> Dict[str, str]:
+    """
+    キャッシュキーに含めるモデル設定 (クラス名、モデル名/デプロイ名、温度など)。
+    bind_tools したモデルは、元のモデルの設定にツール名 (と tool_choice) を加えます。
+    """
+    bound = getattr(model, "bound", None)
+    if bound is not None:
+        signature = model_signature(bound)
+        kwargs = getattr(model, "kwargs", None) or {}
+        tools = kwargs.get("tools") or []
+        signature["tools"] = ",".join(str((t.get("function") or t).get("name")) for t in tools)
+        if kwargs.get("tool_choice") is not None:
+            signature["tool_choice"] = json.dumps(kwargs["tool_choice"], sort_keys=True)
+        return signature
+    params = getattr(model, "_identifying_params", None) or {}
+    signature = {"class": type(model).__name__}
+    for key, value in params.items():
+        if key.lower() in SIGNATURE_EXCLUDED_PARAMS:
+            continue
+        signature[key] = str(value)
+    return signature
+
+def make_cache_key(node: str, messages: List[BaseMessage], model: Any) -> str:
+    payload = json.dumps(
+        {"node": node, "messages": normalize_messages(messages), "model": model_signature(model)},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# ==========================================
+# 2. SQLite キャッシュ本体
+# ==========================================
+
+class ResponseCache:
+    """
+    サイズ上限とTTLで古いエントリを削除する、SQLiteベースの応答キャッシュ。
+    ノードは実行スレッドが異なるため、接続はロックで保護して共有します。
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl_sec: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                node TEXT NOT NULL,
+                content TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_sec:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, node: str, content: str) -> None:
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, node, content, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, node, content, size, now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float) -> None:
+        """
+        TTL切れのエントリを削除し、合計サイズが上限を超えていれば最終アクセスの古い順に削除します。
+        """
+        self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_sec,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        victims = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": total,
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """
+    環境変数に基づいてキャッシュを返します。LLM_CACHE_ENABLED=false の場合は None。
+    """
+    global _cache
+    if os.getenv("LLM_CACHE_ENABLED", "true").lower() in ("0", "false", "no"):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                path=os.getenv("LLM_CACHE_PATH", os.path.join(".cache", "llm_cache.sqlite")),
+                max_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "256")) * 1024 * 1024),
+                ttl_sec=float(os.getenv("LLM_CACHE_TTL_SEC", str(24 * 3600))),
+            )
+        return _cache
+
+# ==========================================
+# 3. キャッシュ応答の再生 (ストリーミング)
+# ==========================================
+
+# ReplayChatModel の実行に付けるタグ (metrics.py はこのタグの付いた実行をトークンを送信しない呼び出しとして数える)
+REPLAY_TAG = "llm_replay"
+
+class ReplayChatModel(BaseChatModel):
+    """
+    保存済みのテキストを、通常のチャットモデルと同じコールバック (on_chat_model_stream) で
+    チャンクに分けて返すモデル。キャッシュヒット時にUIのストリーミング表示を維持するために使います。
+    """
+    text: str
+    chunk_size: int = 24
+    tags: Optional[List[str]] = [REPLAY_TAG]
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.text))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        for i in range(0, len(self.text), self.chunk_size):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=self.text[i:i + self.chunk_size]))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+async def cached_ainvoke(
+    model: Any, messages: List[BaseMessage], config: RunnableConfig, node: str, pool: Any = None
+) -> BaseMessage:
+    """
+    キャッシュを確認してから model.ainvoke を呼び出します。
+    pool (llm_pool.LLMPool) を渡した場合は、そのレート制御を通して呼び出します。
+    ツール呼び出しを含む応答や空の応答はキャッシュしません。
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return await _ainvoke(model, messages, config, pool)
+
+    key = make_cache_key(node, messages, model)
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        return await ReplayChatModel(text=cached).ainvoke(messages, config=config)
+
+    response = await _ainvoke(model, messages, config, pool)
+    if isinstance(response.content, str) and response.content and not getattr(response, "tool_calls", None):
+        await asyncio.to_thread(cache.put, key, node, response.content)
+    return response
+
+async def _ainvoke(model: Any, messages: List[BaseMessage], config: RunnableConfig, pool: Any) -> BaseMessage:
+    if pool is None:
+        return await model.ainvoke(messages, config=config)
+    return await pool.ainvoke(model, messages, config)
@@ -0,0 +1,215 @@
+# このファイルはLLM呼び出しの共有クライアントプールとレート制御を管理します。
+# 多数のChainlitセッションが同時に分析を実行しても 429 (Rate Limit) で失敗しないよう、
+# プロバイダー (openai / azure) ごとに同時実行数とトークン毎分 (TPM) を制限し、
+# 上限に達した呼び出しは待ち行列で待機させます。一時的なエラーはジッター付き指数バックオフで再試行します。
+
+import asyncio
+import os
+import random
+import time
+import weakref
+from typing import Any, Dict, List, Optional
+
+import openai
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import merge_configs
+
+# 再試行の対象とする一時的なエラー
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+# ==========================================
+# 1. トークン数の見積もり
+# ==========================================
+
+def estimate_text_tokens(text: str) -> int:
+    """
+    テキストのトークン数をおおまかに見積もります。
+    日本語は1文字≒1トークン、英数字は4文字≒1トークンとして数えます (tiktoken を使わない簡易計算)。
+    """
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (len(text) - ascii_chars) + ascii_chars // 4
+
+def estimate_tokens(messages: List[BaseMessage]) -> int:
+    """
+    メッセージのトークン数をおおまかに見積もります (estimate_text_tokens + メッセージごとの固定分)。
+    """
+    total = 0
+    for m in messages:
+        text = m.content if isinstance(m.content, str) else str(m.content)
+        total += estimate_text_tokens(text) + 4
+    return total
+
+# ==========================================
+# 2. プロバイダーごとのレート制御
+# ==========================================
+
+class TokenBucket:
+    """
+    トークン毎分 (TPM) の上限を表すトークンバケット。limit が 0 の場合は制限しません。
+    """
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = float(tokens_per_minute)
+        self.available = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        if self.capacity <= 0:
+            return
+        # 1回の要求が上限を超える場合でも、バケットが満杯になれば通す
+        tokens = min(float(tokens), self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(
+                    self.capacity, self.available + (now - self.updated_at) * self.capacity / 60.0
+                )
+                self.updated_at = now
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                await asyncio.sleep((tokens - self.available) * 60.0 / self.capacity)
+
+class ProviderLimiter:
+    """
+    1プロバイダー分の同時実行数 (セマフォ) と TPM (トークンバケット)。
+    """
+
+    def __init__(self, max_concurrency: int, tokens_per_minute: int):
+        self.semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+        self.bucket = TokenBucket(tokens_per_minute)
+        self.waiting = 0
+
+def _provider_setting(provider: str, name: str, default: str) -> str:
+    """
+    プロバイダー別の設定 (例: AZURE_LLM_MAX_CONCURRENCY) があれば優先し、無ければ共通設定を使います。
+    """
+    return os.getenv(f"{provider.upper()}_{name}", os.getenv(name, default))
+
+class StreamStartWatcher(BaseCallbackHandler):
+    """
+    ストリーミングで最初のチャンクを受け取ったかどうかを記録するコールバック。
+    チャンクは既にUIへ送られているため、その後のエラーを最初から再試行すると本文が重複して表示されます。
+    """
+    run_inline = True
+
+    def __init__(self):
+        self.started = False
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.started = True
+
+# ==========================================
+# 3. 共有プール
+# ==========================================
+
+class LLMPool:
+    """
+    プロバイダー単位で共有される呼び出しプール。
+    モデルインスタンス (内部のHTTP接続プール) は graph.py で1つだけ作成して使い回し、
+    ここでは呼び出しの待ち行列・レート制御・再試行だけを担当します。
+    """
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.max_concurrency = int(_provider_setting(provider, "LLM_MAX_CONCURRENCY", "8"))
+        self.tokens_per_minute = int(_provider_setting(provider, "LLM_TPM_LIMIT", "0"))
+        self.max_retries = int(_provider_setting(provider, "LLM_MAX_RETRIES", "5"))
+        self.retry_base_sec = float(_provider_setting(provider, "LLM_RETRY_BASE_SEC", "1.0"))
+        self.retry_max_sec = float(_provider_setting(provider, "LLM_RETRY_MAX_SEC", "30"))
+        # asyncio のプリミティブはイベントループごとに作成する (CLI等で別ループから使われる場合に備える)
+        self._limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, ProviderLimiter]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def _limiter(self) -> ProviderLimiter:
+        loop = asyncio.get_running_loop()
+        limiter = self._limiters.get(loop)
+        if limiter is None:
+            limiter = ProviderLimiter(self.max_concurrency, self.tokens_per_minute)
+            self._limiters[loop] = limiter
+        return limiter
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        """
+        Retry-After ヘッダーがあればそれに従い、無ければフルジッター付きの指数バックオフ。
+        """
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.retry_max_sec) + random.uniform(0, self.retry_base_sec)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.retry_max_sec, self.retry_base_sec * (2 ** attempt)))
+
+    async def ainvoke(self, model: Any, messages: List[BaseMessage], config: Optional[RunnableConfig] = None):
+        """
+        同時実行数とTPMの枠が空くまで待機してから model.ainvoke を呼び出します。
+        再試行するのは最初のチャンクを受け取る前のエラーだけで、ストリーミングの途中で失敗した場合はそのまま送出します。
+        """
+        limiter = self._limiter()
+        tokens = estimate_tokens(messages)
+        attempt = 0
+        while True:
+            limiter.waiting += 1
+            try:
+                await limiter.semaphore.acquire()
+            finally:
+                limiter.waiting -= 1
+            try:
+                await limiter.bucket.acquire(tokens)
+                watcher = StreamStartWatcher()
+                try:
+                    return await model.ainvoke(messages, config=merge_configs(config, {"callbacks": [watcher]}))
+                except RETRYABLE_ERRORS as e:
+                    if attempt >= self.max_retries or watcher.started:
+                        raise
+                    delay = self._retry_delay(attempt, e)
+            finally:
+                limiter.semaphore.release()
+            # 枠を解放してから待機し、他の呼び出しを先に通す
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def queue_depth(self) -> int:
+        """
+        現在のイベントループで枠の空きを待っている呼び出しの数。
+        """
+        limiter = self._limiters.get(asyncio.get_running_loop())
+        return limiter.waiting if limiter is not None else 0
+
+_pools: Dict[str, LLMPool] = {}
+_named_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+def get_named_semaphore(name: str, size: int) -> asyncio.Semaphore:
+    """
+    現在のイベントループ内で共有される名前付きセマフォ (例: シャード分析の同時実行数) を返します。
+    """
+    semaphores = _named_semaphores.setdefault(asyncio.get_running_loop(), {})
+    semaphore = semaphores.get(name)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(size, 1))
+        semaphores[name] = semaphore
+    return semaphore
+
+def get_llm_pool(provider: Optional[str] = None) -> LLMPool:
+    """
+    プロバイダー (既定は環境変数 LLM_TYPE) に対応する共有プールを返します。
+    """
+    provider = provider or os.getenv("LLM_TYPE", "openai")
+    pool = _pools.get(provider)
+    if pool is None:
+        pool = LLMPool(provider)
+        _pools[provider] = pool
+    return pool
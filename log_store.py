@@ -0,0 +1,202 @@
+# このファイルはアップロードされたログ本文のアウトオブバンド保存 (ブロブストア) を管理します。
+# ログ本文はLangGraphのStateやメッセージ履歴には入れず、セッションごとのディレクトリに
+# 内容のハッシュ (SHA-256) をキーとして保存します。Stateには参照 (ref) と要約 (digest) だけを持たせ、
+# 各ノードは必要な行範囲だけをここから読み出します。
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from ingest import iter_numbered_lines
+from ingest_cache import link_or_copy
+
+# ==========================================
+# 1. ブロブの書き込み
+# ==========================================
+
+class BlobWriter:
+    """
+    インジェスト中の行を受け取り、正規化したテキスト (UTF-8, 改行は \\n) を一時ファイルに書き出しながら
+    ハッシュを計算する sink。commit() でハッシュ名のファイルに確定します。
+    """
+
+    def __init__(self, store: "BlobStore"):
+        self.store = store
+        self._hash = hashlib.sha256()
+        fd, self._tmp_path = tempfile.mkstemp(dir=store.root, prefix=".tmp-")
+        self._file = os.fdopen(fd, "wb", buffering=1024 * 1024)
+
+    def add(self, line_no: int, line: str) -> None:
+        self.add_batch(line_no, [line])
+
+    def add_batch(self, first_line_no: int, lines: Sequence[str]) -> None:
+        """
+        連続する行をまとめて1回で符号化し、ハッシュの更新と書き込みも1回で行います。
+        """
+        if not lines:
+            return
+        data = "\n".join(lines).encode("utf-8") + b"\n"
+        self._hash.update(data)
+        self._file.write(data)
+
+    def commit(self) -> str:
+        """
+        書き込みを確定し、ブロブの参照 (SHA-256の16進文字列) を返します。
+        同じ内容のブロブが既にあれば一時ファイルは破棄されます。
+        """
+        self._file.close()
+        ref = self._hash.hexdigest()
+        final_path = self.store.path(ref)
+        if os.path.exists(final_path):
+            os.remove(self._tmp_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(self._tmp_path, final_path)
+        return ref
+
+    def abort(self) -> None:
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+# ==========================================
+# 2. ブロブストア
+# ==========================================
+
+class BlobStore:
+    """
+    内容アドレス方式のログ本文ストア (1セッション = 1ディレクトリ)。
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def writer(self) -> BlobWriter:
+        return BlobWriter(self)
+
+    def path(self, ref: str) -> str:
+        return os.path.join(self.root, ref[:2], ref)
+
+    def exists(self, ref: str) -> bool:
+        return os.path.exists(self.path(ref))
+
+    def adopt(self, ref: str, source: str) -> str:
+        """
+        既存のファイル (解析キャッシュのブロブなど、内容が ref と一致するもの) をストアに取り込み、パスを返します。
+        """
+        path = self.path(ref)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            link_or_copy(source, path)
+        return path
+
+    def read_lines(self, ref: str, start: int, end: int) -> List[Tuple[int, str]]:
+        """
+        ブロブから start〜end 行目 (両端を含む、1始まり) を読み出します。
+        """
+        return list(iter_numbered_lines(self.path(ref), max(start, 1), end))
+
+    def discard(self, ref: str) -> None:
+        """
+        参照されなくなったブロブを削除します (存在しない場合は何もしない)。
+        """
+        try:
+            os.remove(self.path(ref))
+        except FileNotFoundError:
+            pass
+
+    def size_bytes(self) -> int:
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                total += os.path.getsize(os.path.join(dirpath, name))
+        return total
+
+    def delete(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
+
+# ==========================================
+# 3. セッション単位のストア管理
+# ==========================================
+
+_stores: Dict[str, BlobStore] = {}
+
+def log_store_dir() -> str:
+    return os.getenv("LOG_STORE_DIR", os.path.join(tempfile.gettempdir(), "log-kaiseki-store"))
+
+def get_blob_store(session_id: str) -> BlobStore:
+    """
+    セッション (LangGraphの thread_id) に対応するブロブストアを返します。
+    """
+    store = _stores.get(session_id)
+    if store is None:
+        safe_id = re.sub(r"[^\w.-]", "_", str(session_id))
+        store = BlobStore(os.path.join(log_store_dir(), safe_id))
+        _stores[session_id] = store
+    return store
+
+def drop_blob_store(session_id: str) -> None:
+    """
+    セッション終了時にストアを削除します。
+    """
+    store = _stores.pop(session_id, None)
+    if store is not None:
+        store.delete()
+
+# ==========================================
+# 4. 引用箇所の切り出し
+# ==========================================
+
+# [app.log: 0045] / [app.log: 0120-0135] / `db.log: 0045` などの引用
+CITATION_PATTERN = re.compile(r"([\w.\-/]+\.[A-Za-z]\w*)\s*[:：]\s*(\d{1,9})(?:\s*[-〜~]\s*(\d{1,9}))?")
+
+def find_citations(text: str) -> List[Tuple[str, int, int]]:
+    """
+    テキスト中の (ファイル名, 開始行, 終了行) 形式の引用を出現順に返します (重複は除外)。
+    """
+    seen = set()
+    citations = []
+    for match in CITATION_PATTERN.finditer(text):
+        name, start, end = match.group(1), int(match.group(2)), match.group(3)
+        end_line = int(end) if end else start
+        key = (name, start, end_line)
+        if key not in seen:
+            seen.add(key)
+            citations.append(key)
+    return citations
+
+def render_citation_slices(
+    store: BlobStore,
+    log_files: List[dict],
+    citations: List[Tuple[str, int, int]],
+    max_lines_per_citation: int = 20,
+    max_citations: int = 50,
+) -> str:
+    """
+    引用された行範囲の原文をストアから読み出し、検証用のテキストにします。
+    """
+    refs = {f["name"]: f["ref"] for f in log_files if f.get("ref")}
+    blocks = []
+    for name, start, end in citations[:max_citations]:
+        ref = refs.get(name) or refs.get(os.path.basename(name))
+        if ref is None or not store.exists(ref):
+            blocks.append(f"[{name}: {start:04d}] (該当するファイルがありません)")
+            continue
+        lines = store.read_lines(ref, start, min(end, start + max_lines_per_citation - 1))
+        if not lines:
+            blocks.append(f"[{name}: {start:04d}] (行番号が範囲外です)")
+            continue
+        blocks.append("\n".join(f"[{name}: {no:04d}] {line}" for no, line in lines))
+    return "\n".join(blocks)
+
+def resolve_session_id(config: Optional[dict]) -> Optional[str]:
+    """
+    RunnableConfig から thread_id (= セッションID) を取り出します。
+    """
+    if not config:
+        return None
+    return (config.get("configurable") or {}).get("thread_id")
@@ -0,0 +1,127 @@
+# このファイルは分析エージェントが使うログ検索ツールを定義します。
+# ツールは RunnableConfig の thread_id からセッションの行インデックス (line_index.py) を引き、
+# キーワード検索・正規表現検索・行範囲の取得・時間窓の取得の結果を、
+# 引用と同じ "[ファイル名: 行番号] 本文" の形式で返します。
+
+import re
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import tool
+
+from line_index import get_indexed_files
+from log_store import resolve_session_id
+from records import LEVELS, LEVEL_WARNING, format_timestamp, to_epoch, window_join
+
+# 1回のツール呼び出しで返す行数の上限 (プロンプトの肥大化を防ぐ)
+MAX_RESULT_LINES = 200
+# 1行あたりの最大文字数
+MAX_LINE_CHARS = 500
+
+def _format_lines(file_name: str, lines: List[Tuple[int, str]]) -> str:
+    return "\n".join(f"[{file_name}: {no:04d}] {text[:MAX_LINE_CHARS]}" for no, text in lines)
+
+def _select_files(config: RunnableConfig, file_name: Optional[str]) -> Tuple[dict, Optional[str]]:
+    """
+    セッションの検索対象ファイルを返します。該当が無い場合はエラーメッセージを返します。
+    """
+    files = get_indexed_files(resolve_session_id(config))
+    if not files:
+        return {}, "(検索可能なログがありません)"
+    if file_name:
+        f = files.get(file_name)
+        if f is None:
+            return {}, f"(ファイル {file_name} はありません。対象: {', '.join(files)})"
+        return {file_name: f}, None
+    return files, None
+
+@tool
+def search_logs(query: str, config: RunnableConfig, file_name: Optional[str] = None, limit: int = 20) -> str:
+    """アップロードされたログから、キーワード (例: "timeout connection pool") に関連する行をBM25で検索します。file_name を指定するとそのファイルだけを検索します。"""
+    files, error = _select_files(config, file_name)
+    if error:
+        return error
+    limit = max(1, min(limit, MAX_RESULT_LINES))
+    hits = []
+    for name, f in files.items():
+        f.index.ensure_terms(f.path)
+        hits.extend((score, name, line_no) for score, line_no in f.index.search(query, limit))
+    hits = sorted(hits, key=lambda h: -h[0])[:limit]
+    if not hits:
+        return f"(「{query}」に一致する行はありません)"
+    blocks = []
+    for name in files:
+        line_numbers = sorted(line_no for _, hit_name, line_no in hits if hit_name == name)
+        if line_numbers:
+            f = files[name]
+            blocks.append(_format_lines(name, f.index.read_lines(f.path, line_numbers)))
+    return "\n".join(blocks)
+
+@tool
+def grep_logs(
+    pattern: str, config: RunnableConfig, file_name: Optional[str] = None, ignore_case: bool = False, limit: int = 50
+) -> str:
+    """アップロードされたログから、正規表現 (Python の re 構文) に一致する行を先頭から検索します。"""
+    files, error = _select_files(config, file_name)
+    if error:
+        return error
+    try:
+        compiled = re.compile(pattern.encode("utf-8"), re.MULTILINE | (re.IGNORECASE if ignore_case else 0))
+    except re.error as e:
+        return f"(正規表現エラー: {str(e)})"
+    limit = max(1, min(limit, MAX_RESULT_LINES))
+    blocks = []
+    for name, f in files.items():
+        line_numbers = f.index.grep(f.path, compiled, limit)
+        if line_numbers:
+            blocks.append(_format_lines(name, f.index.read_lines(f.path, line_numbers)))
+            limit -= len(line_numbers)
+            if limit <= 0:
+                break
+    return "\n".join(blocks) or f"(/{pattern}/ に一致する行はありません)"
+
+@tool
+def read_log_lines(file_name: str, start_line: int, end_line: int, config: RunnableConfig) -> str:
+    """ログファイルの start_line〜end_line 行目 (両端を含む) の原文を取得します。"""
+    files, error = _select_files(config, file_name)
+    if error:
+        return error
+    f = files[file_name]
+    end_line = min(end_line, start_line + MAX_RESULT_LINES - 1)
+    lines = f.index.read_range(f.path, start_line, end_line)
+    if not lines:
+        return f"(行番号が範囲外です。{file_name} は {len(f.index)} 行です)"
+    return _format_lines(file_name, lines)
+
+@tool
+def read_time_window(
+    start_time: str, end_time: str, config: RunnableConfig, min_level: str = "WARNING"
+) -> str:
+    """全ファイルから、時刻 start_time〜end_time ("YYYY-MM-DD HH:MM:SS" 形式、ログ上の表示時刻) の間に記録されたイベントを時刻順に取得します。min_level でレベルを絞り込みます (DEBUG/INFO/WARNING/ERROR)。"""
+    files, error = _select_files(config, None)
+    if error:
+        return error
+    try:
+        start, end = (
+            to_epoch(*datetime.strptime(t.strip(), "%Y-%m-%d %H:%M:%S").timetuple()[:6])
+            for t in (start_time, end_time)
+        )
+    except ValueError:
+        return "(時刻は YYYY-MM-DD HH:MM:SS 形式で指定してください)"
+    indexed = [f for f in files.values() if f.records is not None]
+    tables = [f.records for f in indexed]
+    events = window_join(tables, start, end, LEVELS.get(min_level.upper(), LEVEL_WARNING))
+    if not events:
+        return f"({start_time} 〜 {end_time} に該当するイベントはありません)"
+    lines = []
+    for ts, table_idx, row in events[:MAX_RESULT_LINES]:
+        f = indexed[table_idx]
+        line_no = f.records.line_starts[row]
+        text = next((t for _, t in f.index.read_lines(f.path, [line_no])), "")
+        lines.append(f"{format_timestamp(ts)} [{f.name}: {line_no:04d}] {text[:MAX_LINE_CHARS]}")
+    if len(events) > MAX_RESULT_LINES:
+        lines.append(f"(他 {len(events) - MAX_RESULT_LINES} 件。時間窓を狭めてください)")
+    return "\n".join(lines)
+
+LOG_TOOLS = [search_logs, grep_logs, read_log_lines, read_time_window]
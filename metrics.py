@@ -0,0 +1,332 @@
+# このファイルはグラフ実行の計測 (メトリクス) を管理します。
+# run_analysis_graph が受け取る astream_events のイベントから、スレッド・ノードごとに
+#   - 所要時間 (壁時計)
+#   - 最初のトークンまでの時間 (TTFT)
+#   - 入力・出力トークン数 (usage_metadata があればその値、無ければ見積もり)
+#   - 入力トークンのうちプロバイダーのプロンプトキャッシュに乗った数 (キャッシュ率)
+#   - レビュー (Critique) の回数
+#   - 応答キャッシュ (llm_cache.py) や検証による自動承認で、LLMに送信せずに返した呼び出しの数 (トークンは数えない)
+#   - UIへのストリーミングで受け取ったチャンク数と、まとめて送信したフレーム数 (ui_stream.py)
+# を記録し、Prometheus のテキスト形式 (ファイル / Chainlit の /metrics) とセッションごとの要約として公開します。
+
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from llm_cache import REPLAY_TAG
+from llm_pool import estimate_tokens
+
+METRIC_PREFIX = "log_kaiseki"
+# 所要時間・TTFT のヒストグラムの区切り (秒)
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# ==========================================
+# 1. 集計 (プロセス全体)
+# ==========================================
+
+class Histogram:
+    """
+    Prometheus のヒストグラム (累積バケット・合計・件数)。
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+class MetricsRegistry:
+    """
+    全セッションの計測値を集計するレジストリ。セッションごとの要約は直近の max_sessions 件だけ保持します。
+    """
+
+    def __init__(self, max_sessions: int = 1000):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self.node_calls: Dict[str, int] = {}
+        self.node_duration: Dict[str, Histogram] = {}
+        self.node_ttft: Dict[str, Histogram] = {}
+        self.input_tokens: Dict[str, int] = {}
+        self.output_tokens: Dict[str, int] = {}
+        self.cached_tokens: Dict[str, int] = {}
+        self.replays: Dict[str, int] = {}
+        self.runs = 0
+        self.run_errors = 0
+        self.run_duration = Histogram()
+        self.revisions = 0
+        self.stream_chunks = 0
+        self.stream_frames = 0
+        self.sessions: "OrderedDict[str, dict]" = OrderedDict()
+
+    def record_run(self, run: "RunRecorder") -> None:
+        with self._lock:
+            for node, stats in run.nodes.items():
+                self.node_calls[node] = self.node_calls.get(node, 0) + stats["calls"]
+                self.input_tokens[node] = self.input_tokens.get(node, 0) + stats["input_tokens"]
+                self.output_tokens[node] = self.output_tokens.get(node, 0) + stats["output_tokens"]
+                self.cached_tokens[node] = self.cached_tokens.get(node, 0) + stats["cached_tokens"]
+                self.replays[node] = self.replays.get(node, 0) + stats["replays"]
+                durations = self.node_duration.setdefault(node, Histogram())
+                for value in stats["durations"]:
+                    durations.observe(value)
+                ttfts = self.node_ttft.setdefault(node, Histogram())
+                for value in stats["ttfts"]:
+                    ttfts.observe(value)
+            self.runs += 1
+            self.run_errors += 1 if run.error else 0
+            self.run_duration.observe(run.duration)
+            self.revisions += run.revisions
+
+            session = self.sessions.pop(run.thread_id, None) or {"runs": 0, "seconds": 0.0, "revisions": 0, "nodes": {}}
+            session["runs"] += 1
+            session["seconds"] += run.duration
+            session["revisions"] += run.revisions
+            for node, stats in run.nodes.items():
+                total = session["nodes"].setdefault(
+                    node,
+                    {
+                        "calls": 0, "seconds": 0.0, "ttft": [], "input_tokens": 0, "output_tokens": 0,
+                        "cached_tokens": 0, "replays": 0,
+                    },
+                )
+                total["calls"] += stats["calls"]
+                total["seconds"] += sum(stats["durations"])
+                total["ttft"].extend(stats["ttfts"])
+                total["input_tokens"] += stats["input_tokens"]
+                total["output_tokens"] += stats["output_tokens"]
+                total["cached_tokens"] += stats["cached_tokens"]
+                total["replays"] += stats["replays"]
+            self.sessions[run.thread_id] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def record_stream(self, chunks: int, frames: int) -> None:
+        with self._lock:
+            self.stream_chunks += chunks
+            self.stream_frames += frames
+
+    def render_prometheus(self) -> str:
+        """
+        Prometheus のテキスト形式 (exposition format) で全メトリクスを返します。
+        """
+        lines: List[str] = []
+
+        def counter(name: str, help_text: str, values: Dict[str, int]) -> None:
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} counter")
+            for node, value in sorted(values.items()):
+                lines.append(f'{METRIC_PREFIX}_{name}{{node="{node}"}} {value}')
+
+        def histogram(name: str, help_text: str, values: Dict[str, Histogram]) -> None:
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} histogram")
+            for label, h in sorted(values.items()):
+                label_text = f'node="{label}",' if label else ""
+                for bound, count in zip(h.buckets, h.counts):
+                    lines.append(f'{METRIC_PREFIX}_{name}_bucket{{{label_text}le="{bound:g}"}} {count}')
+                lines.append(f'{METRIC_PREFIX}_{name}_bucket{{{label_text}le="+Inf"}} {h.count}')
+                suffix = f"{{{label_text.rstrip(',')}}}" if label_text else ""
+                lines.append(f"{METRIC_PREFIX}_{name}_sum{suffix} {h.total:.6f}")
+                lines.append(f"{METRIC_PREFIX}_{name}_count{suffix} {h.count}")
+
+        with self._lock:
+            counter("node_calls_total", "Number of completed node executions.", self.node_calls)
+            histogram("node_duration_seconds", "Wall time of each node execution.", self.node_duration)
+            histogram("node_ttft_seconds", "Time from LLM call start to the first streamed token.", self.node_ttft)
+            counter("llm_input_tokens_total", "LLM input tokens (usage_metadata or estimate).", self.input_tokens)
+            counter("llm_output_tokens_total", "LLM output tokens (usage_metadata or estimate).", self.output_tokens)
+            counter(
+                "llm_cached_input_tokens_total", "LLM input tokens served from the provider prompt cache.",
+                self.cached_tokens,
+            )
+            counter(
+                "llm_replays_total",
+                "LLM calls answered from the response cache or by verifier auto-approval (no tokens sent).",
+                self.replays,
+            )
+            histogram("graph_duration_seconds", "End-to-end wall time of a graph run.", {"": self.run_duration})
+            lines.append(f"# HELP {METRIC_PREFIX}_graph_runs_total Number of graph runs.")
+            lines.append(f"# TYPE {METRIC_PREFIX}_graph_runs_total counter")
+            lines.append(f"{METRIC_PREFIX}_graph_runs_total {self.runs}")
+            lines.append(f"# HELP {METRIC_PREFIX}_graph_errors_total Number of graph runs that raised an error.")
+            lines.append(f"# TYPE {METRIC_PREFIX}_graph_errors_total counter")
+            lines.append(f"{METRIC_PREFIX}_graph_errors_total {self.run_errors}")
+            lines.append(f"# HELP {METRIC_PREFIX}_revisions_total Number of critique reviews.")
+            lines.append(f"# TYPE {METRIC_PREFIX}_revisions_total counter")
+            lines.append(f"{METRIC_PREFIX}_revisions_total {self.revisions}")
+            lines.append(f"# HELP {METRIC_PREFIX}_ui_stream_chunks_total Streamed LLM chunks received for the UI.")
+            lines.append(f"# TYPE {METRIC_PREFIX}_ui_stream_chunks_total counter")
+            lines.append(f"{METRIC_PREFIX}_ui_stream_chunks_total {self.stream_chunks}")
+            lines.append(f"# HELP {METRIC_PREFIX}_ui_stream_frames_total Coalesced stream_token frames sent to the UI.")
+            lines.append(f"# TYPE {METRIC_PREFIX}_ui_stream_frames_total counter")
+            lines.append(f"{METRIC_PREFIX}_ui_stream_frames_total {self.stream_frames}")
+            lines.append(f"# HELP {METRIC_PREFIX}_active_sessions Sessions with a retained summary.")
+            lines.append(f"# TYPE {METRIC_PREFIX}_active_sessions gauge")
+            lines.append(f"{METRIC_PREFIX}_active_sessions {len(self.sessions)}")
+        return "\n".join(lines) + "\n"
+
+    def session_summary(self, thread_id: str) -> str:
+        """
+        セッション (thread_id) ごとの累計を、ノード単位の表で返します。
+        """
+        with self._lock:
+            session = self.sessions.get(thread_id)
+            if session is None:
+                return ""
+            lines = [
+                f"実行 {session['runs']}回 / 合計 {session['seconds']:.1f}秒 / レビュー {session['revisions']}回",
+                "ノード | 回数 | 合計秒 | TTFT中央値 | 入力トークン | 出力トークン | キャッシュ率 | 応答キャッシュ",
+            ]
+            for node, stats in session["nodes"].items():
+                ttft = sorted(stats["ttft"])
+                median = f"{ttft[len(ttft) // 2]:.2f}秒" if ttft else "-"
+                cache_rate = f"{stats['cached_tokens'] / stats['input_tokens']:.0%}" if stats["input_tokens"] else "-"
+                lines.append(
+                    f"{node} | {stats['calls']} | {stats['seconds']:.1f} | {median} | "
+                    f"{stats['input_tokens']} | {stats['output_tokens']} | {cache_rate} | {stats['replays']}"
+                )
+        return "\n".join(lines)
+
+    def drop_session(self, thread_id: str) -> None:
+        with self._lock:
+            self.sessions.pop(thread_id, None)
+
+registry = MetricsRegistry(max_sessions=int(os.getenv("METRICS_MAX_SESSIONS", "1000")))
+
+# METRICS_TOKEN が無い場合に /metrics を取得できる接続元 (同じホストのみ)
+LOCAL_CLIENT_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+def metrics_token() -> Optional[str]:
+    """
+    /metrics の取得に必要なトークン (METRICS_TOKEN)。未設定の場合は None。
+    """
+    return os.getenv("METRICS_TOKEN") or None
+
+def metrics_request_allowed(authorization: Optional[str], client_host: Optional[str]) -> bool:
+    """
+    /metrics へのリクエストを許可するかどうか。
+    METRICS_TOKEN が設定されていれば "Authorization: Bearer <トークン>" が一致する場合のみ、
+    未設定なら同じホスト (ループバック) からの接続のみ許可します。
+    """
+    token = metrics_token()
+    if token is None:
+        return client_host in LOCAL_CLIENT_HOSTS
+    scheme, _, credentials = (authorization or "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip().encode(), token.encode())
+
+def write_metrics_file(path: Optional[str] = None) -> None:
+    """
+    METRICS_FILE が設定されていれば、Prometheus 形式のテキストを書き出します
+    (node_exporter の textfile collector 等で読み込む想定。途中の状態を読まれないよう置き換えで書く)。
+    """
+    path = path or os.getenv("METRICS_FILE")
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(registry.render_prometheus())
+    os.replace(tmp_path, path)
+
+# ==========================================
+# 2. 1回のグラフ実行の計測
+# ==========================================
+
+class RunRecorder:
+    """
+    astream_events (v2) のイベントを observe() に渡し、終了時に finish() を呼び出して使います。
+    track() でイベントストリームを包むと、両方を自動で行います。
+    """
+
+    def __init__(self, thread_id: str):
+        self.thread_id = thread_id
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.revisions = 0
+        self.error: Optional[str] = None
+        self.nodes: Dict[str, dict] = {}
+        # run_id -> (ノード名, 開始時刻)
+        self._node_runs: Dict[str, Tuple[str, float]] = {}
+        # run_id -> [ノード名, 開始時刻, 最初のトークンを受信したか, 入力トークンの見積もり]
+        self._llm_runs: Dict[str, list] = {}
+
+    def _node(self, name: str) -> dict:
+        stats = self.nodes.get(name)
+        if stats is None:
+            stats = self.nodes[name] = {
+                "calls": 0, "durations": [], "ttfts": [], "input_tokens": 0, "output_tokens": 0, "cached_tokens": 0,
+                "replays": 0,
+            }
+        return stats
+
+    def observe(self, event: dict) -> None:
+        kind = event["event"]
+        node = event.get("metadata", {}).get("langgraph_node")
+        if not node:
+            return
+        run_id = event.get("run_id")
+        now = time.perf_counter()
+        if kind == "on_chain_start" and event.get("name") == node:
+            self._node_runs[run_id] = (node, now)
+        elif kind == "on_chain_end" and run_id in self._node_runs:
+            name, started = self._node_runs.pop(run_id)
+            stats = self._node(name)
+            stats["calls"] += 1
+            stats["durations"].append(now - started)
+            if name == "critique_node":
+                self.revisions += 1
+        elif kind == "on_chat_model_start" and REPLAY_TAG in (event.get("tags") or []):
+            # 応答キャッシュの再生・自動承認はLLMに送信していないため、トークン数とTTFTには含めない
+            self._node(node)["replays"] += 1
+        elif kind == "on_chat_model_start":
+            messages = (event.get("data", {}).get("input") or {}).get("messages") or []
+            self._llm_runs[run_id] = [node, now, False, sum(estimate_tokens(m) for m in messages)]
+        elif kind == "on_chat_model_stream" and run_id in self._llm_runs:
+            llm_run = self._llm_runs[run_id]
+            if not llm_run[2]:
+                llm_run[2] = True
+                self._node(llm_run[0])["ttfts"].append(now - llm_run[1])
+        elif kind == "on_chat_model_end" and run_id in self._llm_runs:
+            name, _, _, estimated_input = self._llm_runs.pop(run_id)
+            output = event.get("data", {}).get("output")
+            usage = getattr(output, "usage_metadata", None) or {}
+            stats = self._node(name)
+            stats["input_tokens"] += usage.get("input_tokens") or estimated_input
+            stats["output_tokens"] += usage.get("output_tokens") or (estimate_tokens([output]) if output else 0)
+            # プロンプトキャッシュに乗った入力トークン (OpenAI / Azure は prompt_tokens_details.cached_tokens)
+            stats["cached_tokens"] += (usage.get("input_token_details") or {}).get("cache_read") or 0
+
+    async def track(self, events: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        """
+        イベントストリームをそのまま流しながら計測し、終了時 (例外を含む) に finish() を呼び出します。
+        """
+        try:
+            async for event in events:
+                self.observe(event)
+                yield event
+        except BaseException as e:
+            self.finish(e)
+            raise
+        self.finish()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """
+        計測を終了し、プロセス全体の集計に反映します。
+        """
+        self.duration = time.perf_counter() - self.started
+        self.error = f"{type(error).__name__}: {error}" if error else None
+        registry.record_run(self)
+        try:
+            write_metrics_file()
+        except OSError:
+            # メトリクスファイルの書き込み失敗で分析を失敗させない
+            pass
@@ -69,6 +69,10 @@ ANALYSIS_AGENT_PROMPT = """
 **すべての分析結果には、必ず具体的な「根拠となるログ」を引用してください。**
 引用形式: `[ファイル名: 行番号] ログの内容`
 
+行数の多いログファイルは「テンプレート要約」形式（件数 | 初出行 | 最終行 | テンプレート と、その下のサンプル行）で提供されます。
+`<*>` は可変部分（日時、IP、数値など）です。引用にはサンプル行の行番号、または初出行・最終行を使用し、
+繰り返し発生しているエラーは件数と発生範囲（例: `[app.log: 0120-4580] 982件`）も併記してください。
+
 もし分析に必要な情報が不足している場合や、不明なエラーコードがありユーザーの知識が必要な場合は、
 **推測で埋めずに、ユーザーに対して具体的な質問を行ってください。**
 その場合は、回答形式として「QUESTION_TO_USER: <質問内容>」と明記してください。
@@ -91,6 +95,51 @@ ANALYSIS_AGENT_PROMPT = """
 技術者向けのMarkdown形式で出力してください。具体的なログの引用（ファイル名、行番号）を含めてください。
 """
 
+# シャード分析用プロンプト (Map)
+# 役割: 大規模ログを分割したシャードの1つだけを分析し、部分的な発見事項を報告する
+SHARD_ANALYSIS_PROMPT = """
+あなたはログ分析チームの一員（Shard Analysis Agent）です。
+大規模なログを分割したうちの1区間だけが与えられます。この区間の中で確認できる事実のみを報告してください。
+
+対象区間: {shard_label}
+
+タスク:
+1. この区間内のエラー・警告・異常なパターン（急増、再起動、タイムアウトなど）を列挙する。
+2. 各発見事項には必ず根拠となるログを `[ファイル名: 行番号] ログの内容` の形式で引用する。
+3. 他の区間やファイルとの関連が疑われる場合は、その旨と該当時刻を「要確認」として記載する。
+
+異常が見当たらない場合は「異常なし」とだけ答えてください。推測や一般論は不要です。
+
+--- ログ ({shard_label}) ---
+{log_text}
+"""
+
+# シャード分析結果の統合用プロンプト (Reduce)
+# 役割: 各シャードの部分的な分析結果を統合し、通常の分析エージェントと同じ形式で出力する
+REDUCE_AGENT_PROMPT = """
+あなたは高度なログ分析専門のエージェント（Error Analysis Agent）です。
+ログが大きいため、複数の区間（シャード）に分割して並列に分析しました。以下はその部分的な分析結果です。
+
+これらを統合し、ファイル・区間をまたいだ因果関係（時刻の前後関係）を推論した上で、1つの分析結果にまとめてください。
+批評エージェントからの指摘が履歴にある場合は、それを反映して修正してください。
+
+【重要要件】
+**すべての分析結果には、必ず具体的な「根拠となるログ」を引用してください。**
+引用形式: `[ファイル名: 行番号] ログの内容`（部分分析結果に含まれる引用をそのまま使用してください）
+
+タスク:
+1. **エラーの抽出**: 全区間のエラーを重複を除いてリストアップする。
+2. **コンテキストの特定**: 各エラーがどのような操作または状況で発生したか特定する。
+3. **根本原因の究明**: 区間・ファイルをまたいだ時系列から、技術的な根拠を持って原因を推論する。
+4. **解決策の提示**: 具体的な修正案を提示する。
+
+出力形式:
+技術者向けのMarkdown形式で出力してください。
+
+--- 部分分析結果 ({shard_count}区間) ---
+{findings}
+"""
+
 # フォローアップ分析用プロンプト（ユーザーからの返信があった場合）
 ANALYSIS_FOLLOWUP_PROMPT = """
 あなたはログ分析セッションの途中にいます。
@@ -108,6 +157,89 @@ ANALYSIS_FOLLOWUP_PROMPT = """
 - ログの引用（ファイル名: 行番号）は引き続き必須です。
 """
 
+# フォローアップ時に、前のターンまでの履歴の代わりに渡す直前の最終レポート
+# 役割: セッションが長くなっても、以前の分析結果をコンパクトに参照できるようにする
+PREVIOUS_FINDINGS_PROMPT = """
+【前回までの分析結果（最終レポート）】
+これまでのやり取りで作成した最終レポートです。以前の結論や引用はここを参照してください。
+
+{report}
+"""
+
+# フォローアップ時に、以前のターンでアップロード済みのファイルを示す
+# 役割: 以前のログの要約を毎回送らずに、検索ツールで参照できることを伝える
+EARLIER_LOG_FILES_PROMPT = """
+【以前アップロードされたログファイル】
+{file_names}
+これらのファイルの内容は前回までの分析結果に反映済みです。必要な行はログ検索ツールで取得してください。
+"""
+
+# アップロードされたログファイルの内容 (行番号付きの本文、または行数の多いファイルはテンプレート要約)
+# 役割: メッセージ履歴とは別に保存されたログの要約を、分析エージェントに渡す
+LOG_DIGEST_PROMPT = """
+【アップロードされたログファイル】
+{log_blocks}
+"""
+
+# ログがトークン予算を超えたため層別サンプリングした場合の説明 (sampler.py)
+# 役割: 送信していない行があることと、その内訳をモデルに伝え、必要な行をツールで取得させる
+LOG_SAMPLE_NOTE_PROMPT = """
+【ログのサンプリングについて】
+{note}
+重要な行とその前後は優先して残していますが、省略した行に根拠が必要な場合はログ検索ツールで原文を確認してください。
+"""
+
+# ログ検索ツールの使い方 (行インデックスがある場合に分析エージェントへ追加する)
+# 役割: 要約に含まれない行を、必要な分だけツールで取得させる
+LOG_TOOLS_PROMPT = """
+【ログ検索ツール】
+要約に含まれていない行や、テンプレート要約の実際の行を確認したい場合は、以下のツールで原文を取得できます。
+- `search_logs`: キーワードに関連する行を検索（例: エラーメッセージ、例外名、ユーザーID）
+- `grep_logs`: 正規表現に一致する行を先頭から検索
+- `read_log_lines`: 指定したファイルの行範囲を取得（エラー前後の文脈の確認など）
+- `read_time_window`: 指定した時刻範囲の全ファイルのイベントを時刻順に取得
+ツールの結果は `[ファイル名: 行番号] 本文` の形式なので、そのまま引用に使用できます。
+必要な証拠が揃ったら、ツールを呼ばずに分析結果を出力してください。
+"""
+
+# 批評エージェントに渡す、分析結果で引用された行の原文
+# 役割: 引用の正しさをログ全体を渡さずに検証できるようにする
+CITATION_SLICES_PROMPT = """
+【引用箇所の原文（ログストアから抽出）】
+分析結果で引用されているファイル名・行番号の実際の内容です。引用内容が原文と一致しているか確認してください。
+
+{slices}
+"""
+
+# 異常候補のランキング (パース結果から NumPy で事前検出したもの)
+# 役割: ログ全体を走査する前に、調べるべき時間窓と行範囲を分析エージェントに示す
+ANOMALY_REPORT_PROMPT = """
+【異常候補（自動検出、スコア順）】
+時刻ごとの集計から機械的に検出した、エラー率の急増・5xxの集中・レベルの悪化・ログの途絶の候補です。
+まずスコアの高い候補の行範囲から調査してください。ただし候補は統計的な目安であり、原因の判断は原文の確認に基づいて行ってください。
+
+{report}
+"""
+
+# 批評エージェントに渡す、引用の機械的な検証結果 (verifier.py)
+# 役割: 自動検証で承認できなかった理由を示し、批評の観点を絞る
+CITATION_CHECK_PROMPT = """
+【引用の自動検証結果】
+分析結果の引用をログの原文と機械的に照合した結果です。以下の問題点を優先して確認してください。
+
+{report}
+"""
+
+# 統合インシデントタイムライン (ログを機械的にパースして自動生成したもの)
+# 役割: ファイル横断の時刻の突き合わせ結果を分析エージェントに提供する
+INCIDENT_TIMELINE_PROMPT = """
+【統合インシデントタイムライン（自動生成）】
+アップロードされたログをパースし、ERROR以上のイベントを中心に全ファイルのWARNING以上のイベントを時刻順に統合したものです。
+各行の `[ファイル名: 行番号]` はそのまま引用に使用できます。ファイル間の因果関係を推論する際の出発点として活用してください。
+
+{timeline}
+"""
+
 # 批評エージェント用 (Critique Agent)
 # 役割: 解析結果をレビューし、証拠の引用が不十分であれば差し戻す
 CRITIC_AGENT_PROMPT = """
@@ -0,0 +1,472 @@
+# このファイルはログのパース（構造化）と時刻インデックスを管理します。
+# SYSTEM_CONTEXT_INFO に記載された access.log / app.log / db.log の形式をパーサーレジストリで解釈し、
+# 列指向のコンパクトなレコード表に変換します。複数ファイルの突き合わせは時刻順の k-way マージと
+# 時間窓結合で行い、統合インシデントタイムラインとしてグラフに渡します。
+
+import calendar
+import heapq
+import os
+import re
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Type
+
+# ==========================================
+# 1. レベル定義
+# ==========================================
+LEVEL_DEBUG = 10
+LEVEL_INFO = 20
+LEVEL_WARNING = 30
+LEVEL_ERROR = 40
+LEVEL_CRITICAL = 50
+
+LEVELS = {
+    "DEBUG": LEVEL_DEBUG,
+    "INFO": LEVEL_INFO,
+    "NOTICE": LEVEL_INFO,
+    "LOG": LEVEL_INFO,
+    "WARN": LEVEL_WARNING,
+    "WARNING": LEVEL_WARNING,
+    "ERROR": LEVEL_ERROR,
+    "CRITICAL": LEVEL_CRITICAL,
+    "FATAL": LEVEL_CRITICAL,
+    "PANIC": LEVEL_CRITICAL,
+}
+LEVEL_NAMES = {
+    LEVEL_DEBUG: "DEBUG",
+    LEVEL_INFO: "INFO",
+    LEVEL_WARNING: "WARNING",
+    LEVEL_ERROR: "ERROR",
+    LEVEL_CRITICAL: "CRITICAL",
+}
+
+# PostgreSQLの補足行 ([DETAIL] など) は直前のレコードのレベルを引き継ぐ
+INHERITED_LEVELS = {"DETAIL", "HINT", "CONTEXT", "STATEMENT"}
+
+# レコードのフラグ
+FLAG_TRACEBACK = 1
+
+MONTHS = {m: i for i, m in enumerate(
+    ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], start=1
+)}
+
+# 例外の最終行 (例: "ConnectionError: Timeout connecting to DB")
+EXCEPTION_LINE = re.compile(r"^[A-Za-z_][\w.]*(?:Error|Exception|Exit|Interrupt)\b")
+
+_epoch_day_cache: Dict[Tuple[int, int, int], int] = {}
+
+def to_epoch(year: int, month: int, day: int, hour: int, minute: int, second: int) -> float:
+    """
+    ログ上の表示時刻 (壁時計) を秒に変換します。
+    ファイルごとにタイムゾーン表記の有無が異なるため、オフセットは無視して表示上の時刻で揃えます。
+    """
+    key = (year, month, day)
+    base = _epoch_day_cache.get(key)
+    if base is None:
+        base = calendar.timegm((year, month, day, 0, 0, 0, 0, 0, 0))
+        _epoch_day_cache[key] = base
+    return float(base + hour * 3600 + minute * 60 + second)
+
+def format_timestamp(ts: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts))
+
+# ==========================================
+# 2. 列指向レコード表
+# ==========================================
+
+class RecordTable:
+    """
+    1ファイル分のパース結果を列ごとの配列で保持するレコード表。
+
+    本文 (message) は注目レコード (WARNING以上) のみ保持し、通常のINFO行は
+    時刻・レベル・行番号などの数値列だけを持つことでメモリを抑えます。
+    """
+
+    # 数値列の属性名 (解析キャッシュへの保存・復元に使う)
+    COLUMNS = ("timestamps", "levels", "statuses", "path_ids", "line_starts", "line_ends", "flags")
+
+    def __init__(self, file_name: str, parser_name: str):
+        self.file_name = file_name
+        self.parser_name = parser_name
+        self.timestamps = array("d")
+        self.levels = array("b")
+        self.statuses = array("H")
+        self.path_ids = array("i")
+        self.line_starts = array("I")
+        self.line_ends = array("I")
+        self.flags = array("B")
+        self.messages: Dict[int, str] = {}
+        self.paths: List[str] = []
+        self._path_ids: Dict[str, int] = {}
+        self._order: Optional[array] = None
+        self._sorted_ts: Optional[array] = None
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def to_columns(self) -> Tuple[dict, Dict[str, array]]:
+        """
+        解析キャッシュに保存する (メタ情報, 数値列) を返します。
+        """
+        meta = {"parser_name": self.parser_name, "messages": sorted(self.messages.items()), "paths": self.paths}
+        return meta, {name: getattr(self, name) for name in self.COLUMNS}
+
+    @classmethod
+    def from_columns(cls, file_name: str, meta: dict, columns: Dict[str, Sequence]) -> "RecordTable":
+        """
+        to_columns() で保存した列からレコード表を復元します。
+        列は解析キャッシュを mmap した memoryview のまま参照するため、復元した表に行は追加できません。
+        """
+        table = cls(file_name, meta["parser_name"])
+        for name in cls.COLUMNS:
+            setattr(table, name, columns[name])
+        table.messages = {int(row): message for row, message in meta["messages"]}
+        table.paths = list(meta["paths"])
+        table._path_ids = {path: i for i, path in enumerate(table.paths)}
+        return table
+
+    def __getstate__(self) -> dict:
+        # mmap した列 (memoryview) はプロセス間で受け渡せないため、配列にコピーする
+        return {k: array(v.format, v.tobytes()) if isinstance(v, memoryview) else v for k, v in self.__dict__.items()}
+
+    def append(
+        self,
+        ts: float,
+        level: int,
+        line_no: int,
+        message: str = "",
+        status: int = 0,
+        path: Optional[str] = None,
+    ) -> int:
+        row = len(self.timestamps)
+        self.timestamps.append(ts)
+        self.levels.append(level)
+        self.statuses.append(status)
+        self.path_ids.append(self._intern_path(path))
+        self.line_starts.append(line_no)
+        self.line_ends.append(line_no)
+        self.flags.append(0)
+        if level >= LEVEL_WARNING:
+            self.messages[row] = message
+        self._order = None
+        return row
+
+    def extend_last(self, line_no: int, line: str) -> None:
+        """
+        タイムスタンプを持たない継続行 (Traceback など) を直前のレコードにまとめます。
+        """
+        if not self.timestamps:
+            return
+        row = len(self.timestamps) - 1
+        self.line_ends[row] = line_no
+        stripped = line.strip()
+        if stripped.startswith("Traceback"):
+            self.flags[row] |= FLAG_TRACEBACK
+            # スタックトレースを伴うレコードは少なくともERRORとして扱う
+            if self.levels[row] < LEVEL_ERROR:
+                self.levels[row] = LEVEL_ERROR
+                self.messages.setdefault(row, "")
+        elif self.flags[row] & FLAG_TRACEBACK and EXCEPTION_LINE.match(stripped):
+            self.messages[row] = f"{self.messages.get(row, '')} (Traceback: {stripped})".strip()
+
+    def _intern_path(self, path: Optional[str]) -> int:
+        if path is None:
+            return -1
+        path_id = self._path_ids.get(path)
+        if path_id is None:
+            path_id = len(self.paths)
+            self.paths.append(path)
+            self._path_ids[path] = path_id
+        return path_id
+
+    # ------------------------------------------
+    # 時刻インデックス
+    # ------------------------------------------
+    def _ensure_index(self) -> None:
+        if self._order is not None:
+            return
+        ts = self.timestamps
+        if all(ts[i] <= ts[i + 1] for i in range(len(ts) - 1)):
+            # ログは通常すでに時刻順なので、ソートを省略する
+            self._order = array("I", range(len(ts)))
+            self._sorted_ts = ts
+        else:
+            self._order = array("I", sorted(range(len(ts)), key=ts.__getitem__))
+            self._sorted_ts = array("d", (ts[i] for i in self._order))
+
+    def rows_between(self, start: float, end: float) -> array:
+        """
+        start <= 時刻 <= end のレコード行を時刻順で返します (二分探索)。
+        """
+        self._ensure_index()
+        lo = bisect_left(self._sorted_ts, start)
+        hi = bisect_right(self._sorted_ts, end)
+        return self._order[lo:hi]
+
+    def iter_sorted(self, min_level: int = 0) -> Iterator[Tuple[float, int]]:
+        """
+        (時刻, 行) を時刻順に返します。
+        """
+        self._ensure_index()
+        levels = self.levels
+        for ts, row in zip(self._sorted_ts, self._order):
+            if levels[row] >= min_level:
+                yield ts, row
+
+    @property
+    def time_range(self) -> Optional[Tuple[float, float]]:
+        if not self.timestamps:
+            return None
+        self._ensure_index()
+        return self._sorted_ts[0], self._sorted_ts[-1]
+
+    def line_ref(self, row: int) -> str:
+        start, end = self.line_starts[row], self.line_ends[row]
+        if start == end:
+            return f"{self.file_name}: {start:04d}"
+        return f"{self.file_name}: {start:04d}-{end:04d}"
+
+    def describe(self, row: int) -> str:
+        level = LEVEL_NAMES.get(self.levels[row], str(self.levels[row]))
+        return f"{level} {self.messages.get(row, '')}".rstrip()
+
+# ==========================================
+# 3. パーサーレジストリ
+# ==========================================
+
+PARSERS: Dict[str, Type["LogParser"]] = {}
+
+def register_parser(cls: Type["LogParser"]) -> Type["LogParser"]:
+    """
+    パーサークラスをレジストリに登録するデコレータ。
+    新しいログ形式に対応する場合は LogParser を継承したクラスに付与してください。
+    """
+    PARSERS[cls.name] = cls
+    return cls
+
+class LogParser:
+    """
+    1行ずつ受け取り、RecordTable を構築するパーサーの基底クラス。
+    """
+    name = ""
+    # ファイル名にこの文字列が含まれる場合に優先的に選択される
+    file_hints: Tuple[str, ...] = ()
+    line_pattern: re.Pattern = re.compile(r"(?!)")
+
+    def __init__(self, file_name: str):
+        self.table = RecordTable(file_name, self.name)
+
+    @classmethod
+    def sniff(cls, line: str) -> bool:
+        return cls.line_pattern.match(line) is not None
+
+    def add(self, line_no: int, line: str) -> None:
+        match = self.line_pattern.match(line)
+        if match is None:
+            self.table.extend_last(line_no, line)
+        else:
+            self.parse(line_no, match)
+
+    def add_batch(self, first_line_no: int, lines: Sequence[str]) -> None:
+        """
+        連続する行番号の行 (first_line_no から始まる) をまとめてパースします。
+        """
+        match_line = self.line_pattern.match
+        extend_last = self.table.extend_last
+        parse = self.parse
+        for line_no, line in enumerate(lines, first_line_no):
+            match = match_line(line)
+            if match is None:
+                extend_last(line_no, line)
+            else:
+                parse(line_no, match)
+
+    def parse(self, line_no: int, match: re.Match) -> None:
+        raise NotImplementedError
+
+@register_parser
+class AccessLogParser(LogParser):
+    """
+    access.log: IPアドレス - - [日時] "メソッド パス プロトコル" ステータスコード サイズ "-" "User-Agent"
+    """
+    name = "access"
+    file_hints = ("access",)
+    line_pattern = re.compile(
+        r'^\S+ \S+ \S+ \[(\d{2})/(\w{3})/(\d{4}):(\d{2}):(\d{2}):(\d{2})[^\]]*\] '
+        r'"(\S+) (\S+)[^"]*" (\d{3}) '
+    )
+
+    def parse(self, line_no: int, match: re.Match) -> None:
+        day, mon, year, hh, mm, ss, method, path, status = match.groups()
+        ts = to_epoch(int(year), MONTHS.get(mon, 1), int(day), int(hh), int(mm), int(ss))
+        status_code = int(status)
+        if status_code >= 500:
+            level = LEVEL_ERROR
+        elif status_code >= 400:
+            level = LEVEL_WARNING
+        else:
+            level = LEVEL_INFO
+        self.table.append(ts, level, line_no, f"{status_code} {method} {path}", status_code, path)
+
+@register_parser
+class LeveledLogParser(LogParser):
+    """
+    app.log: 日時 [ログレベル] メッセージ
+    タイムスタンプを持たない行 (Traceback など) は直前のレコードにまとめます。
+    """
+    name = "app"
+    file_hints = ("app",)
+    line_pattern = re.compile(
+        r"^(\d{4})-(\d{2})-(\d{2})[ T](\d{2}):(\d{2}):(\d{2})(?:[.,]\d+)?\s+\[(\w+)\]\s?(.*)"
+    )
+
+    def parse(self, line_no: int, match: re.Match) -> None:
+        year, month, day, hh, mm, ss, level_name, message = match.groups()
+        ts = to_epoch(int(year), int(month), int(day), int(hh), int(mm), int(ss))
+        level_name = level_name.upper()
+        if level_name in INHERITED_LEVELS and len(self.table):
+            level = self.table.levels[-1]
+            message = f"[{level_name}] {message}"
+        else:
+            level = LEVELS.get(level_name, LEVEL_INFO)
+        self.table.append(ts, level, line_no, message)
+
+@register_parser
+class DatabaseLogParser(LeveledLogParser):
+    """
+    db.log: 日時 [ログレベル] メッセージ (形式は app.log と同じ)
+    """
+    name = "db"
+    file_hints = ("db", "postgres", "sql")
+
+def detect_parser(file_name: str, first_line: str) -> Optional[LogParser]:
+    """
+    ファイル名のヒントと先頭行の形式から、適切なパーサーを選択します。
+    """
+    lower_name = os.path.basename(file_name).lower()
+    for cls in PARSERS.values():
+        if any(hint in lower_name for hint in cls.file_hints) and cls.sniff(first_line):
+            return cls(file_name)
+    for cls in PARSERS.values():
+        if cls.sniff(first_line):
+            return cls(file_name)
+    return None
+
+class RecordCollector:
+    """
+    インジェスト中の行を受け取り、最初の空でない行でパーサーを決定してレコード表を構築します。
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.parser: Optional[LogParser] = None
+        self._detected = False
+
+    def add(self, line_no: int, line: str) -> None:
+        if not self._detected:
+            if not line.strip():
+                return
+            self.parser = detect_parser(self.file_name, line)
+            self._detected = True
+        if self.parser is not None:
+            self.parser.add(line_no, line)
+
+    def add_batch(self, first_line_no: int, lines: Sequence[str]) -> None:
+        if not self._detected:
+            # パーサーが決まるまでの行 (先頭の空行と最初の行) は1行ずつ渡す
+            for skipped, line in enumerate(lines):
+                self.add(first_line_no + skipped, line)
+                if self._detected:
+                    first_line_no += skipped + 1
+                    lines = lines[skipped + 1:]
+                    break
+            else:
+                return
+        if self.parser is not None:
+            self.parser.add_batch(first_line_no, lines)
+
+    @property
+    def table(self) -> Optional[RecordTable]:
+        if self.parser is None or not len(self.parser.table):
+            return None
+        return self.parser.table
+
+# ==========================================
+# 4. ファイル横断の相関 (k-way マージ / 時間窓結合)
+# ==========================================
+
+def merge_events(tables: List[RecordTable], min_level: int = 0) -> Iterator[Tuple[float, int, int]]:
+    """
+    複数のレコード表を時刻順に k-way マージし、(時刻, 表の番号, 行) を返します。
+    """
+    streams = [
+        ((ts, table_idx, row) for ts, row in table.iter_sorted(min_level))
+        for table_idx, table in enumerate(tables)
+    ]
+    return heapq.merge(*streams)
+
+def find_incidents(tables: List[RecordTable], window_sec: float) -> List[Tuple[float, float, int]]:
+    """
+    ERROR以上のイベントを時刻順に走査し、window_sec 以内に連続するものを1つのインシデントにまとめます。
+    (開始時刻, 終了時刻, エラー件数) のリストを返します。
+    """
+    incidents: List[Tuple[float, float, int]] = []
+    for ts, _, _ in merge_events(tables, LEVEL_ERROR):
+        if incidents and ts - incidents[-1][1] <= window_sec:
+            start, _, count = incidents[-1]
+            incidents[-1] = (start, ts, count + 1)
+        else:
+            incidents.append((ts, ts, 1))
+    return incidents
+
+def window_join(
+    tables: List[RecordTable], start: float, end: float, min_level: int = LEVEL_WARNING
+) -> List[Tuple[float, int, int]]:
+    """
+    時間窓 [start, end] に含まれる全ファイルの注目イベントを時刻順に結合します。
+    """
+    streams = []
+    for table_idx, table in enumerate(tables):
+        rows = [row for row in table.rows_between(start, end) if table.levels[row] >= min_level]
+        streams.append([(table.timestamps[row], table_idx, row) for row in rows])
+    return list(heapq.merge(*streams))
+
+def build_incident_timeline(
+    tables: List[RecordTable],
+    window_sec: Optional[float] = None,
+    max_incidents: int = 20,
+    max_events: int = 30,
+) -> str:
+    """
+    ファイル横断の統合インシデントタイムラインをテキストで返します。
+    パース可能なレコードやエラーが無い場合は空文字列を返します。
+    """
+    tables = [t for t in tables if t is not None and len(t)]
+    if not tables:
+        return ""
+    if window_sec is None:
+        window_sec = float(os.getenv("INCIDENT_WINDOW_SEC", "30"))
+
+    incidents = find_incidents(tables, window_sec)
+    if not incidents:
+        return ""
+
+    # エラー件数の多いインシデントを優先し、表示は時刻順に戻す
+    shown = sorted(sorted(incidents, key=lambda x: -x[2])[:max_incidents])
+    lines = [
+        f"対象: {', '.join(t.file_name for t in tables)} (時刻はログ上の表示時刻、前後{window_sec:g}秒の窓で結合)"
+    ]
+    for n, (start, end, error_count) in enumerate(shown, start=1):
+        events = window_join(tables, start - window_sec, end + window_sec)
+        lines.append(
+            f"■ インシデント{n}: {format_timestamp(start)} 〜 {format_timestamp(end)} (ERROR以上 {error_count}件)"
+        )
+        for ts, table_idx, row in events[:max_events]:
+            table = tables[table_idx]
+            lines.append(f"  {format_timestamp(ts)} [{table.line_ref(row)}] {table.describe(row)}")
+        if len(events) > max_events:
+            lines.append(f"  (他 {len(events) - max_events} 件)")
+    if len(incidents) > len(shown):
+        lines.append(f"(他 {len(incidents) - len(shown)} インシデントは省略)")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,188 @@
+# このファイルはLLMに渡す前のログ削減（テンプレート抽出）処理を管理します。
+# Drain方式の固定深さ解析木で行をテンプレートにクラスタリングし、
+# 件数・初出行/最終行・サンプル行だけを残すことで、繰り返しの多いログを数百行程度に圧縮します。
+
+import os
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 変数部分としてマスクするパターン (左から優先して1パスで置換)。
+# どの候補も数字・16進の英字・"[" "+" "-" のいずれかで始まるため、先頭の先読みでそれ以外の位置を素早く読み飛ばす
+MASK_PATTERN = re.compile(r"(?=[\da-fA-F\[+\-])(?:" + "|".join([
+    r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?",   # 2025-12-23 10:00:01
+    r"\[\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2} [+-]\d{4}\]",     # [23/Dec/2025:10:00:02 +0900]
+    r"\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b",                   # 192.168.1.50:5432
+    r"\b0x[0-9a-fA-F]+\b",
+    r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b",
+    r"(?<![\w.])[-+]?\d+(?:\.\d+)?(?![\w.])",
+]) + ")")
+WILDCARD = "<*>"
+
+# 要約時に行番号付きで残すサンプル行の数 (テンプレートごと)
+DEFAULT_SAMPLE_LINES = 2
+
+@lru_cache(maxsize=4096)
+def _has_digit(token: str) -> bool:
+    # 解析木の先頭トークンは種類が少ないため、判定結果をキャッシュする
+    return any(c.isdigit() for c in token)
+
+@dataclass
+class LogCluster:
+    """
+    1つのテンプレートと、それに属する行の統計情報。
+    """
+    template: List[str]
+    count: int = 0
+    first_line: int = 0
+    last_line: int = 0
+    samples: List[Tuple[int, str]] = field(default_factory=list)
+
+    def template_text(self) -> str:
+        return " ".join(self.template)
+
+class TemplateMiner:
+    """
+    Drain方式のオンライン・テンプレート抽出器。
+
+    トークン数 → 先頭 depth 個のトークン で解析木を辿り、葉に並ぶクラスタの中から
+    類似度が閾値以上のものに合流させます。一致しない位置は <*> に置き換えます。
+    """
+
+    def __init__(
+        self,
+        depth: int = 4,
+        similarity_threshold: float = 0.5,
+        max_children: int = 100,
+        sample_lines: int = DEFAULT_SAMPLE_LINES,
+    ):
+        self.depth = max(depth - 2, 1)
+        self.similarity_threshold = similarity_threshold
+        self.max_children = max_children
+        self.sample_lines = sample_lines
+        self.clusters: List[LogCluster] = []
+        self.total_lines = 0
+        self._tree: Dict = {}
+
+    # ------------------------------------------
+    # 前処理
+    # ------------------------------------------
+    @staticmethod
+    def tokenize(line: str) -> List[str]:
+        """
+        変数部分をマスクした上で空白区切りのトークン列に変換します。
+        """
+        return MASK_PATTERN.sub(WILDCARD, line).split()
+
+    # ------------------------------------------
+    # 解析木の探索
+    # ------------------------------------------
+    def _leaf(self, tokens: List[str]) -> List[LogCluster]:
+        node = self._tree.setdefault(len(tokens), {})
+        for token in tokens[: self.depth]:
+            # 数字を含むトークンは分岐を爆発させるのでワイルドカード扱いにする
+            if _has_digit(token):
+                token = WILDCARD
+            if token not in node:
+                if len(node) >= self.max_children:
+                    token = WILDCARD
+                node = node.setdefault(token, {})
+            else:
+                node = node[token]
+        return node.setdefault(None, [])
+
+    @staticmethod
+    def _similarity(template: List[str], tokens: List[str]) -> Tuple[float, int]:
+        same = 0
+        wildcards = 0
+        for t, s in zip(template, tokens):
+            if t == s:
+                same += 1
+            elif t == WILDCARD:
+                wildcards += 1
+        return same / len(tokens), wildcards
+
+    def add(self, line_no: int, line: str) -> LogCluster:
+        """
+        1行をクラスタリングし、所属したクラスタを返します。
+        """
+        self.total_lines += 1
+        tokens = self.tokenize(line) or [""]
+        leaf = self._leaf(tokens)
+
+        best: Optional[LogCluster] = None
+        best_key = (-1.0, -1)
+        for cluster in leaf:
+            key = self._similarity(cluster.template, tokens)
+            if key > best_key:
+                best, best_key = cluster, key
+
+        if best is None or best_key[0] < self.similarity_threshold:
+            best = LogCluster(template=list(tokens), first_line=line_no)
+            leaf.append(best)
+            self.clusters.append(best)
+        elif best_key[0] < 1.0:
+            best.template = [
+                t if t == s else WILDCARD for t, s in zip(best.template, tokens)
+            ]
+
+        best.count += 1
+        best.last_line = line_no
+        if len(best.samples) < self.sample_lines:
+            best.samples.append((line_no, line))
+        return best
+
+    def add_batch(self, first_line_no: int, lines: Sequence[str]) -> None:
+        """
+        連続する行番号の行 (first_line_no から始まる) をまとめてクラスタリングします。
+        """
+        add = self.add
+        for line_no, line in enumerate(lines, first_line_no):
+            add(line_no, line)
+
+    # ------------------------------------------
+    # 出力
+    # ------------------------------------------
+    def render(self, max_templates: Optional[int] = None) -> str:
+        """
+        テンプレート一覧を行番号付きのテキスト表に変換します。
+        max_templates を超える場合は出現件数の少ない（＝異常の可能性が高い）テンプレートを優先して残します。
+        """
+        clusters = self.clusters
+        omitted: List[LogCluster] = []
+        if max_templates is not None and len(clusters) > max_templates:
+            ranked = sorted(clusters, key=lambda c: (c.count, c.first_line))
+            kept = set(id(c) for c in ranked[:max_templates])
+            omitted = [c for c in clusters if id(c) not in kept]
+            clusters = [c for c in clusters if id(c) in kept]
+
+        lines = [
+            f"(テンプレート要約: 全{self.total_lines}行 → {len(self.clusters)}テンプレート。"
+            f"サンプル行は元の行番号付きで引用可能です)",
+            "件数 | 初出行 | 最終行 | テンプレート",
+        ]
+        for c in clusters:
+            lines.append(f"{c.count} | {c.first_line:04d} | {c.last_line:04d} | {c.template_text()}")
+            for line_no, sample in c.samples:
+                lines.append(f"    {line_no:04d}: {sample}")
+        if omitted:
+            omitted_lines = sum(c.count for c in omitted)
+            lines.append(f"(他 {len(omitted)} テンプレート / 計 {omitted_lines} 行は頻出のため省略)")
+        return "\n".join(lines) + "\n"
+
+# ==========================================
+# 設定
+# ==========================================
+
+def reduce_min_lines() -> int:
+    """
+    テンプレート要約に切り替える行数の閾値。これ以下のファイルは全行をそのまま渡します。
+    """
+    return int(os.getenv("LOG_REDUCE_MIN_LINES", "1000"))
+
+def reduce_max_templates() -> int:
+    """
+    1ファイルあたりに出力するテンプレート数の上限。
+    """
+    return int(os.getenv("LOG_REDUCE_MAX_TEMPLATES", "300"))
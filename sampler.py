@@ -0,0 +1,325 @@
+# このファイルはモデルのコンテキストに収まらないログの層別サンプリングを管理します。
+# アップロード全体の要約がトークン予算 (LOG_CONTEXT_TOKEN_BUDGET) を超える場合に、ブロブストアの本文を
+# ファイルごとに1回だけ先頭から読みながら
+#   - ERROR / CRITICAL 以上の行、Traceback、2xx 以外のアクセスログ (重要な行) は前後の文脈と合わせて残し
+#   - INFO や 2xx などの通常の行は、ファイルを時間帯 (行の並び順で等分した区間) ごとの
+#     リザーバーサンプリングで均等に間引き
+# 予算に収まる行番号付きのログブロックと、省略した内容の説明を作ります。
+# 乱数はファイル名から決めるため、同じ入力からは常に同じ結果 (= 同じプロンプトの先頭部分) になります。
+
+import os
+import random
+import re
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from ingest import format_file_block, format_line, iter_numbered_lines
+from llm_pool import estimate_text_tokens
+from records import EXCEPTION_LINE
+
+# 重要度 (大きいほど優先して残す)
+RANK_ROUTINE = 0
+RANK_OTHER_STATUS = 1
+RANK_CLIENT_ERROR = 2
+RANK_ERROR = 3
+RANK_CRITICAL = 4
+
+# ERROR 以上の行を選んだ後、それ以外の重要な行より先に通常の行へ割り当てる予算の割合
+ROUTINE_SHARE = 0.2
+# 説明文 (SampledLogs.note と LOG_SAMPLE_NOTE_PROMPT) のトークン数の目安
+NOTE_TOKENS = 250
+# 省略記号 "... (N行省略)" 1つ分のトークン数
+GAP_COST = estimate_text_tokens("... (9999999行省略)\n")
+
+RANK_LABELS = {
+    RANK_CRITICAL: "CRITICAL以上",
+    RANK_ERROR: "ERROR・Traceback・5xx",
+    RANK_CLIENT_ERROR: "4xx",
+    RANK_OTHER_STATUS: "2xx・4xx・5xx以外のステータス",
+}
+
+LEVEL_PATTERN = re.compile(r"\b(CRITICAL|FATAL|PANIC|ERROR)\b")
+# access.log の "メソッド パス プロトコル" に続くステータスコード
+ACCESS_STATUS_PATTERN = re.compile(r'" (\d{3}) ')
+
+def context_token_budget() -> int:
+    """
+    ログブロックに使うトークン数の上限 (LOG_CONTEXT_TOKEN_BUDGET)。0 の場合はサンプリングしません。
+    """
+    return int(os.getenv("LOG_CONTEXT_TOKEN_BUDGET", "60000"))
+
+def sample_context_lines() -> int:
+    return int(os.getenv("LOG_SAMPLE_CONTEXT_LINES", "2"))
+
+def sample_strata() -> int:
+    return max(int(os.getenv("LOG_SAMPLE_STRATA", "20")), 1)
+
+class LineClassifier:
+    """
+    1行ずつ重要度を判定する。Traceback は例外の最終行まで (インデントされた行が続く間) を ERROR として扱う。
+    """
+
+    def __init__(self):
+        self._in_traceback = False
+
+    def rank(self, line: str) -> int:
+        if self._in_traceback:
+            if line[:1].isspace() or EXCEPTION_LINE.match(line):
+                return RANK_ERROR
+            self._in_traceback = False
+        if line.startswith("Traceback"):
+            self._in_traceback = True
+            return RANK_ERROR
+        match = LEVEL_PATTERN.search(line)
+        if match is not None:
+            return RANK_ERROR if match.group(1) == "ERROR" else RANK_CRITICAL
+        match = ACCESS_STATUS_PATTERN.search(line)
+        if match is not None:
+            status = int(match.group(1))
+            if status >= 500:
+                return RANK_ERROR
+            if status >= 400:
+                return RANK_CLIENT_ERROR
+            if not 200 <= status < 300:
+                return RANK_OTHER_STATUS
+        return RANK_ROUTINE
+
+@dataclass
+class LineGroup:
+    """
+    重要な行とその前後の文脈。
+    """
+    rank: int
+    lines: List[Tuple[int, str]]
+    # lines のうち重要な行そのものの行番号 (予算が足りない場合は文脈より先に残す)
+    core: List[int] = field(default_factory=list)
+    # 同じファイル・区間・重要度の中での出現順 (時間帯に散らして選ぶために使う)
+    order: int = 0
+    stratum: int = 0
+
+@dataclass
+class FileSample:
+    name: str
+    total_lines: int = 0
+    # 読み込んだ範囲の先頭の行番号 (シャードのように途中から読む場合)
+    start_line: int = 1
+    groups: List[LineGroup] = field(default_factory=list)
+    # 区間ごとの通常の行のリザーバー
+    reservoirs: List[List[Tuple[int, str]]] = field(default_factory=list)
+    important_lines: int = 0
+    # メモリを抑えるため、区間ごとの上限を超えて記録しなかった重要な行の数 (重要度別)
+    overflow: Dict[int, int] = field(default_factory=dict)
+    chosen: Dict[int, str] = field(default_factory=dict)
+
+def scan_file(
+    name: str, path: str, line_count: int, context_lines: int, strata: int, reservoir_size: int, max_groups: int,
+    start_line: int = 1,
+) -> FileSample:
+    """
+    ファイルを先頭 (start_line 行目) から1回だけ読み、重要な行のグループと区間ごとの通常の行のリザーバーを作ります。
+    """
+    sample = FileSample(name, start_line=start_line, reservoirs=[[] for _ in range(strata)])
+    rng = random.Random(name)
+    classifier = LineClassifier()
+    before: deque = deque(maxlen=context_lines)
+    seen_in_stratum = [0] * strata
+    group_counts: Dict[Tuple[int, int], int] = {}
+    current: Optional[LineGroup] = None
+    after = 0
+    total = max(line_count, 1)
+    end_line = start_line + line_count - 1 if line_count > 0 else None
+    for line_no, line in iter_numbered_lines(path, start_line, end_line):
+        sample.total_lines = line_no - start_line + 1
+        stratum = min((line_no - start_line) * strata // total, strata - 1)
+        rank = classifier.rank(line)
+        if rank > RANK_ROUTINE:
+            sample.important_lines += 1
+            if current is not None and after >= 0 and current.lines[-1][0] == line_no - 1:
+                # 直前のグループに続く重要な行 (Traceback の続きなど) は同じグループにまとめる
+                current.lines.append((line_no, line))
+                current.core.append(line_no)
+                current.rank = max(current.rank, rank)
+            else:
+                key = (stratum, rank)
+                count = group_counts.get(key, 0)
+                group_counts[key] = count + 1
+                if count < max_groups:
+                    current = LineGroup(
+                        rank, list(before) + [(line_no, line)], core=[line_no], order=count, stratum=stratum
+                    )
+                    sample.groups.append(current)
+                else:
+                    current = None
+                    sample.overflow[rank] = sample.overflow.get(rank, 0) + 1
+            after = context_lines
+            before.clear()
+            continue
+        if current is not None and after > 0:
+            current.lines.append((line_no, line))
+            after -= 1
+            continue
+        current = None
+        before.append((line_no, line))
+        # 通常の行: 区間ごとのリザーバーサンプリング (Algorithm R)
+        seen_in_stratum[stratum] += 1
+        reservoir = sample.reservoirs[stratum]
+        if len(reservoir) < reservoir_size:
+            reservoir.append((line_no, line))
+        else:
+            j = rng.randrange(seen_in_stratum[stratum])
+            if j < reservoir_size:
+                reservoir[j] = (line_no, line)
+    return sample
+
+@dataclass
+class SampledLogs:
+    blocks: str
+    token_budget: int
+    total_lines: int = 0
+    sent_lines: int = 0
+    important_lines: int = 0
+    important_sent: int = 0
+    routine_lines: int = 0
+    routine_sent: int = 0
+    # 予算に収まらず省略した重要な行のグループ数 (重要度別)
+    dropped_groups: Dict[int, int] = field(default_factory=dict)
+
+    def note(self) -> str:
+        """
+        何を残し、何を省略したかの説明。
+        """
+        lines = [
+            f"トークン予算 {self.token_budget} に収めるため、全 {self.total_lines} 行のうち {self.sent_lines} 行だけを送信しています"
+            "（行番号は原文のまま、「...」は省略箇所）。",
+            f"- 重要な行（ERROR/CRITICAL 以上・Traceback・2xx 以外のアクセス）: {self.important_sent}/{self.important_lines} 行",
+            f"- 通常の行（INFO・2xx など）: {self.routine_sent}/{self.routine_lines} 行"
+            "（重要な行の前後の文脈と、時間帯ごとに均等に抽出した行）",
+        ]
+        for rank, count in sorted(self.dropped_groups.items(), reverse=True):
+            lines.append(f"- 予算に収まらず省略した重要な箇所: {RANK_LABELS[rank]} {count} 件")
+        return "\n".join(lines)
+
+def _line_cost(line_no: int, line: str) -> int:
+    return estimate_text_tokens(format_line(line_no, line)) + 1
+
+class _Selection:
+    """
+    予算内で送信する行を選ぶ。選んだ行ごとに、直前に入る可能性のある省略記号の分も数える。
+    """
+
+    def __init__(self, line_budget: int):
+        self.line_budget = line_budget
+        self.cost = 0
+        self._positions: Dict[int, int] = {}
+
+    def _take(self, sample: FileSample, lines: List[Tuple[int, str]], limit: int) -> bool:
+        lines = [(no, line) for no, line in lines if no not in sample.chosen]
+        cost = sum(_line_cost(no, line) for no, line in lines)
+        # 連続しない行の前には省略記号が入る
+        cost += GAP_COST * sum(1 for i, (no, _) in enumerate(lines) if i == 0 or lines[i - 1][0] != no - 1)
+        if self.cost + cost > limit:
+            return False
+        self.cost += cost
+        sample.chosen.update(lines)
+        return True
+
+    def add_groups(self, groups: List[Tuple[LineGroup, FileSample]], result: SampledLogs) -> None:
+        """
+        先に重要な行そのものを選び、残った予算で選んだ箇所の前後の文脈を追加する。
+        """
+        kept = []
+        for group, sample in groups:
+            core = set(group.core)
+            if self._take(sample, [(no, line) for no, line in group.lines if no in core], self.line_budget):
+                kept.append((group, sample))
+            else:
+                result.dropped_groups[group.rank] = result.dropped_groups.get(group.rank, 0) + 1
+        for group, sample in kept:
+            self._take(sample, group.lines, self.line_budget)
+
+    def add_routine(self, samples: List[FileSample], limit: int, result: SampledLogs) -> None:
+        """
+        全ファイルの区間を1行ずつ順番に巡り、limit に達するまで通常の行を追加する。
+        """
+        queues = [
+            (sample, reservoir) for sample in samples for reservoir in sample.reservoirs
+            if len(reservoir) > self._positions.get(id(reservoir), 0)
+        ]
+        while queues and self.cost < limit:
+            remaining = []
+            for sample, reservoir in queues:
+                position = self._positions.get(id(reservoir), 0)
+                line_no, line = reservoir[position]
+                if line_no not in sample.chosen and not self._take(sample, [(line_no, line)], limit):
+                    continue
+                self._positions[id(reservoir)] = position + 1
+                if position + 1 < len(reservoir):
+                    remaining.append((sample, reservoir))
+            queues = remaining
+
+def sample_logs(
+    files: List[Tuple[str, str, int]],
+    token_budget: int,
+    context_lines: Optional[int] = None,
+    strata: Optional[int] = None,
+    start_line: int = 1,
+) -> SampledLogs:
+    """
+    (ファイル名, ブロブのパス, 行数) の一覧から、token_budget に収まるログブロックを作ります。
+    start_line を指定すると、各ファイルのその行から 行数 分の範囲だけを対象にします (シャード分析)。
+    重要な行は重要度の高い順に、同じ重要度の中では区間を順番に巡って時間的に散らばるように選び、
+    残りの予算を通常の行に区間ごとに均等に割り当てます。
+    """
+    context_lines = sample_context_lines() if context_lines is None else context_lines
+    strata = sample_strata() if strata is None else strata
+    # 見積もりの誤差と、ファイルのヘッダー・説明文の分を残しておく
+    line_budget = int(token_budget * 0.95) - 40 * len(files) - NOTE_TOKENS
+    # 1行は少なくとも数トークンになるため、予算に収まる行数より多くは保持しない
+    reservoir_size = max(line_budget // (4 * strata * max(len(files), 1)), 1)
+    max_groups = max(line_budget // (4 * strata), 1)
+
+    samples = [
+        scan_file(name, path, line_count, context_lines, strata, reservoir_size, max_groups, start_line)
+        for name, path, line_count in files
+    ]
+    result = SampledLogs(blocks="", token_budget=token_budget)
+    selection = _Selection(line_budget)
+    groups = [(g, s) for s in samples for g in s.groups]
+    groups.sort(key=lambda item: (-item[0].rank, item[0].order, item[0].stratum))
+    # 1. ERROR 以上の行とその前後
+    selection.add_groups([item for item in groups if item[0].rank >= RANK_ERROR], result)
+    # 2. 4xx などが大量にあっても時間帯ごとの通常の様子が分かるよう、通常の行に予算の一部を先に割り当てる
+    selection.add_routine(samples, min(selection.cost + int(line_budget * ROUTINE_SHARE), line_budget), result)
+    # 3. 残りの重要な行 (4xx など) とその前後
+    selection.add_groups([item for item in groups if item[0].rank < RANK_ERROR], result)
+    # 4. 残った予算を通常の行に割り当てる
+    selection.add_routine(samples, line_budget, result)
+    for sample in samples:
+        for rank, count in sample.overflow.items():
+            result.dropped_groups[rank] = result.dropped_groups.get(rank, 0) + count
+        core = {no for group in sample.groups for no in group.core}
+        important_sent = sum(1 for no in sample.chosen if no in core)
+        result.important_lines += sample.important_lines
+        result.important_sent += important_sent
+        result.routine_lines += sample.total_lines - sample.important_lines
+        result.routine_sent += len(sample.chosen) - important_sent
+        result.total_lines += sample.total_lines
+
+    # ファイルごとに行番号順に並べ、省略箇所に印を付ける
+    blocks = []
+    for sample in samples:
+        body = []
+        previous = sample.start_line - 1
+        last_line = sample.start_line + sample.total_lines - 1
+        for line_no in sorted(sample.chosen):
+            if line_no > previous + 1:
+                body.append(f"... ({line_no - previous - 1}行省略)\n")
+            body.append(format_line(line_no, sample.chosen[line_no]))
+            previous = line_no
+        if previous < last_line:
+            body.append(f"... ({last_line - previous}行省略)\n")
+        blocks.append(format_file_block(sample.name, "".join(body)))
+        result.sent_lines += len(sample.chosen)
+    result.blocks = "".join(blocks)
+    return result
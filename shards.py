@@ -0,0 +1,181 @@
+# このファイルは大規模アップロード向けのシャード分割 (map-reduce 分析) の計画を管理します。
+# ログをファイル単位・時間窓単位のシャードに分割し、各シャードを並列に分析した後、
+# グラフの reduce ノードで部分的な分析結果を統合します。
+
+import os
+from typing import List, Optional
+
+from ingest import IngestResult, format_line, iter_numbered_lines, render_log_body
+from llm_pool import estimate_text_tokens
+from records import RecordTable, format_timestamp
+from sampler import sample_logs
+
+# ==========================================
+# 1. 設定
+# ==========================================
+
+def shard_min_total_lines() -> int:
+    """
+    シャード分析に切り替える総行数の閾値。0 (既定) の場合はシャード分析を行いません。
+    シャード分析はシャードの数だけLLMを呼び出すため、明示的に有効にした場合だけ使います。
+    """
+    return int(os.getenv("SHARD_MIN_TOTAL_LINES", "0"))
+
+def shard_token_budget() -> int:
+    """
+    1シャードの本文に使うトークン数の上限 (SHARD_TOKEN_BUDGET)。
+    シャードの行数はこの予算に収まるように決め、まとめたシャードが予算を超える場合はサンプリングします。
+    """
+    return int(os.getenv("SHARD_TOKEN_BUDGET", "12000"))
+
+def shard_max_count() -> int:
+    """
+    シャード数の上限 (SHARD_MAX_COUNT)。超える場合は隣接するシャードをまとめます
+    (ファイル数が上限を超える場合でも、1ファイルにつき1シャードは作ります)。
+    """
+    return max(int(os.getenv("SHARD_MAX_COUNT", "8")), 1)
+
+def shard_window_sec() -> float:
+    """
+    シャードを区切る時間窓 (秒)。
+    """
+    return float(os.getenv("SHARD_WINDOW_SEC", "600"))
+
+def shard_max_concurrency() -> int:
+    """
+    シャード分析で同時に実行するLLM呼び出しの上限。
+    """
+    return int(os.getenv("SHARD_MAX_CONCURRENCY", "4"))
+
+# 1行あたりのトークン数を見積もるために読む先頭の行数
+TOKEN_ESTIMATE_LINES = 200
+
+# ==========================================
+# 2. シャードの計画
+# ==========================================
+
+def _make_shard(file_name: str, path: str, start_line: int, end_line: int,
+                start_ts: Optional[float], end_ts: Optional[float]) -> dict:
+    # チェックポイントに保存されるため、JSONに変換可能な値だけで構成する
+    return {
+        "file": file_name,
+        "path": path,
+        "start_line": start_line,
+        "end_line": end_line,
+        "start_time": format_timestamp(start_ts) if start_ts is not None else None,
+        "end_time": format_timestamp(end_ts) if end_ts is not None else None,
+    }
+
+def tokens_per_line(path: str) -> float:
+    """
+    ファイルの先頭の行から、行番号付きで渡す場合の1行あたりのトークン数を見積もります。
+    """
+    costs = [
+        estimate_text_tokens(format_line(line_no, line))
+        for line_no, line in iter_numbered_lines(path, 1, TOKEN_ESTIMATE_LINES)
+    ]
+    return max(sum(costs) / len(costs), 1.0) if costs else 1.0
+
+def plan_file_shards(file_name: str, path: str, line_count: int,
+                     table: Optional[RecordTable], max_lines: int, window_sec: float) -> List[dict]:
+    """
+    1ファイルをシャードに分割します。
+
+    パース済みレコードがある場合は時間窓の境界で区切り、隣接する小さな時間窓はまとめます。
+    時間窓が max_lines を超える場合や、レコードが無い場合は行数で区切ります。
+    """
+    if line_count <= 0:
+        return []
+    if table is None or not len(table):
+        return [
+            _make_shard(file_name, path, start, min(start + max_lines - 1, line_count), None, None)
+            for start in range(1, line_count + 1, max_lines)
+        ]
+
+    shards = []
+    shard_start = 1
+    shard_start_ts = table.timestamps[0]
+    prev_ts = shard_start_ts
+    bucket = int(shard_start_ts // window_sec)
+    for row in range(1, len(table)):
+        line_no = table.line_starts[row]
+        ts = table.timestamps[row]
+        row_bucket = int(ts // window_sec)
+        size = line_no - shard_start
+        # 時間窓が変わった時点で一定以上の大きさがあれば区切る (小さな窓は次とまとめる)
+        if size >= max_lines or (row_bucket != bucket and size >= max_lines // 4):
+            shards.append(_make_shard(file_name, path, shard_start, line_no - 1, shard_start_ts, prev_ts))
+            shard_start = line_no
+            shard_start_ts = ts
+        bucket = row_bucket
+        prev_ts = ts
+    shards.append(_make_shard(file_name, path, shard_start, line_count, shard_start_ts, prev_ts))
+    return shards
+
+def merge_shards(shards: List[dict], count: int) -> List[dict]:
+    """
+    1ファイル分の隣接するシャードを、行数がほぼ均等な count 個以下にまとめます。
+    """
+    if len(shards) <= count:
+        return shards
+    first = shards[0]["start_line"]
+    total = shards[-1]["end_line"] - first + 1
+    merged: List[dict] = []
+    group = -1
+    for shard in shards:
+        shard_group = min((shard["start_line"] - first) * count // total, count - 1)
+        if shard_group == group:
+            merged[-1] = dict(merged[-1], end_line=shard["end_line"], end_time=shard["end_time"])
+        else:
+            merged.append(shard)
+            group = shard_group
+    return merged
+
+def plan_shards(result: IngestResult) -> List[dict]:
+    """
+    インジェスト結果の総行数が閾値を超える場合にシャード計画を返します。閾値以下 (または無効) なら空リスト。
+
+    1シャードの行数は SHARD_TOKEN_BUDGET に収まるように見積もり、シャード数が SHARD_MAX_COUNT を超える場合は
+    ファイルの行数に応じて上限を配分し、隣接するシャードをまとめます。
+    """
+    min_total = shard_min_total_lines()
+    if min_total <= 0 or result.total_lines < min_total:
+        return []
+    budget = shard_token_budget()
+    max_count = shard_max_count()
+    window_sec = shard_window_sec()
+    files = [f for f in result.files if f.path is not None and f.line_count > 0]
+    total_lines = sum(f.line_count for f in files) or 1
+    shards = []
+    for f in files:
+        max_lines = max(int(budget / tokens_per_line(f.path)), 1)
+        file_shards = plan_file_shards(f.name, f.path, f.line_count, f.records, max_lines, window_sec)
+        quota = max(max_count * f.line_count // total_lines, 1)
+        shards.extend(merge_shards(file_shards, quota))
+    return shards
+
+# ==========================================
+# 3. シャード本文の読み込み
+# ==========================================
+
+def describe_shard(shard: dict) -> str:
+    """
+    シャードの範囲を表す見出し (例: "app.log 0001-5000行 (2025-12-23 10:00:00 〜 10:09:59)")。
+    """
+    text = f"{shard['file']} {shard['start_line']:04d}-{shard['end_line']:04d}行"
+    if shard.get("start_time"):
+        text += f" ({shard['start_time']} 〜 {shard['end_time']})"
+    return text
+
+def read_shard(shard: dict, token_budget: Optional[int] = None) -> str:
+    """
+    シャードの行範囲だけをファイルから読み込み、行番号付き (または要約済み) の本文を返します。
+    本文がトークン予算 (SHARD_TOKEN_BUDGET) を超える場合は、重要な行を残して層別サンプリングします (sampler.py)。
+    """
+    token_budget = shard_token_budget() if token_budget is None else token_budget
+    body, _, _ = render_log_body(iter_numbered_lines(shard["path"], shard["start_line"], shard["end_line"]))
+    if token_budget <= 0 or estimate_text_tokens(body) <= token_budget:
+        return body
+    line_count = shard["end_line"] - shard["start_line"] + 1
+    sampled = sample_logs([(shard["file"], shard["path"], line_count)], token_budget, start_line=shard["start_line"])
+    return f"{sampled.blocks}\n{sampled.note()}\n"
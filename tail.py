@@ -0,0 +1,365 @@
+# このファイルはローカルのログディレクトリを監視して、異常を検出したときだけ分析する常駐モードを管理します。
+# ディレクトリ配下のログファイルを tail -F のように追跡し (ローテーション・切り詰めに対応)、
+#   - 追記されたバイト列はそのままローリングウィンドウ (直近の一定時間・一定サイズ) に保持し、
+#     エラー行の数だけをバイト列の正規表現で数える (行ごとのパースはしないため高レートのログにも追従できる)
+#   - 直近のエラー数が閾値を超えたら、デバウンス時間だけ待ってバースト全体を1回の分析にまとめ、
+#     ウィンドウをパース・インデックス化して LangGraph のワークフローを実行する
+# スレッド (thread_id) は実行をまたいで同じものを使うため、2回目以降は前回の分析結果からの差分として分析されます。
+#
+# 使い方:
+#   python tail.py /var/log/myapp --output reports/tail --threshold 20 --debounce 30
+
+import argparse
+import asyncio
+import fnmatch
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from batch import find_log_files
+from ingest import IngestResult, ingest_file
+
+# エラーとして数える行 (app.log / db.log の ERROR 以上、access.log の 5xx)
+ERROR_PATTERN = re.compile(rb"\[(?:ERROR|CRITICAL|FATAL|PANIC)\]|\" 5\d\d ")
+
+# ==========================================
+# 1. ファイルの追跡
+# ==========================================
+
+class FileFollower:
+    """
+    1ファイルを追跡し、前回から追記された完全な行だけをバイト列で返す。
+    ファイルが別の inode に置き換わった場合 (ローテーション) は古いファイルを最後まで読んでから新しいファイルの先頭へ、
+    サイズが読み込み位置より小さくなった場合 (copytruncate) は先頭へ戻る。
+    """
+
+    def __init__(self, name: str, path: str, from_start: bool = False):
+        self.name = name
+        self.path = path
+        self._file = None
+        self._inode: Optional[int] = None
+        self._pending = b""
+        # 直前の read() で上限まで読んだか (まだ読み残しがある可能性)
+        self.has_more = False
+        self._open(from_start)
+
+    def _open(self, from_start: bool) -> None:
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        self._file = f
+        self._inode = os.fstat(f.fileno()).st_ino
+        if not from_start:
+            f.seek(0, os.SEEK_END)
+
+    def read(self, max_bytes: int) -> bytes:
+        if self._file is None:
+            # 起動時に無かったファイルは、現れた時点で先頭から読む
+            self._open(from_start=True)
+            if self._file is None:
+                return b""
+        chunks = [self._pending, self._file.read(max_bytes)]
+        self.has_more = len(chunks[1]) >= max_bytes
+        if not self.has_more:
+            # 末尾まで読んだときだけ、置き換え・切り詰めを確認する
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                st = None
+            if st is not None and st.st_ino != self._inode:
+                # 古いファイルの残りを読み切り、改行で終わっていない最後の行も確定させる
+                chunks.append(self._file.read())
+                tail = b"".join(chunks)
+                if tail and not tail.endswith(b"\n"):
+                    chunks.append(b"\n")
+                self._file.close()
+                self._open(from_start=True)
+                if self._file is not None:
+                    chunks.append(self._file.read(max_bytes))
+            elif st is not None and st.st_size < self._file.tell():
+                self._file.seek(0)
+                chunks = [chunks[0], b"\n" if chunks[0] else b"", self._file.read(max_bytes)]
+        data = b"".join(chunks)
+        cut = data.rfind(b"\n")
+        if cut < 0:
+            self._pending = data
+            return b""
+        self._pending = data[cut + 1:]
+        return data[:cut + 1]
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class RollingWindow:
+    """
+    1ファイル分の直近の追記 (到着時刻, バイト列) を、時間とサイズの上限で保持する。
+    """
+
+    def __init__(self, window_sec: float, max_bytes: int):
+        self.window_sec = window_sec
+        self.max_bytes = max_bytes
+        self.chunks: Deque[Tuple[float, bytes]] = deque()
+        self.size = 0
+
+    def append(self, now: float, data: bytes) -> None:
+        self.chunks.append((now, data))
+        self.size += len(data)
+        while self.chunks and (self.size > self.max_bytes or self.chunks[0][0] < now - self.window_sec):
+            _, old = self.chunks.popleft()
+            self.size -= len(old)
+
+    def data(self) -> List[bytes]:
+        """
+        保持しているバイト列のコピー (bytes は不変のため、リストの複製だけで済む)。
+        """
+        return [data for _, data in self.chunks]
+
+class ErrorDetector:
+    """
+    直近 window_sec 秒のエラー行数が threshold 以上になったら発火する。
+    """
+
+    def __init__(self, threshold: int, window_sec: float):
+        self.threshold = threshold
+        self.window_sec = window_sec
+        self.counts: Deque[Tuple[float, int]] = deque()
+        self.total = 0
+
+    def add(self, now: float, count: int) -> None:
+        if count:
+            self.counts.append((now, count))
+            self.total += count
+        while self.counts and self.counts[0][0] < now - self.window_sec:
+            self.total -= self.counts.popleft()[1]
+
+    @property
+    def fired(self) -> bool:
+        return self.total >= self.threshold
+
+# ==========================================
+# 2. 監視と分析
+# ==========================================
+
+class LogTailer:
+    """
+    ディレクトリ配下のファイルを追跡し、検出器の発火をデバウンスして分析グラフを実行する。
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.directory = args.directory
+        self.thread_id = args.thread_id or f"tail-{os.path.basename(os.path.normpath(args.directory))}"
+        self.followers: Dict[str, FileFollower] = {}
+        self.windows: Dict[str, RollingWindow] = {}
+        # poll (ワーカースレッド) によるウィンドウの更新と、分析タスクの snapshot (別のワーカースレッド) を排他する
+        self._windows_lock = threading.Lock()
+        self.detector = ErrorDetector(args.threshold, args.detect_window)
+        self.bytes_read = 0
+        self.runs = 0
+        # 発火してからデバウンス時間が経つまで分析を待つ (バースト全体を1回にまとめる)
+        self.pending_since: Optional[float] = None
+        self.last_run_end = float("-inf")
+        self.last_scan = float("-inf")
+        # ファイル名 -> 直前の分析で使ったブロブの参照 (次の分析で不要になったものを削除する)
+        self.refs: Dict[str, str] = {}
+
+    def scan(self, from_start: bool) -> None:
+        """
+        新しく現れたファイルを追跡対象に加える (ローテーション後の app.log.1 などはパターンで除外する)。
+        """
+        for f in find_log_files(self.directory):
+            if f.name in self.followers or not fnmatch.fnmatch(os.path.basename(f.name), self.args.pattern):
+                continue
+            self.followers[f.name] = FileFollower(f.name, f.path, from_start)
+            with self._windows_lock:
+                self.windows[f.name] = RollingWindow(self.args.window, self.args.window_mb * 1024 * 1024)
+
+    def poll(self) -> bool:
+        """
+        全ファイルの追記を読み込み、ウィンドウと検出器に反映する。読み残しがあれば True を返す。
+        """
+        now = time.monotonic()
+        if now - self.last_scan >= self.args.rescan:
+            self.scan(from_start=self.last_scan != float("-inf") or self.args.from_start)
+            self.last_scan = now
+        max_bytes = self.args.read_mb * 1024 * 1024
+        more = False
+        for name, follower in self.followers.items():
+            data = follower.read(max_bytes)
+            if not data:
+                continue
+            self.bytes_read += len(data)
+            with self._windows_lock:
+                self.windows[name].append(now, data)
+            self.detector.add(now, len(ERROR_PATTERN.findall(data)))
+            more = more or follower.has_more
+        self.detector.add(now, 0)
+        return more
+
+    def snapshot(self, store) -> IngestResult:
+        """
+        ウィンドウの内容をパースし、行インデックス付きでストアに保存する (ファイルを読み直さない)。
+        poll と並行して呼ばれるため、ロック中はバイト列の参照だけをコピーし、行への分割とパースはロックの外で行う。
+        """
+        with self._windows_lock:
+            copies = [(name, window.data()) for name, window in self.windows.items()]
+        files = []
+        for name, chunks in copies:
+            lines = []
+            for data in chunks:
+                # ingest.iter_raw_lines と同じく \n だけで分割する (splitlines は \r や \x0c などでも分割し、
+                # 行番号がブロブ・引用とずれる)。チャンクは \n で終わるため、最後の空要素は行ではない
+                parts = data.split(b"\n")
+                if not parts[-1]:
+                    parts.pop()
+                lines.extend(part.rstrip(b"\r") for part in parts)
+            if lines:
+                files.append(ingest_file(name, None, store, raw_lines=lines))
+        return IngestResult(files)
+
+    async def analyze(self, error_count: int) -> None:
+        from graph import app as app_graph, drop_sampled_contexts
+        from langchain_core.messages import AIMessage, HumanMessage
+        from line_index import register_indexed_files
+        from log_store import get_blob_store
+        from metrics import RunRecorder
+        from shards import plan_shards
+
+        store = get_blob_store(self.thread_id)
+        result = await asyncio.to_thread(self.snapshot, store)
+        if not result.files:
+            return
+        register_indexed_files(self.thread_id, result.files)
+        # 前回のスナップショットのブロブは、同じ名前の新しいものに置き換わったので削除する
+        for f in result.files:
+            old = self.refs.get(f.name)
+            if old is not None and old != f.ref:
+                store.discard(old)
+            if f.ref is not None:
+                self.refs[f.name] = f.ref
+
+        window_text = ", ".join(f"{f.name} ({f.line_count}行)" for f in result.files)
+        message = (
+            f"監視中のログで異常を検出しました (直近{self.args.detect_window:g}秒のエラー行 {error_count}件)。\n"
+            f"直近{self.args.window:g}秒に追記された行を分析してください: {window_text}\n"
+            "(行番号はこのウィンドウ内での番号です。前回の分析結果がある場合は、そこから変化した点を明確にしてください)"
+        )
+        graph_input = {
+            "messages": [HumanMessage(content=message)],
+            "log_files": result.log_files,
+            "new_log_files": result.log_files,
+            "incident_timeline": result.incident_timeline(),
+            "anomaly_report": result.anomaly_report(),
+            "shards": plan_shards(result),
+        }
+        config = {"configurable": {"thread_id": self.thread_id}}
+        started = time.perf_counter()
+        recorder = RunRecorder(self.thread_id)
+        try:
+            async for _ in recorder.track(app_graph.astream_events(graph_input, config, version="v2")):
+                pass
+        finally:
+            # 次のスナップショットはブロブの参照が変わるため、今回のサンプリング結果は使われない
+            drop_sampled_contexts(self.thread_id)
+
+        state = await app_graph.aget_state(config)
+        report = next(
+            (m.content for m in reversed(state.values.get("messages", [])) if isinstance(m, AIMessage) and m.content),
+            "",
+        )
+        os.makedirs(self.args.output, exist_ok=True)
+        path = os.path.join(self.args.output, time.strftime("%Y%m%d-%H%M%S") + ".md")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(str(report))
+        print(f"[analyze] {path} ({time.perf_counter() - started:.1f}秒, {window_text})", file=sys.stderr)
+
+    async def run(self) -> None:
+        run_task: Optional[asyncio.Task] = None
+        try:
+            while self.args.max_runs <= 0 or self.runs < self.args.max_runs or run_task is not None:
+                more = await asyncio.to_thread(self.poll)
+                now = time.monotonic()
+
+                if run_task is not None and run_task.done():
+                    if run_task.exception() is not None:
+                        e = run_task.exception()
+                        print(f"[error] {type(e).__name__}: {e}", file=sys.stderr)
+                    run_task = None
+                    self.last_run_end = now
+
+                if self.detector.fired and self.pending_since is None:
+                    self.pending_since = now
+                if (
+                    self.pending_since is not None
+                    and run_task is None
+                    and now - self.pending_since >= self.args.debounce
+                    and now - self.last_run_end >= self.args.cooldown
+                    and (self.args.max_runs <= 0 or self.runs < self.args.max_runs)
+                ):
+                    # 分析中に溜まった発火はまとめて次の1回になる
+                    self.pending_since = None
+                    self.runs += 1
+                    run_task = asyncio.create_task(self.analyze(self.detector.total))
+                    self.detector.counts.clear()
+                    self.detector.total = 0
+
+                if not more:
+                    await asyncio.sleep(self.args.poll)
+        finally:
+            if run_task is not None:
+                run_task.cancel()
+            for follower in self.followers.values():
+                follower.close()
+
+# ==========================================
+# 3. コマンドライン
+# ==========================================
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="ログディレクトリを監視し、異常を検出したときだけ分析します。")
+    parser.add_argument("directory", help="監視するログディレクトリ")
+    parser.add_argument("--output", default="reports/tail", help="レポートの出力先 (既定: reports/tail)")
+    parser.add_argument("--pattern", default=os.getenv("TAIL_FILE_PATTERN", "*.log"),
+                        help="追跡するファイル名のパターン (既定: *.log。ローテーション済みの app.log.1 等は対象外)")
+    parser.add_argument("--thread-id", default=None, help="分析を継続するスレッドID (既定: tail-<ディレクトリ名>)")
+    parser.add_argument("--from-start", action="store_true", help="起動時に既存の内容も先頭から読み込む")
+    parser.add_argument("--threshold", type=int, default=int(os.getenv("TAIL_ERROR_THRESHOLD", "20")),
+                        help="分析を起動するエラー行数 (既定: 20)")
+    parser.add_argument("--detect-window", type=float, default=float(os.getenv("TAIL_DETECT_WINDOW_SEC", "60")),
+                        help="エラー行を数える時間幅 (秒、既定: 60)")
+    parser.add_argument("--debounce", type=float, default=float(os.getenv("TAIL_DEBOUNCE_SEC", "30")),
+                        help="発火から分析開始までの待ち時間 (秒、既定: 30)")
+    parser.add_argument("--cooldown", type=float, default=float(os.getenv("TAIL_COOLDOWN_SEC", "300")),
+                        help="分析の終了から次の分析までの最短間隔 (秒、既定: 300)")
+    parser.add_argument("--window", type=float, default=float(os.getenv("TAIL_WINDOW_SEC", "900")),
+                        help="分析対象とする直近の時間幅 (秒、既定: 900)")
+    parser.add_argument("--window-mb", type=int, default=int(os.getenv("TAIL_WINDOW_MB", "64")),
+                        help="1ファイルあたりのウィンドウの上限 (MB、既定: 64)")
+    parser.add_argument("--poll", type=float, default=0.5, help="追記の確認間隔 (秒、既定: 0.5)")
+    parser.add_argument("--rescan", type=float, default=5.0, help="新しいファイルの確認間隔 (秒、既定: 5)")
+    parser.add_argument("--read-mb", type=int, default=8, help="1回の確認で1ファイルから読む上限 (MB、既定: 8)")
+    parser.add_argument("--max-runs", type=int, default=0, help="この回数だけ分析したら終了する (0は無制限)")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if not os.path.isdir(args.directory):
+        print(f"{args.directory} はディレクトリではありません", file=sys.stderr)
+        return 2
+    tailer = LogTailer(args)
+    try:
+        asyncio.run(tailer.run())
+    except KeyboardInterrupt:
+        pass
+    print(f"[stop] {tailer.bytes_read / (1024 * 1024):.1f}MB 読み込み, 分析 {tailer.runs}回", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
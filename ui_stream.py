@@ -0,0 +1,82 @@
+# このファイルはChainlitへのトークンのストリーミング表示をまとめて送るバッファを管理します。
+# on_chat_model_stream のチャンクごとに stream_token を呼ぶと、1トークン = 1フレームの WebSocket 送信になり、
+# 多数のセッションが同時にストリーミングするとサーバーのCPUを占有します。
+# TokenStream はチャンクを溜めて、一定時間 (既定 50ms) ごと、または一定の文字数を超えたときに
+# まとめて1回送信します。ノードの終了時には close() で残りを送ってから Step / Message を確定します。
+
+import asyncio
+import os
+import time
+from typing import List, Optional
+
+def stream_flush_interval() -> float:
+    """
+    まとめて送信する間隔 (秒、UI_STREAM_FLUSH_MS)。0 の場合はチャンクごとに送信します。
+    """
+    return max(float(os.getenv("UI_STREAM_FLUSH_MS", "50")), 0.0) / 1000
+
+def stream_max_chars() -> int:
+    """
+    間隔を待たずに送信するバッファの文字数 (UI_STREAM_MAX_CHARS)。
+    """
+    return max(int(os.getenv("UI_STREAM_MAX_CHARS", "2000")), 1)
+
+class TokenStream:
+    """
+    stream_token(token) を持つ送信先 (cl.Step / cl.Message) へのバッファ付きストリーム。
+    送信はロックで直列化するため、タイマーによる送信と書き込みによる送信が重なっても順序は保たれます。
+    """
+
+    def __init__(self, target, flush_interval: Optional[float] = None, max_chars: Optional[int] = None):
+        self.target = target
+        self.flush_interval = stream_flush_interval() if flush_interval is None else flush_interval
+        self.max_chars = stream_max_chars() if max_chars is None else max_chars
+        # 受け取ったチャンク数と実際の送信回数 (metrics.py で集計する)
+        self.chunks = 0
+        self.frames = 0
+        self._parts: List[str] = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+
+    async def write(self, text: str) -> None:
+        if not text:
+            return
+        self.chunks += 1
+        self._parts.append(text)
+        self._size += len(text)
+        if (
+            self.flush_interval <= 0
+            or self._size >= self.max_chars
+            or time.monotonic() - self._last_flush >= self.flush_interval
+        ):
+            await self.flush()
+        elif self._timer is None:
+            # 次のチャンクが来なくても、間隔が過ぎたら溜まった分を表示する
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(max(self.flush_interval - (time.monotonic() - self._last_flush), 0.0))
+        self._timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._parts:
+                return
+            text = "".join(self._parts)
+            self._parts.clear()
+            self._size = 0
+            self.frames += 1
+            await self.target.stream_token(text)
+
+    async def close(self) -> None:
+        """
+        タイマーを止め、残りを送信します。Step / Message の update() の前に呼び出します。
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
@@ -0,0 +1,146 @@
+# このファイルは分析結果の引用 (ファイル名:行番号) を機械的に検証する検証器を管理します。
+# Critique Agent の差し戻しの多くは引用の欠落・誤りなので、LLMを呼ぶ前に
+#   - 引用されたファイル・行がインジェスト済みのログに実在するか
+#   - 引用の直後にバッククォートで書かれた抜粋が、その行の原文に含まれるか
+#   - 箇条書きの主張のうち、どれだけに引用が付いているか
+# を行インデックス (line_index.py) またはブロブストアで確認します。
+# 十分に引用された分析は critique_node がLLMを呼ばずに承認し、判定できない場合だけLLMの批評に回します。
+
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from line_index import get_indexed_files
+from log_store import CITATION_PATTERN, BlobStore
+
+# 引用の直後 (同じ行) に書かれた `抜粋`
+QUOTE_PATTERN = re.compile(r"`([^`\n]{4,})`")
+# 見出し・箇条書きの判定
+HEADING_PATTERN = re.compile(r"^\s*#")
+CLAIM_PATTERN = re.compile(r"^\s*(?:[-*・]|\d+[.)])\s+\S")
+
+def verifier_enabled() -> bool:
+    return os.getenv("VERIFIER_ENABLED", "true").lower() not in ("0", "false", "no")
+
+@dataclass
+class Verdict:
+    # "approve" (LLMの批評を省略して承認) または "inconclusive" (LLMの批評に回す)
+    status: str
+    citations: int = 0
+    claims: int = 0
+    cited_claims: int = 0
+    # 検証で見つかった問題 (LLMの批評にそのまま渡す)
+    problems: List[str] = field(default_factory=list)
+
+    @property
+    def coverage(self) -> float:
+        return self.cited_claims / self.claims if self.claims else 1.0
+
+    def approval_message(self) -> str:
+        return (
+            "APPROVE\n"
+            f"(自動検証) 引用 {self.citations} 件がすべてログの原文と一致し、"
+            f"主張 {self.claims} 件のうち {self.cited_claims} 件に引用があります。"
+        )
+
+    def report(self) -> str:
+        """
+        LLMの批評に渡す検証結果のテキスト。
+        """
+        lines = [f"引用 {self.citations} 件 / 引用付きの主張 {self.cited_claims}/{self.claims} 件"]
+        lines.extend(f"- {p}" for p in self.problems)
+        return "\n".join(lines)
+
+class CitedLines:
+    """
+    ファイル名から原文の行を引く。行インデックスがあればオフセットで直接読み、無ければブロブストアから読む。
+    """
+
+    def __init__(self, session_id: Optional[str], store: Optional[BlobStore], log_files: List[dict]):
+        self.indexed = get_indexed_files(session_id)
+        self.store = store
+        self.refs = {f["name"]: f["ref"] for f in log_files if f.get("ref")}
+
+    def _resolve(self, name: str) -> Optional[str]:
+        for candidate in (name, os.path.basename(name)):
+            if candidate in self.indexed or candidate in self.refs:
+                return candidate
+        return None
+
+    def read(self, name: str, start: int, end: int) -> Optional[List[Tuple[int, str]]]:
+        """
+        start〜end 行目を返します。ファイルが見つからない場合は None を返します。
+        """
+        resolved = self._resolve(name)
+        if resolved is None:
+            return None
+        f = self.indexed.get(resolved)
+        if f is not None:
+            return f.index.read_range(f.path, start, end)
+        ref = self.refs[resolved]
+        if self.store is None or not self.store.exists(ref):
+            return None
+        return self.store.read_lines(ref, start, end)
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+def verify_analysis(
+    text: str,
+    lines: CitedLines,
+    min_citations: Optional[int] = None,
+    min_coverage: Optional[float] = None,
+    max_lines_per_citation: int = 50,
+) -> Verdict:
+    """
+    分析結果のテキストの引用を検証します。
+    全ての引用が実在する行を指し、抜粋が原文と一致し、引用数と主張の引用率が基準を満たす場合に承認します。
+    """
+    if min_citations is None:
+        min_citations = int(os.getenv("VERIFIER_MIN_CITATIONS", "2"))
+    if min_coverage is None:
+        min_coverage = float(os.getenv("VERIFIER_MIN_COVERAGE", "0.6"))
+
+    verdict = Verdict(status="inconclusive")
+    checked = set()
+    for row in text.splitlines():
+        if HEADING_PATTERN.match(row) or not row.strip():
+            continue
+        matches = list(CITATION_PATTERN.finditer(row))
+        if CLAIM_PATTERN.match(row):
+            verdict.claims += 1
+            verdict.cited_claims += 1 if matches else 0
+        for i, match in enumerate(matches):
+            name, start = match.group(1), int(match.group(2))
+            end = int(match.group(3)) if match.group(3) else start
+            # 抜粋は、この引用から次の引用までの間に書かれたものを対象にする
+            tail = row[match.end():matches[i + 1].start() if i + 1 < len(matches) else len(row)]
+            quotes = [q for q in QUOTE_PATTERN.findall(tail) if not CITATION_PATTERN.search(q)]
+            if (name, start, end) in checked and not quotes:
+                continue
+            checked.add((name, start, end))
+            verdict.citations += 1
+
+            if end < start:
+                verdict.problems.append(f"{name}: {start}-{end} は行範囲が逆順です")
+                continue
+            cited = lines.read(name, start, min(end, start + max_lines_per_citation - 1))
+            if cited is None:
+                verdict.problems.append(f"{name} はアップロードされたログにありません")
+                continue
+            if not cited:
+                verdict.problems.append(f"{name}: {start} は行番号が範囲外です")
+                continue
+            original = _normalize("\n".join(line for _, line in cited))
+            for quote in quotes:
+                if _normalize(quote) not in original:
+                    verdict.problems.append(f"{name}: {start} の原文に `{quote}` が見つかりません")
+
+    if verdict.citations < min_citations:
+        verdict.problems.append(f"引用が {verdict.citations} 件しかありません (基準: {min_citations} 件以上)")
+    if verdict.coverage < min_coverage:
+        verdict.problems.append(f"引用の付いていない主張があります (引用率 {verdict.coverage:.0%}、基準: {min_coverage:.0%})")
+    if not verdict.problems:
+        verdict.status = "approve"
+    return verdict